@@ -0,0 +1,209 @@
+#!/usr/bin/env python3.4
+#
+# @file    indexes.py
+# @brief   Declarative description and management of the database indexes.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# The indexes we want on the repos collection are listed in 'repo_indexes'
+# below.  IndexManager compares that list with what the server actually
+# has (from index_information()), and can build the missing ones, several
+# at a time, and drop the ones that aren't in the list.  It also points
+# out indexes that are redundant because another index starts with the
+# same keys, and reports how long each build took and how big each index
+# is.
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from pymongo import ASCENDING, DESCENDING, TEXT
+
+
+# Index specifications.
+# .............................................................................
+
+class IndexSpec(namedtuple('IndexSpec', 'keys options')):
+    '''An index: 'keys' is a list of (field, direction) pairs, as for
+    create_index(), and 'options' a dict of its other options.'''
+
+    __slots__ = ()
+
+    def __new__(cls, keys, **options):
+        return super().__new__(cls, tuple(keys), options)
+
+    @property
+    def name(self):
+        '''The name the server gives the index, unless one was given.'''
+        if 'name' in self.options:
+            return self.options['name']
+        return '_'.join('{}_{}'.format(field, direction)
+                        for field, direction in self.keys)
+
+    @property
+    def is_text(self):
+        return any(direction == TEXT for _, direction in self.keys)
+
+
+# The indexes on the repos collection.
+
+repo_indexes = [
+    IndexSpec([('owner', ASCENDING), ('name', ASCENDING)]),
+    IndexSpec([('description', TEXT), ('readme', TEXT)]),
+    IndexSpec([('text_languages', ASCENDING)]),
+    IndexSpec([('languages.name', ASCENDING)]),
+    IndexSpec([('files', ASCENDING)]),
+    IndexSpec([('content_type', ASCENDING)]),
+    IndexSpec([('is_deleted', ASCENDING)]),
+    IndexSpec([('is_visible', ASCENDING)]),
+    IndexSpec([('fork.parent', ASCENDING)]),
+    IndexSpec([('fork.root', ASCENDING)]),
+    IndexSpec([('time.repo_created', ASCENDING)]),
+    IndexSpec([('time.repo_updated', ASCENDING)]),
+    IndexSpec([('time.repo_pushed', ASCENDING)]),
+    IndexSpec([('time.data_refreshed', ASCENDING)]),
+    IndexSpec([('topics.lcsh', ASCENDING)]),
+    IndexSpec([('interfaces', ASCENDING)]),
+    IndexSpec([('kind', ASCENDING)]),
+]
+
+
+# Comparing.
+# .............................................................................
+
+def _same_keys(spec, info):
+    # Text indexes are stored with internal keys (_fts, _ftsx) and the
+    # fields in 'weights', so compare those by field names instead.
+    if spec.is_text:
+        weights = info.get('weights', {})
+        return (any(direction == 'text' for _, direction in info['key'])
+                and set(weights) == {field for field, _ in spec.keys})
+    return [(f, d) for f, d in info['key']] == list(spec.keys)
+
+
+def _redundant(info):
+    # Returns {name: name of the index that makes it redundant}.  An index
+    # is redundant if its keys are a prefix of another ordinary index's.
+    plain = {name: list(i['key']) for name, i in info.items()
+             if name != '_id_' and not any(d == 'text' for _, d in i['key'])}
+    redundant = {}
+    for name, keys in plain.items():
+        for other, other_keys in plain.items():
+            if (other != name and len(keys) < len(other_keys)
+                    and other_keys[:len(keys)] == keys
+                    and not info[name].get('unique')):
+                redundant[name] = other
+                break
+    return redundant
+
+
+IndexPlan = namedtuple('IndexPlan', 'present missing extra redundant')
+
+
+# Managing.
+# .............................................................................
+
+class IndexManager():
+    '''Keeps the indexes on 'collection' in line with 'specs'.'''
+
+    def __init__(self, collection, specs, log=None):
+        self.collection = collection
+        self.specs = list(specs)
+        self.log = log or (lambda text: None)
+
+    def plan(self):
+        '''Compare the specs with the indexes on the server.  Returns an
+        IndexPlan: 'present' and 'missing' are lists of specs, 'extra' a
+        list of the names of indexes on the server that aren't in the
+        specs, and 'redundant' a dict as described for _redundant().'''
+        info = self.collection.index_information()
+        present, missing = [], []
+        matched = set()
+        for spec in self.specs:
+            name = next((name for name, i in info.items() if _same_keys(spec, i)), None)
+            if name:
+                present.append(spec)
+                matched.add(name)
+            else:
+                missing.append(spec)
+        extra = [name for name in info if name not in matched and name != '_id_']
+        return IndexPlan(present, missing, extra, _redundant(info))
+
+    def sizes(self):
+        '''Return {index name: size in bytes}.'''
+        stats = self.collection.database.command('collstats', self.collection.name)
+        return stats.get('indexSizes', {})
+
+    def usage(self):
+        '''Return {index name: number of times used since the server
+        started}, from $indexStats.'''
+        return {s['name']: s['accesses']['ops']
+                for s in self.collection.aggregate([{'$indexStats': {}}])}
+
+    def _build(self, spec):
+        start = time()
+        options = dict(spec.options)
+        options.setdefault('background', True)
+        name = self.collection.create_index(list(spec.keys), **options)
+        return (name, time() - start)
+
+    def build_missing(self, parallel=2, dry_run=False):
+        '''Build the indexes that are missing, 'parallel' at a time.
+        Returns a list of (name, seconds taken).'''
+        missing = self.plan().missing
+        if not missing:
+            self.log('All {} indexes are present'.format(len(self.specs)))
+            return []
+        if dry_run:
+            for spec in missing:
+                self.log('Would build {}'.format(spec.name))
+            return []
+        results = []
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+            for name, seconds in pool.map(self._build, missing):
+                self.log('Built {} in {:.1f} s'.format(name, seconds))
+                results.append((name, seconds))
+        return results
+
+    def drop_extra(self, dry_run=False, unused_only=False):
+        '''Drop the indexes on the server that aren't in the specs.  If
+        'unused_only' is true, only those that $indexStats says have never
+        been used are dropped.  Returns the names of the indexes dropped.'''
+        extra = self.plan().extra
+        if unused_only and extra:
+            usage = self.usage()
+            extra = [name for name in extra if not usage.get(name)]
+        for name in extra:
+            if dry_run:
+                self.log('Would drop {}'.format(name))
+            else:
+                self.collection.drop_index(name)
+                self.log('Dropped {}'.format(name))
+        return extra
+
+    def report(self):
+        '''Return a list of lines describing each index: whether it is in
+        the specs, its size, and whether it is redundant.'''
+        plan = self.plan()
+        sizes = self.sizes()
+        info = self.collection.index_information()
+        lines = []
+        for name in sorted(info):
+            if name == '_id_':
+                status = 'built in'
+            elif name in plan.extra:
+                status = 'not in spec'
+            else:
+                status = 'ok'
+            if name in plan.redundant:
+                status += ', redundant with ' + plan.redundant[name]
+            lines.append('{:<45} {:>10.1f} MB  {}'.format(
+                name, sizes.get(name, 0)/2**20, status))
+        for spec in plan.missing:
+            lines.append('{:<45} {:>13}  missing'.format(spec.name, '-'))
+        return lines
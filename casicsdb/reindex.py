@@ -1,83 +1,39 @@
 #!/usr/bin/env python3.4
+#
+# Brings the indexes on the repos collection in line with the list in
+# indexes.py: builds the ones that are missing (-p at a time), optionally
+# drops the ones that aren't in the list (-d, or -u to drop only those
+# that have never been used), and prints the size and status of each.
+# Use -n to see what would be done without doing it.
 
 import os
-import pprint
+import plac
 import sys
-import time
 
 sys.path.append('../common')
 
 from casicsdb import *
-from pymongo import ASCENDING, DESCENDING, TEXT
-
-casicsdb = CasicsDB()
-github_db = casicsdb.open('github')
-repos = github_db.repos
-
-start = time.time()
-repos.create_index( [('owner', ASCENDING), ('name', ASCENDING)], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('description', TEXT), ('readme', TEXT)], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('text_languages', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('languages.name', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('files', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('content_type', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('is_deleted', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('is_visible', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('fork.parent', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('fork.root', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('time.repo_created', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('time.repo_updated', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('time.repo_pushed', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('time.data_refreshed', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('topics.lcsh', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('interfaces', ASCENDING )], background=True)
-print(time.time() - start)
-
-start = time.time()
-repos.create_index( [('kind', ASCENDING )], background=True)
-print(time.time() - start)
+from indexes import *
+
+
+def run(parallel=2, drop=False, unused=False, dry_run=False):
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
+
+    manager = IndexManager(repos, repo_indexes, log=print)
+    manager.build_missing(parallel, dry_run)
+    if drop or unused:
+        manager.drop_extra(dry_run, unused_only=unused)
+    for line in manager.report():
+        print(line)
+
+run.__annotations__ = dict(
+    parallel = ('number of indexes to build at the same time', 'option', 'p', int),
+    drop     = ('drop indexes that are not in the list', 'flag', 'd'),
+    unused   = ('drop indexes that are not in the list and never used', 'flag', 'u'),
+    dry_run  = ('only say what would be done', 'flag', 'n'),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
@@ -33,6 +33,7 @@ from time import time, sleep
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
 from casicsdb import *
+from ghtorrent import *
 
 
 # Main body.
@@ -40,54 +41,42 @@ from casicsdb import *
 # Currently this only does GitHub, but extending this to handle other hosts
 # should hopefully be possible.
 
-start = time()
-
-msg('Opening database ...')
+def run(processes=1):
+    start = time()
 
-casicsdb = CasicsDB()
-github_db = casicsdb.open('github')
-repos = github_db.repos
+    msg('Opening database ...')
 
-# The GHTorrent CSV projects.csv file has an "id" as the first column, but
-# I believe that's the id for the entry in the table and not the project id.
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
 
-fields = {'id'          : 0,            # Don't use this -- no the project id.
-          'url'         : 1,
-          'name'        : 3,
-          'description' : 4,
-          'language'    : 5,
-          'created'     : 6,
-          'forked_from' : 7,
-          'deleted'     : 8}
+    # The GHTorrent CSV projects.csv file has an "id" as the first column,
+    # but I believe that's the id for the entry in the table and not the
+    # project id.
 
-namestart = len('https://api.github.com/repos/')
-id_map = {}
+    fields = {'id'          : 0,            # Don't use this -- no the project id.
+              'url'         : 1,
+              'name'        : 3,
+              'description' : 4,
+              'language'    : 5,
+              'created'     : 6,
+              'forked_from' : 7,
+              'deleted'     : 8}
 
-# Read the file once and build a mapping from their identifiers to
-# project owner/name path strings.
+    # We need a mapping from their identifiers to project owner/name path
+    # strings.  It's kept in an index file next to projects.csv, which is
+    # built from the CSV file the first time it's needed.
 
-msg('Building project id mapping')
-with open('projects.csv', encoding="utf-8", errors="replace") as f:
-    reader = csv.reader(f, escapechar='\\')
-    count = 0
-    for row in reader:
-        id   = row[fields['id']]
-        if id == '-1':
-            continue
-        path = row[fields['url']][namestart:]
-        id_map[id] = path
-        count += 1
-        if count % 10000 == 0:
-            msg(count)
+    msg('Opening project id mapping')
+    id_map = open_id_map('projects.csv')
 
-# Now process the file for real.
+    # Now process the file for real.  The file is parsed by -p worker
+    # processes.
 
-msg('Extracting the data for real.')
-with open('projects.csv', encoding="utf-8", errors="replace") as f:
-    reader = csv.reader(f, escapechar='\\')
+    msg('Extracting the data for real.')
     count = 0
     start = time()
-    for row in reader:
+    for row in iter_csv_rows('projects.csv', processes):
         id   = row[fields['id']]
         if id == '-1':
             continue
@@ -170,3 +159,10 @@ with open('projects.csv', encoding="utf-8", errors="replace") as f:
         if count % 10000 == 0:
             msg('{} [{:2f}]'.format(count, time() - start))
             start = time()
+
+run.__annotations__ = dict(
+    processes = ('number of processes for parsing the CSV file', 'option', 'p', int),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
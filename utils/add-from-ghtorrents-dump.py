@@ -23,12 +23,15 @@ import http
 import requests
 import urllib
 from datetime import datetime
+from itertools import chain
 from time import time, sleep
 from pymongo import MongoClient
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
 from casicsdb import *
+from bulkwriter import *
+from ghtorrent import *
 
 
 # Helpers
@@ -67,6 +70,9 @@ def add(entry, owner, name):
                         fork_of=parent,
                         fork_root=fork_root)
     repos.insert_one(entry)
+    # The resolver may remember this repository as not found.
+    resolver.forget(id=ghentry['id'], owner=owner, name=name)
+    return entry
 
 
 def update(entry, ghentry):
@@ -107,9 +113,9 @@ def update(entry, ghentry):
         fork['root']   = ghentry['source']['full_name']
         updates['fork'] = fork
 
-    # Issue the update to our db.
+    # Queue the update to our db.
     msg('{}/{} (#{}) updated'.format(owner, name, entry['_id']))
-    repos.update_one({'_id': entry['_id']}, {'$set': updates}, upsert=False)
+    writer.set(entry['_id'], updates)
 
 
 def github_url_path(entry, owner=None, name=None):
@@ -141,6 +147,10 @@ def github_url_exists(entry, owner=None, name=None):
     return resp.status < 400
 
 
+def not_in_dump(owner, name):
+    msg('* {}/{} not found in GHTorrent dump'.format(owner, name))
+
+
 # Main body.
 # .............................................................................
 # Currently this only does GitHub, but extending this to handle other hosts
@@ -154,81 +164,94 @@ ghtorrentdb = MongoClient(tz_aware=True, connect=True)
 ghtorrentgithub = ghtorrentdb['github']
 ghtorrentrepos = ghtorrentgithub.repos
 
+# Inputs with at least this many lines are joined with a sorted scan of the
+# dump rather than looked up in batches of 'batch_size'.
+
+join_threshold = 100000
+batch_size     = 1000
+
 msg('Opening remote CASICS database ...')
 
 casicsdb = CasicsDB()
 github_db = casicsdb.open('github')
 repos = github_db.repos
 
-msg('Reading file of repositories')
+# Long lists of repositories are sorted and merged with a sorted scan of the
+# GHTorrent dump; short ones are looked up in batches.  Either way, our own
+# entries are looked up a batch at a time.
 
-lines = None
-with open(sys.argv[1], encoding="utf-8") as f:
-    lines = f.readlines()
+input_file = sys.argv[1]
+join = count_lines(input_file) >= join_threshold
+msg('Matching {} against GHTorrent dump by {}'.format(
+    input_file, 'sorted merge' if join else 'batched lookups'))
+
+matches = dump_entries(ghtorrentrepos, read_repo_paths(input_file), join,
+                       None, batch_size, not_found=not_in_dump)
 
 msg('Doing updates')
+writer = BulkUpdater(repos, batch_size=batch_size)
+resolver = RepoResolver(repos)
 count = 0
 start = time()
-for line in lines:
-    line  = line.strip()
-    owner = line[:line.find('/')]
-    name  = line[line.find('/') + 1:]
-
-    ghentry = ghtorrentrepos.find_one({'owner.login': owner, 'name': name})
-    if not ghentry:
-        msg('* {}/{} not found in GHTorrent dump'.format(owner, name))
-        continue
-
-    # First try to find it with the repo id, because that's more invariant
-    # than the name of the repo.
-    entry = repos.find_one({'_id': ghentry['id']})
-    if entry:
-        if entry['owner'] != owner or entry['name'] != name:
-            # We have the id, but with a different owner/name.  We keep ours
-            # because we are more likely to have updated our records compared
-            # to the older dumps from GHTorrent (at least at the time I'm
-            # doing this today, 2016-05-12).
-            msg('*** owner/name mismatch: using {}/{} for {}'.format(
-                entry['owner'], entry['name'], entry['_id']))
-        update(entry, ghentry)
-    else:
-        # We didn't find the id.  Check if we have the owner/name.
-        entry = repos.find_one({'owner': owner, 'name': name})
+for window in casics_windows(repos, matches, batch_size, resolver=resolver):
+    # Entries added from this window, by id and by path.  The whole window
+    # was looked up before any of them were added, so a repository that
+    # comes up twice in it would otherwise look new both times.
+    added = {}
+    for owner, name, ghentry, entry, entry_by_path in window:
+        entry = entry or added.get(ghentry['id'])
+        entry_by_path = entry_by_path or added.get((owner, name))
+        # First try to find it with the repo id, because that's more invariant
+        # than the name of the repo.
         if entry:
-            # We have different id's for the same owner/name path.  This can
-            # happen if an owner renames a repository "A" to "B" but then
-            # creates another repository called "A".  Depending on when we
-            # sample GH versus when GHTorrent samples GH, we may have
-            # different id's for the same owner/name path.  Now the question
-            # is, which one is more correct?  We should take the one with the
-            # most recent creation date.
-
-            ghentry_date = canonicalize_timestamp(ghentry['created_at'])
-            if entry['time']['repo_created'] > ghentry_date:
-                msg('*** id mismatch: {}/{} is our #{} but their #{} -- ours is newer'.format(
-                    entry['owner'], entry['name'], entry['_id'], ghentry['id']))
-                update(entry, ghentry)
-            else:
-                # Their entry has a newer creation date.  It's tempting to
-                # delete our entry and replace it with their presumably-newer
-                # data, but in my spot-checking of cases when this happened,
-                # our data was correct and theirs didn't match what's in GH.
-                # I am leaving ours in place.
-
-                msg('*** id mismatch: {}/{} is our #{} but their #{} -- theirs is newer'.format(
-                    entry['owner'], entry['name'], entry['_id'], ghentry['id']))
-                # repos.remove_one({'_id' : entry['_id']})
-                # add(ghentry, owner, name)
-                update(entry, ghentry)
+            if entry['owner'] != owner or entry['name'] != name:
+                # We have the id, but with a different owner/name.  We keep ours
+                # because we are more likely to have updated our records compared
+                # to the older dumps from GHTorrent (at least at the time I'm
+                # doing this today, 2016-05-12).
+                msg('*** owner/name mismatch: using {}/{} for {}'.format(
+                    entry['owner'], entry['name'], entry['_id']))
+            update(entry, ghentry)
         else:
-            # We didn't find it at all.
-            add(ghentry, owner, name)
+            # We didn't find the id.  Check if we have the owner/name.
+            entry = entry_by_path
+            if entry:
+                # We have different id's for the same owner/name path.  This can
+                # happen if an owner renames a repository "A" to "B" but then
+                # creates another repository called "A".  Depending on when we
+                # sample GH versus when GHTorrent samples GH, we may have
+                # different id's for the same owner/name path.  Now the question
+                # is, which one is more correct?  We should take the one with the
+                # most recent creation date.
+
+                ghentry_date = canonicalize_timestamp(ghentry['created_at'])
+                if entry['time']['repo_created'] > ghentry_date:
+                    msg('*** id mismatch: {}/{} is our #{} but their #{} -- ours is newer'.format(
+                        entry['owner'], entry['name'], entry['_id'], ghentry['id']))
+                    update(entry, ghentry)
+                else:
+                    # Their entry has a newer creation date.  It's tempting to
+                    # delete our entry and replace it with their presumably-newer
+                    # data, but in my spot-checking of cases when this happened,
+                    # our data was correct and theirs didn't match what's in GH.
+                    # I am leaving ours in place.
+
+                    msg('*** id mismatch: {}/{} is our #{} but their #{} -- theirs is newer'.format(
+                        entry['owner'], entry['name'], entry['_id'], ghentry['id']))
+                    # repos.remove_one({'_id' : entry['_id']})
+                    # add(ghentry, owner, name)
+                    update(entry, ghentry)
+            else:
+                # We didn't find it at all.
+                added[ghentry['id']] = added[(owner, name)] = add(ghentry, owner, name)
 
-    # Misc.
+        # Misc.
 
-    count += 1
-    if count % 1000 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
+        count += 1
+        if count % 1000 == 0:
+            msg('{} [{:2f}]'.format(count, time() - start))
+            start = time()
 
+writer.flush()
+msg('{} updates sent, {} modified'.format(writer.sent, writer.modified))
 msg('Done')
@@ -26,25 +26,16 @@ import sys
 import plac
 import os
 import csv
-from collections import defaultdict
 from time import time, sleep
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
 from casicsdb import *
+from ghtorrent import *
+from extsort import *
+from bulkwriter import *
 
 
-# Main body.
-# .............................................................................
-
-start = time()
-
-msg('Opening database ...')
-
-casicsdb = CasicsDB()
-github_db = casicsdb.open('github')
-repos = github_db.repos
-
 # The GHTorrent CSV projects.csv file has an "id" as the first column, but
 # I believe that's the id for the entry in the table and not the project id.
 
@@ -57,72 +48,30 @@ proj_fields = {'id'          : 0,            # Don't use this -- no the project
                'forked_from' : 7,
                'deleted'     : 8}
 
-namestart = len('https://api.github.com/repos/')
-id_map = {}
-
-# Read the projects.csv file once and build a mapping from GHTorrent's
-# project identifiers to project owner/name path strings.
-
-msg('Building project id mapping')
-with open('projects.csv', encoding="utf-8", errors="replace") as f:
-    reader = csv.reader(f, escapechar='\\')
-    count = 0
-    for row in reader:
-        id   = int(row[0])
-        if id == -1:
-            continue
-        path = row[1][namestart:]
-        id_map[id] = path
-        count += 1
-        if count % 1000000 == 0:
-            msg(count)
-
-# Read project-languages.csv and create a list of languages known for each
-# project.
+# Read project_languages.csv and projects.csv, and join them on GHTorrent's
+# project id.  Rather than hold maps of both files in memory, each is sorted
+# by id (spilling to temporary files when it doesn't fit in 'run_size'
+# records) and then the two sorted streams are merged.  Memory use is
+# bounded by 'run_size' no matter how big the files are.
+#
+# The output of the join is a stream of (id, languages, paths) tuples, where
+# each language and path comes with its line number in its file, e.g.:
+#
+#   (58021, [(1, 'c'), (3, 'php'), (4, 'c++')], [(0, 'tosch/ruote-kit')])
+#
+# We then need to:
+# 1) correct the case of the language strings ("viml" -> "VimL")
+# 2) convert the language list to the form [{'name': 'c'}, {'name': 'VimL']...}
+# 3) look up the owner/name paths in our database and update the entries.
 
 lang_fields = {'id'   : 0,            # Their id, not ours.
                'lang' : 1}
 
-lang_map = defaultdict(list)
+run_size = 5000000
 
-msg('Reading languages')
-with open('project_languages.csv', encoding="utf-8", errors="replace") as f:
-    reader = csv.reader(f, escapechar='\\')
-    count = 0
-    for row in reader:
-        id   = int(row[0])
-        if id == -1:
-            continue
-        lang = row[1]
-        if lang not in lang_map[id]:
-            lang_map[id].append(lang)
-        count += 1
-        if count % 1000000 == 0:
-            msg(count)
-
-# At this point, we have a dictionary that looks like this:
-#
-# defaultdict(<class 'list'>, {'79607': ['viml'],
-#                             '58021': ['c', 'php', 'objective-c', 'shell'],
-#                             '935276': ['perl']
-#                             ...})
-# We need to:
-# 1) translate id numbers to project owner/name strings
-# 2) correct the case of the language strings ("viml" -> "VimL")
-# 3) convert the language list to the form [{'name': 'c'}, {'name': 'VimL']...}
-
-final_map = {}
-
-msg('Building final map: 1st stage')
-count = 0
-for id, languages in lang_map.items():
-    if id not in id_map:
-        msg('*** {} not found'.format(id))
-        continue
-    final_map[id_map[id]] = languages
-    count += 1
-    if count % 1000000 == 0:
-        msg(count)
+# Database lookups and updates are done this many at a time.
+
+batch_size = 1000
 
 lang_names = [
     "ABAP",
@@ -671,34 +620,86 @@ lang_name_map = {name.lower() : name for name in lang_names}
 def rename(lang):
     return lang_name_map[lang] if lang in lang_name_map else lang
 
-msg('Building final map: 2nd stage')
-count = 0
-for path, languages in final_map.items():
-    final_map[path] = [{'name': rename(n)} for n in final_map[path]]
-    count += 1
-    if count % 1000000 == 0:
-        msg(count)
-
-msg('Updating database')
-count = 0
-for path, languages in final_map.items():
-    owner       = path[:path.find('/')]
-    name        = path[path.find('/') + 1:]
-
-    entry = repos.find_one({'owner': owner, 'name': name}, {'languages': 1})
-
-    if not entry:
-        # We need to deal with these using our cataloguer.
-        msg('*** Unknown entry {}'.format(path))
-        continue
-
-    if not entry['languages'] or entry['languages'] == -1 \
-       or (len(entry['languages']) < len(languages)):
-        msg('Updating {}'.format(path))
-        repos.update_one({'_id': entry['_id']},
-                         {'$set': {'languages': languages}},
-                         upsert=False)
-
-    count += 1
-    if count % 1000000 == 0:
-        msg(count)
+
+def language_records(processes):
+    # Each language goes with its line number, so that a project's languages
+    # sort in file order (largest first, in GHTorrent's files) rather than
+    # alphabetically.  parallel_csv_rows() gives the rows in file order.
+    count = 0
+    for rows in parallel_csv_rows('project_languages.csv', processes, columns=(0, 1)):
+        for row in rows:
+            yield (int(row[lang_fields['id']]), (count, row[lang_fields['lang']]))
+            count += 1
+            if count % 1000000 == 0:
+                msg('{} language records read'.format(count))
+
+
+def project_records():
+    # Each path goes with its line number, so that paths with the same id
+    # sort in file order rather than alphabetically.
+    for n, (id, path) in enumerate(project_id_paths('projects.csv')):
+        yield (int(id), (n, path))
+
+
+def not_found(id, languages):
+    msg('*** {} not found'.format(id))
+
+
+def joined(processes):
+    languages = grouped(external_sort(language_records(processes), run_size))
+    projects  = grouped(external_sort(project_records(), run_size))
+    for id, langs, paths in merge_join(languages, projects, not_found):
+        # The languages are in file order; keep the first of any duplicates,
+        # as the old dict of language lists did.  An id should appear only
+        # once in projects.csv; if not, we take the path that comes last in
+        # the file, as the old dict of ids did.
+        seen  = set()
+        langs = [lang for _, lang in langs if not (lang in seen or seen.add(lang))]
+        path  = paths[-1][1]
+        yield (path[:path.find('/')], path[path.find('/') + 1:],
+               [{'name': rename(n)} for n in langs])
+
+
+# Main body.
+# .............................................................................
+# The files are parsed by -p worker processes.
+
+def run(processes=1):
+    msg('Opening database ...')
+
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
+
+    msg('Joining languages with projects and updating database')
+    meter = RateMeter()
+    with BulkUpdater(repos, batch_size=batch_size) as writer:
+        for window in windows(joined(processes), batch_size):
+            entries = find_by_paths(repos, [(owner, name) for owner, name, _ in window],
+                                    {'languages': 1})
+            for owner, name, languages in window:
+                entry = entries.get((owner, name))
+                if not entry:
+                    # We need to deal with these using our cataloguer.
+                    msg('*** Unknown entry {}/{}'.format(owner, name))
+                    continue
+
+                if not entry['languages'] or entry['languages'] == -1 \
+                   or (len(entry['languages']) < len(languages)):
+                    msg('Updating {}/{}'.format(owner, name))
+                    writer.set(entry['_id'], {'languages': languages})
+
+            meter.add(len(window))
+            if meter.count % 1000000 < batch_size:
+                msg('{} [{:.0f}/s]'.format(meter.count, meter.rate()))
+
+    msg('{} projects with languages; {} updates sent, {} modified'.format(
+        meter.count, writer.sent, writer.modified))
+    msg('Done')
+
+run.__annotations__ = dict(
+    processes = ('number of processes for parsing the CSV files', 'option', 'p', int),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
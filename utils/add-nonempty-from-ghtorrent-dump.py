@@ -29,12 +29,13 @@ sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
 from casicsdb import *
+from checkpoint import Checkpoint, default_checkpoint_file, scan
 
 
 # Helpers
 # .............................................................................
 
-def update(entry, ghentry):
+def update(repos, entry, ghentry):
     updates = {}
 
     # Turns out we can't trust the value returned by GitHub: if it's 0, the
@@ -43,7 +44,9 @@ def update(entry, ghentry):
     if ghentry['size'] > 0 and entry['content_type'] == '':
         updates['content_type'] = 'nonempty'
         repos.update_one({'_id': entry['_id']}, {'$set': updates}, upsert=False)
-        msg('{}/{} (#{}) updated'.format(owner, name, entry['_id']))
+        msg('{}/{} (#{}) updated'.format(entry['owner'], entry['name'], entry['_id']))
+        return True
+    return False
 
 
 # Main body.
@@ -51,35 +54,56 @@ def update(entry, ghentry):
 # Currently this only does GitHub, but extending this to handle other hosts
 # should hopefully be possible.
 
-start = time()
-
-msg('Opening local database ...')
-
-ghtorrentdb = MongoClient(tz_aware=True, connect=True)
-ghtorrentgithub = ghtorrentdb['github']
-ghtorrentrepos = ghtorrentgithub.repos
-
-msg('Opening remote CASICS database ...')
-
-casicsdb = CasicsDB()
-github_db = casicsdb.open('github')
-repos = github_db.repos
-
-msg('Doing updates')
-count = 0
-start = time()
-for ghentry in ghtorrentrepos.find({}, {'size': 1, 'owner': 1, 'name': 1}, no_cursor_timeout=True):
-    owner = ghentry['owner']['login']
-    name = ghentry['name']
-    entry = repos.find_one({'owner': owner, 'name': name}, {'content_type': 1, 'owner': 1, 'name': 1})
-    if not entry:
-        msg('*** {}/{} not found in our database'.format(owner, name))
-        continue
-    update(entry, ghentry)
-
-    count += 1
-    if count % 1000 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
-
-msg('Done')
+def run(resume=False, checkpoint_file=None):
+    msg('Opening local database ...')
+
+    ghtorrentdb = MongoClient(tz_aware=True, connect=True)
+    ghtorrentgithub = ghtorrentdb['github']
+    ghtorrentrepos = ghtorrentgithub.repos
+
+    msg('Opening remote CASICS database ...')
+
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
+
+    # The dump is read in _id order, and the last _id done is saved every
+    # minute, so that --resume continues from there.  If the cursor times
+    # out anyway, scan() opens a new one where it left off.
+
+    checkpoint = Checkpoint(checkpoint_file or default_checkpoint_file(__file__), resume)
+    if checkpoint.resumed:
+        msg('Resuming after _id {}'.format(checkpoint.position))
+
+    msg('Doing updates')
+    start = time()
+    for ghentry in scan(ghtorrentrepos, {}, {'size': 1, 'owner': 1, 'name': 1},
+                        checkpoint, no_cursor_timeout=True):
+        owner = ghentry['owner']['login']
+        name = ghentry['name']
+        checkpoint.count('read')
+        entry = repos.find_one({'owner': owner, 'name': name}, {'content_type': 1, 'owner': 1, 'name': 1})
+        if not entry:
+            msg('*** {}/{} not found in our database'.format(owner, name))
+            checkpoint.count('not found')
+            continue
+        if update(repos, entry, ghentry):
+            checkpoint.count('updated')
+
+        if checkpoint.counts['read'] % 1000 == 0:
+            msg('{} [{:2f}]'.format(checkpoint.counts['read'], time() - start))
+            start = time()
+
+    msg('{} read, {} not found, {} updated'.format(checkpoint.counts.get('read', 0),
+                                                   checkpoint.counts.get('not found', 0),
+                                                   checkpoint.counts.get('updated', 0)))
+    checkpoint.finish()
+    msg('Done')
+
+run.__annotations__ = dict(
+    resume          = ('continue from the last checkpoint', 'flag', 'R'),
+    checkpoint_file = ('checkpoint file (default: add-nonempty-from-ghtorrent-dump.checkpoint)', 'option', 'c'),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
@@ -23,12 +23,15 @@ import http
 import requests
 import urllib
 from datetime import datetime
+from itertools import chain
 from time import time, sleep
 from pymongo import MongoClient
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
 from casicsdb import *
+from bulkwriter import *
+from ghtorrent import *
 
 
 # Helpers
@@ -43,9 +46,13 @@ def update(entry, ghentry):
     time['repo_pushed']  = canonicalize_timestamp(ghentry['pushed_at'])
     updates['time'] = time
 
-    # Issue the update to our db.
+    # Queue the update to our db.
     msg('{}/{} (#{}) updated'.format(owner, name, entry['_id']))
-    repos.update_one({'_id': entry['_id']}, {'$set': updates}, upsert=False)
+    writer.set(entry['_id'], updates)
+
+
+def not_in_dump(owner, name):
+    msg('* {}/{} not found in GHTorrent dump'.format(owner, name))
 
 
 # Main body.
@@ -61,34 +68,39 @@ ghtorrentdb = MongoClient(tz_aware=True, connect=True)
 ghtorrentgithub = ghtorrentdb['github']
 ghtorrentrepos = ghtorrentgithub.repos
 
+# Inputs with at least this many lines are joined with a sorted scan of the
+# dump rather than looked up in batches of 'batch_size'.
+
+join_threshold = 100000
+batch_size     = 1000
+dump_fields    = {'id': 1, 'created_at': 1, 'updated_at': 1, 'pushed_at': 1}
+
 msg('Opening remote CASICS database ...')
 
 casicsdb = CasicsDB()
 github_db = casicsdb.open('github')
 repos = github_db.repos
 
-msg('Reading file of repositories')
+# Long lists of repositories are sorted and merged with a sorted scan of the
+# GHTorrent dump; short ones are looked up in batches.  Either way, our own
+# entries are looked up a batch at a time.
 
-lines = None
-with open(sys.argv[1], encoding="utf-8") as f:
-    lines = f.readlines()
+input_file = sys.argv[1]
+join = count_lines(input_file) >= join_threshold
+msg('Matching {} against GHTorrent dump by {}'.format(
+    input_file, 'sorted merge' if join else 'batched lookups'))
+
+matches = dump_entries(ghtorrentrepos, read_repo_paths(input_file), join,
+                       dump_fields, batch_size, not_found=not_in_dump)
 
 msg('Doing updates')
+writer = BulkUpdater(repos, batch_size=batch_size)
 count = 0
 start = time()
-for line in lines:
-    line  = line.strip()
-    owner = line[:line.find('/')]
-    name  = line[line.find('/') + 1:]
-
-    ghentry = ghtorrentrepos.find_one({'owner.login': owner, 'name': name})
-    if not ghentry:
-        msg('* {}/{} not found in GHTorrent dump'.format(owner, name))
-        continue
-
+for owner, name, ghentry, entry, entry_by_path in \
+        chain.from_iterable(casics_windows(repos, matches, batch_size)):
     # First try to find it with the repo id, because that's more invariant
     # than the name of the repo.
-    entry = repos.find_one({'_id': ghentry['id']})
     if entry:
         if entry['owner'] != owner or entry['name'] != name:
             # We have the id, but with a different owner/name.  We keep ours
@@ -100,7 +112,7 @@ for line in lines:
         update(entry, ghentry)
     else:
         # We didn't find the id.  Check if we have the owner/name.
-        entry = repos.find_one({'owner': owner, 'name': name})
+        entry = entry_by_path
         if entry:
             # We have different id's for the same owner/name path.  This can
             # happen if an owner renames a repository "A" to "B" but then
@@ -137,4 +149,6 @@ for line in lines:
         msg('{} [{:2f}]'.format(count, time() - start))
         start = time()
 
+writer.flush()
+msg('{} updates sent, {} modified'.format(writer.sent, writer.modified))
 msg('Done')
@@ -10,6 +10,7 @@ import time
 sys.path.append('../common')
 from casicsdb import *
 from utils import *
+from pipelines import *
 
 casicsdb = CasicsDB()
 github_db = casicsdb.open('github')
@@ -42,23 +43,13 @@ print('time elapsed: {}'.format(time() - start))
 #      fork.parent = None means it is not a fork, else the parent is named
 #      fork.root has a value only if it's a fork and we know the original source
 
-count = 0
 start = time()
-for entry in repos.find({'is_fork': True}):
-    if entry['fork_of']:
-        fork = entry['fork_of']
-    else:
-        fork = None
-    if entry['fork_root']:
-        root = entry['fork_root']
-    else:
-        root = None
-    repos.update({'_id': entry['_id']},
-                 {'$set': {'fork': {'parent': fork, 'root': root}}})
-    count += 1
-    if count % 1000 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
+fork_fields = Reshape({'is_fork': True},
+                      {'fork': {'parent': Either(Field('fork_of'), None),
+                                'root': Either(Field('fork_root'), None)}})
+modified, on_server = apply_reshape(repos, fork_fields)
+msg('{} modified {} [{:2f}]'.format(modified, 'on the server' if on_server else 'from here',
+                                     time() - start))
 
 start = time()
 msg(repos.update_many({'is_fork': False},
@@ -85,17 +76,14 @@ print('time elapsed: {}'.format(time() - start))
 #   time.repo_modified  ==> when the repo was last updated (if we know)
 #   time.data_refreshed ==> when we last touched this entry
 
-count = 0
 start = time()
-for entry in repos.find({}):
-    repos.update({'_id': entry['_id']},
-                 {'$set': {'time': {'repo_created': entry['created'],
-                                    'repo_modified': None,
-                                    'data_refreshed': entry['refreshed']}}})
-    count += 1
-    if count % 100 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
+time_fields = Reshape({},
+                      {'time': {'repo_created': Field('created'),
+                                'repo_modified': None,
+                                'data_refreshed': Field('refreshed')}})
+modified, on_server = apply_reshape(repos, time_fields)
+msg('{} modified {} [{:2f}]'.format(modified, 'on the server' if on_server else 'from here',
+                                     time() - start))
 
 start = time()
 msg(repos.update_many({}, {'$unset': {'created': 1}}))
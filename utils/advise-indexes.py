@@ -0,0 +1,41 @@
+#!/usr/bin/env python3.4
+#
+# @file    advise-indexes.py
+# @brief   Explain the recorded query shapes and suggest indexes.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Reads the query shapes recorded by record-workload.py, runs explain() on
+# an example of each, and prints them worst first: whether they scan the
+# whole collection, how many documents they examine per document returned,
+# and an index that would cover them, in the form used in
+# casicsdb/indexes.py.
+
+import sys
+import plac
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
+from casicsdb import *
+from workload import *
+
+
+def run(workload_file='workload.jsonl'):
+    shapes = load_shapes(workload_file)
+    msg('{} query shapes in {}'.format(len(shapes), workload_file))
+
+    casicsdb = CasicsDB()
+    advise(casicsdb.open, shapes, log=msg)
+
+run.__annotations__ = dict(
+    workload_file = ('file written by record-workload.py', 'positional'),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3.4
+#
+# @file    benchmark-id-map.py
+# @brief   Compare memory and speed of a dict id_map versus IdPathMap.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# The GHTorrent scripts used to build "id_map = {}" dicts from projects.csv.
+# This measures what that costs compared to the array-based IdPathMap in
+# ghtorrent.py, using either a real projects.csv file or synthetic data.
+# Memory is measured with tracemalloc, so it counts only Python allocations
+# made while building each structure; build times are measured separately.
+# Both structures are built from the same "id,path" lines so that each one
+# pays for creating its own strings, as it would when reading the CSV file.
+#
+# IdPathMap is slower to build than the dict: it converts every id to an
+# int and copies every path into its arena, which the dict doesn't do.
+# What it saves is memory, at its peak during the build as well as once
+# built, and the output says how the two compare on both counts.
+
+import sys
+import plac
+import os
+import gc
+import random
+import tracemalloc
+from itertools import islice
+from time import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
+from ghtorrent import *
+
+
+# Helpers
+# .............................................................................
+
+def synthetic_lines(count):
+    # Paths look roughly like real ones: a short owner and a longer name.
+    rand = random.Random(1)
+    letters = 'abcdefghijklmnopqrstuvwxyz0123456789-_'
+    for id in range(1, count + 1):
+        owner = ''.join(rand.choice(letters) for _ in range(rand.randint(4, 12)))
+        name  = ''.join(rand.choice(letters) for _ in range(rand.randint(4, 20)))
+        yield '{},{}/{}'.format(id, owner, name)
+
+
+def measure(label, build):
+    # Time the build without tracemalloc running, because tracing slows
+    # allocation down a lot, then build again to measure memory.
+    gc.collect()
+    start = time()
+    result = build()
+    elapsed = time() - start
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<10} build {:7.2f} s   retained {:10.1f} MB   peak {:10.1f} MB'.format(
+        label, elapsed, current/2**20, peak/2**20))
+    return (result, elapsed, peak)
+
+
+def time_lookups(label, mapping, keys):
+    start = time()
+    for key in keys:
+        mapping[key]
+    elapsed = time() - start
+    print('{:<10} {} lookups in {:.2f} s ({:.2f} us each)'.format(
+        label, len(keys), elapsed, 1e6*elapsed/len(keys)))
+
+
+# Main body.
+# .............................................................................
+
+def run(count=1000000, lookups=100000, csv_file=None):
+    if csv_file:
+        # Build the dict the way the scripts used to, straight from the CSV.
+        print('Reading {}'.format(csv_file))
+        build_dict = lambda: {row[0]: row_path(row) for row in projects_rows(csv_file)}
+        build_map  = lambda: load_id_map(csv_file)
+        keys = list(islice((id for id, _ in project_id_paths(csv_file)), lookups*10))
+    else:
+        print('Generating {} synthetic entries'.format(count))
+        lines = list(synthetic_lines(count))
+        build_dict = lambda: dict(line.split(',', 1) for line in lines)
+        build_map  = lambda: IdPathMap.from_pairs(line.split(',', 1) for line in lines)
+        keys = [line[:line.find(',')] for line in lines]
+
+    id_dict, dict_time, dict_peak = measure('dict', build_dict)
+    id_map, map_time, map_peak    = measure('IdPathMap', build_map)
+    print('IdPathMap arrays take {:.1f} MB'.format(id_map.nbytes()/2**20))
+    print('IdPathMap build is {:.1f}x {} than the dict, with {:.1f}x {} peak memory'.format(
+        max(map_time, dict_time)/max(1e-9, min(map_time, dict_time)),
+        'slower' if map_time > dict_time else 'faster',
+        max(map_peak, dict_peak)/max(1, min(map_peak, dict_peak)),
+        'more' if map_peak > dict_peak else 'less'))
+
+    keys = random.Random(2).sample(keys, min(lookups, len(keys)))
+    time_lookups('dict', id_dict, keys)
+    time_lookups('IdPathMap', id_map, keys)
+
+    # Make sure the two agree.
+    if len(id_dict) != len(id_map):
+        raise SystemExit('Sizes differ: {} vs {}'.format(len(id_dict), len(id_map)))
+    for key in keys:
+        if id_dict[key] != id_map[key]:
+            raise SystemExit('Mismatch for {}'.format(key))
+
+run.__annotations__ = dict(
+    count    = ('number of synthetic entries to generate', 'option', 'n', int),
+    lookups  = ('number of random lookups to time', 'option', 'l', int),
+    csv_file = ('use this projects.csv file instead of synthetic data', 'positional'),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3.5
+#
+# @file    benchmark-visibility.py
+# @brief   Compare the old URL check with VisibilityChecker on a stub server.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Starts a stub HTTP server on localhost that answers HEAD requests after a
+# delay (-d, in ms, standing in for the round trip to GitHub), with 200 for
+# even-numbered repositories and 404 for odd ones.  It then checks the same
+# synthetic repositories the old way (a new connection and one request at
+# a time, as github_url_exists() does) and with VisibilityChecker, and
+# reports the time each took, the number of connections each opened, and
+# whether the answers agree.  The old way is only run on the first -s
+# repositories, since it is so slow.
+
+import sys
+import plac
+import os
+import http.client
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import sleep, time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
+from visibility import VisibilityChecker, is_visible
+
+
+# Stub server.
+# .............................................................................
+
+class StubServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads      = True
+    request_queue_size  = 1024
+    allow_reuse_address = True
+    delay               = 0
+    connections         = 0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_HEAD(self):
+        sleep(self.server.delay)
+        number = int(self.path.rsplit('-', 1)[-1])
+        self.send_response(200 if number % 2 == 0 else 404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(delay):
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    server.delay = delay
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+# The two ways of checking.
+# .............................................................................
+
+def old_way(port, paths):
+    # What github_url_exists() does, minus the retry.
+    results = {}
+    for path in paths:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=15)
+        conn.request('HEAD', path)
+        results[path] = conn.getresponse().status < 400
+        conn.close()
+    return results
+
+
+def new_way(port, paths, concurrency, rate):
+    results = {}
+
+    def record(path, status):
+        results[path] = None if status is None else is_visible(status)
+
+    checker = VisibilityChecker(concurrency, rate=rate or None)
+    checker.check_all(((path, 'http://127.0.0.1:{}{}'.format(port, path)) for path in paths),
+                      record)
+    return (results, checker.stats())
+
+
+# Main body.
+# .............................................................................
+
+def run(count=5000, sequential=500, delay=20, concurrency=50, rate=0):
+    server = start_server(delay/1000.0)
+    port = server.server_address[1]
+    paths = ['/owner{}/repo-{}'.format(i % 97, i) for i in range(count)]
+    print('Stub server on port {} answering after {} ms'.format(port, delay))
+
+    server.connections = 0
+    start = time()
+    old = old_way(port, paths[:sequential])
+    elapsed = time() - start
+    print('{:<20} {:6} urls in {:7.2f} s  {:8.0f}/s  {:6} connections'.format(
+        'one at a time', len(old), elapsed, len(old)/elapsed, server.connections))
+
+    server.connections = 0
+    start = time()
+    new, stats = new_way(port, paths, concurrency, rate)
+    elapsed = time() - start
+    print('{:<20} {:6} urls in {:7.2f} s  {:8.0f}/s  {:6} connections'.format(
+        'VisibilityChecker', len(new), elapsed, len(new)/elapsed, server.connections))
+
+    expected = {path: int(path.rsplit('-', 1)[-1]) % 2 == 0 for path in paths}
+    wrong = [path for path in paths if new.get(path) != expected[path]]
+    disagree = [path for path in old if old[path] != new.get(path)]
+    print('{} failed, {} wrong, {} disagreeing with the old way; checker stats {}'.format(
+        stats['failures'], len(wrong), len(disagree), stats))
+    server.shutdown()
+    if wrong or disagree:
+        raise SystemExit(1)
+
+run.__annotations__ = dict(
+    count       = ('number of urls to check with VisibilityChecker', 'option', 'n', int),
+    sequential  = ('number of urls to check the old way', 'option', 's', int),
+    delay       = ('stub server response delay in ms', 'option', 'd', int),
+    concurrency = ('requests in flight at once for VisibilityChecker', 'option', 'c', int),
+    rate        = ('most requests per second for VisibilityChecker (default: no limit)', 'option', 'r', float),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3.4
+#
+# @file    build-ghtorrent-id-index.py
+# @brief   Build the GHTorrent project id -> owner/name index file.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# The scripts that read GHTorrent's projects.csv need a mapping from
+# GHTorrent's project id numbers to owner/name paths.  This builds it once
+# and writes it to an index file (by default, projects.csv.idx next to the
+# CSV file) that the scripts memory-map instead of reparsing the CSV file.
+# The scripts will also build the index themselves if it's missing or older
+# than the CSV file, so running this ahead of time is optional.
+
+import sys
+import plac
+import os
+from time import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
+from casicsdb import *
+from ghtorrent import *
+
+
+def run(index_file=None, csv_file=None):
+    if not csv_file:
+        raise SystemExit('Need the path to a GHTorrent projects.csv file.')
+    if not index_file:
+        index_file = default_index_file(csv_file)
+
+    msg('Building {} from {}'.format(index_file, csv_file))
+    start = time()
+    count = build_id_index(csv_file, index_file)
+    msg('{} ids written in {:.1f} s ({} bytes)'.format(
+        count, time() - start, os.path.getsize(index_file)))
+
+    start = time()
+    with IdPathIndex(index_file) as index:
+        msg('Index opens in {:.3f} s'.format(time() - start))
+
+run.__annotations__ = dict(
+    index_file = ('write the index to this file', 'option', 'o'),
+    csv_file   = ('path to GHTorrent projects.csv file', 'positional'),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3.4
+#
+# @file    build-identity-snapshot.py
+# @brief   Write or refresh the repository id <-> owner/name snapshot file.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Exports the _id, owner and name of every repository in the database to a
+# snapshot file that bulk jobs can memory-map to resolve repositories
+# without asking the database (see snapshot.py).  With -r, only the entries
+# refreshed since the snapshot was written are fetched and merged into it.
+# To make jobs use the snapshot, set CASICS_SNAPSHOT to the file's path.
+
+import sys
+import plac
+import os
+from time import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
+from casicsdb import *
+from snapshot import *
+
+
+def run(refresh=False, snapshot_file=None):
+    if not snapshot_file:
+        snapshot_file = os.environ.get(snapshot_variable)
+    if not snapshot_file:
+        raise SystemExit('Need the path of the snapshot file or {} to be set.'
+                         .format(snapshot_variable))
+
+    msg('Opening remote CASICS database ...')
+
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
+
+    start = time()
+    if refresh and os.path.exists(snapshot_file):
+        msg('Refreshing {}'.format(snapshot_file))
+        count = refresh_snapshot(repos, snapshot_file)
+        msg('{} entries refreshed in {:.1f} s'.format(count, time() - start))
+    else:
+        msg('Exporting to {}'.format(snapshot_file))
+        count = export_snapshot(repos, snapshot_file)
+        msg('{} entries written in {:.1f} s'.format(count, time() - start))
+
+    with IdentitySnapshot(snapshot_file) as snapshot:
+        msg('{} entries, {} bytes, refreshed up to {}'.format(
+            len(snapshot), os.path.getsize(snapshot_file), snapshot.refreshed))
+
+run.__annotations__ = dict(
+    refresh       = ('only fetch entries refreshed since the last snapshot', 'flag', 'r'),
+    snapshot_file = ('path of the snapshot file (default: $CASICS_SNAPSHOT)', 'positional'),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3.4
+#
+# @file    bulkwriter.py
+# @brief   Helpers for batching reads and writes against the CASICS database.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Most of our utilities do one find_one() and one update_one() per input
+# item.  With tens of millions of items, the network round trips dominate
+# the run time.  The classes here let a script gather its work into windows,
+# look up a whole window with one query, and send the resulting updates to
+# the server with an unordered bulk_write().
+#
+# The server they write to also answers interactive users, and a bulk
+# utility left to itself will write as fast as the server accepts writes.
+# A WriteThrottle given to BulkUpdater watches how long the server takes to
+# answer reads and paces the writes to keep that near a target, backing
+# off by half when reads get slow and speeding up a step at a time when
+# they're fast again.
+
+from itertools import islice
+from time import sleep, time
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+
+# Helpers
+# .............................................................................
+
+def windows(iterable, size):
+    '''Yield successive lists of at most 'size' items from 'iterable'.'''
+    iterator = iter(iterable)
+    while True:
+        window = list(islice(iterator, size))
+        if not window:
+            return
+        yield window
+
+
+def find_by_paths(collection, paths, fields=None):
+    '''Look up a list of (owner, name) tuples using a single query.
+    Returns a dict mapping (owner, name) to the database entry.'''
+    if not paths:
+        return {}
+    query = {'$or': [{'owner': owner, 'name': name} for owner, name in paths]}
+    if fields is not None:
+        fields = dict(fields, owner=1, name=1)
+    return {(e['owner'], e['name']): e for e in collection.find(query, fields)}
+
+
+def find_by_ids(collection, ids, fields=None):
+    '''Look up a list of repository identifiers using a single query.
+    Returns a dict mapping the identifier to the database entry.'''
+    if not ids:
+        return {}
+    return {e['_id']: e for e in collection.find({'_id': {'$in': list(ids)}},
+                                                 fields)}
+
+
+# Rate reporting
+# .............................................................................
+
+class RateMeter():
+    '''Keeps a running count of items and reports items per second.'''
+
+    def __init__(self):
+        self.count = 0
+        self.start = time()
+        self._last_count = 0
+        self._last_time = self.start
+
+    def add(self, n=1):
+        self.count += n
+
+    def rate(self):
+        '''Items/sec since the last call to rate().'''
+        now = time()
+        elapsed = now - self._last_time
+        done = self.count - self._last_count
+        self._last_time = now
+        self._last_count = self.count
+        return done/elapsed if elapsed > 0 else 0.0
+
+    def overall_rate(self):
+        elapsed = time() - self.start
+        return self.count/elapsed if elapsed > 0 else 0.0
+
+
+# Write throttling
+# .............................................................................
+
+class WriteThrottle():
+    '''Paces writes to hold the server's read latency near 'target_ms'.
+
+    Every 'interval' seconds, the average latency of the reads the server
+    has done since the last sample is taken from the opLatencies section of
+    serverStatus.  If we aren't allowed to run serverStatus, the time of a
+    small find_one() on 'collection' is used instead.  When the latency is
+    over the target, the write rate (operations per second) and the batch
+    size are halved; when it's under 80% of the target, the rate goes up by
+    'step' and the batch size by a tenth, up to the limits.  Each change is
+    passed to 'log', and metrics() returns the current state.
+    '''
+
+    def __init__(self, collection, target_ms=50, rate=2000, min_rate=50,
+                 max_rate=50000, step=None, batch_size=1000, min_batch=50,
+                 interval=5, log=None):
+        self.collection = collection
+        self.target_ms  = target_ms
+        self.rate       = rate
+        self.min_rate   = min_rate
+        self.max_rate   = max_rate
+        self.step       = step or max(1, rate//10)
+        self.batch_size = batch_size
+        self.max_batch  = batch_size
+        self.min_batch  = min(min_batch, batch_size)
+        self.interval   = interval
+        self.log        = log or (lambda text: None)
+        self.latency_ms = None
+        self.source     = 'serverStatus'
+        self.samples    = 0
+        self.increases  = 0
+        self.decreases  = 0
+        self.slept      = 0.0
+        self.written    = 0
+        self._next      = time()
+        self._last      = None
+        self._sampled   = 0
+
+    def _read_totals(self):
+        status = self.collection.database.command('serverStatus')
+        reads = status['opLatencies']['reads']
+        return (reads['latency'], reads['ops'])
+
+    def sample(self):
+        '''Return the read latency in ms since the last sample, or None if
+        there have been no reads to measure.'''
+        if self.source == 'serverStatus':
+            try:
+                totals = self._read_totals()
+            except (OperationFailure, KeyError):
+                self.source = 'find_one'
+                self.log('Write throttle: no serverStatus; timing reads instead')
+            else:
+                last, self._last = self._last, totals
+                if last is None or totals[1] <= last[1]:
+                    return None
+                return (totals[0] - last[0])/(totals[1] - last[1])/1000.0
+        start = time()
+        self.collection.find_one({}, {'_id': 1})
+        return (time() - start)*1000.0
+
+    def _adjust(self):
+        latency = self.sample()
+        self.samples += 1
+        if latency is None:
+            return
+        self.latency_ms = latency
+        if latency > self.target_ms:
+            rate = max(self.min_rate, self.rate//2)
+            batch_size = max(self.min_batch, self.batch_size//2)
+            if (rate, batch_size) != (self.rate, self.batch_size):
+                self.decreases += 1
+                self.log('Write throttle: reads at {:.1f} ms, slowing to {} ops/s in batches of {}'
+                         .format(latency, rate, batch_size))
+        elif latency < 0.8*self.target_ms:
+            rate = min(self.max_rate, self.rate + self.step)
+            batch_size = min(self.max_batch, self.batch_size + max(1, self.max_batch//10))
+            if (rate, batch_size) != (self.rate, self.batch_size):
+                self.increases += 1
+                self.log('Write throttle: reads at {:.1f} ms, speeding up to {} ops/s in batches of {}'
+                         .format(latency, rate, batch_size))
+        else:
+            return
+        self.rate, self.batch_size = rate, batch_size
+
+    def wait(self, count):
+        '''Called before writing 'count' operations; sleeps as long as
+        needed to keep to the current rate.'''
+        now = time()
+        if now - self._sampled >= self.interval:
+            self._sampled = now
+            self._adjust()
+        if self._next > now:
+            sleep(self._next - now)
+            self.slept += self._next - now
+        self._next = max(now, self._next) + count/self.rate
+        self.written += count
+
+    def metrics(self):
+        return {'target_ms' : self.target_ms,
+                'latency_ms': self.latency_ms,
+                'source'    : self.source,
+                'rate'      : self.rate,
+                'batch_size': self.batch_size,
+                'samples'   : self.samples,
+                'increases' : self.increases,
+                'decreases' : self.decreases,
+                'slept'     : self.slept,
+                'written'   : self.written}
+
+
+# Bulk writes
+# .............................................................................
+
+class BulkUpdater():
+    '''Accumulates update operations and sends them with bulk_write().
+
+    Operations are queued with set() or add() and sent automatically once
+    'batch_size' of them have accumulated.  Call flush() at the end to send
+    whatever is left.  Writes are unordered by default, which lets the
+    server apply them in parallel; all the updates we generate are
+    independent of each other, so ordering buys us nothing.  If a
+    WriteThrottle is given, it sets the pace of the writes, and may make
+    the batches smaller than 'batch_size'.
+    '''
+
+    def __init__(self, collection, batch_size=1000, ordered=False, throttle=None):
+        self.collection = collection
+        self.batch_size = max(1, batch_size)
+        self.ordered    = ordered
+        self.throttle   = throttle
+        self.pending    = []
+        self.sent       = 0
+        self.modified   = 0
+        self.batches    = 0
+        self.errors     = 0
+
+    def set(self, id, updates):
+        self.add(UpdateOne({'_id': id}, {'$set': updates}, upsert=False))
+
+    def add(self, op):
+        self.pending.append(op)
+        limit = self.batch_size
+        if self.throttle:
+            limit = min(limit, self.throttle.batch_size)
+        if len(self.pending) >= limit:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        ops = self.pending
+        self.pending = []
+        if self.throttle:
+            self.throttle.wait(len(ops))
+        try:
+            result = self.collection.bulk_write(ops, ordered=self.ordered)
+            self.modified += result.modified_count
+        except BulkWriteError as err:
+            # With unordered writes the rest of the batch still gets applied,
+            # so record the failures and keep going.
+            self.modified += err.details.get('nModified', 0)
+            self.errors += len(err.details.get('writeErrors', []))
+        self.sent += len(ops)
+        self.batches += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
@@ -10,6 +10,7 @@ import time
 sys.path.append('../common')
 from casicsdb import *
 from utils import *
+from pipelines import *
 
 casicsdb = CasicsDB()
 github_db = casicsdb.open('github')
@@ -20,15 +21,15 @@ repos = github_db.repos
 # time.repo_modified is now time.repo_updated
 # we have a new field time.repo_pushed
 
-count = 0
+# This only moves values around, so it's done on the server with a pipeline
+# update if it can be (see pipelines.py).
+
 start = time()
-for entry in repos.find({}):
-    repos.update({'_id': entry['_id']},
-                 {'$set': {'time': {'repo_created': entry['time']['repo_created'],
-                                    'repo_updated': None,
-                                    'repo_pushed': None,
-                                    'data_refreshed': entry['time']['data_refreshed']}}})
-    count += 1
-    if count % 1000 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
+time_fields = Reshape({},
+                      {'time': {'repo_created': Field('time.repo_created'),
+                                'repo_updated': None,
+                                'repo_pushed': None,
+                                'data_refreshed': Field('time.data_refreshed')}})
+modified, on_server = apply_reshape(repos, time_fields)
+msg('{} modified {} [{:2f}]'.format(modified, 'on the server' if on_server else 'from here',
+                                     time() - start))
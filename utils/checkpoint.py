@@ -0,0 +1,125 @@
+#!/usr/bin/env python3.4
+#
+# @file    checkpoint.py
+# @brief   Save the progress of long scans and file ingests, to resume them.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Some of our utilities run for a day or more over a whole collection or a
+# whole GHTorrent CSV file, and when one of them crashed or its cursor timed
+# out, the only choice was to start it again from the beginning.
+#
+# A Checkpoint keeps the position a utility has reached (the last _id it
+# finished with, or a byte offset in a file) together with whatever counts
+# it is keeping, and writes them to a file every so often.  When the utility
+# is run again with --resume, it loads the file and starts after that
+# position, with its counts where they were.  The position is only saved
+# once the work before it is done (and, for utilities that write in bulk,
+# flushed), so resuming may redo a little work but never skips any; the
+# utilities using this must therefore be safe to run twice on an entry.
+#
+# scan() is the collection side of this: it walks a collection in _id
+# order from the checkpoint on, and if the server drops the cursor, it
+# opens a new one after the last _id it handed out.
+
+import os
+import pickle
+from time import time
+
+from pymongo import ASCENDING
+from pymongo.errors import CursorNotFound
+
+
+# Checkpoints.
+# .............................................................................
+
+class Checkpoint():
+    '''Progress of a long-running job, saved to 'file' at most every
+    'interval' seconds.  If 'resume' is true and the file exists, the
+    position and counts saved in it are loaded; otherwise the job starts
+    from the beginning.  'position' is None at the beginning; 'counts' is
+    a dict the job may keep any totals in.'''
+
+    def __init__(self, file, resume=False, interval=60):
+        self.file     = file
+        self.interval = interval
+        self.position = None
+        self.counts   = {}
+        self.resumed  = False
+        self._saved   = time()
+        if resume and os.path.exists(file):
+            with open(file, 'rb') as f:
+                state = pickle.load(f)
+            self.position = state['position']
+            self.counts   = state['counts']
+            self.resumed  = True
+
+    def count(self, name, n=1):
+        '''Add 'n' to the count called 'name'.'''
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def advance(self, position):
+        '''Record that everything up to and including 'position' is done,
+        saving the checkpoint if it's been long enough since the last time.'''
+        self.position = position
+        self.tick()
+
+    def tick(self):
+        '''Save the checkpoint if it's been long enough since the last time.'''
+        if time() - self._saved >= self.interval:
+            self.save()
+
+    def save(self):
+        # Written to a temporary file and renamed, so that a crash while
+        # saving leaves the previous checkpoint in place.
+        temp = self.file + '.tmp'
+        with open(temp, 'wb') as f:
+            pickle.dump({'position': self.position, 'counts': self.counts}, f)
+        os.replace(temp, self.file)
+        self._saved = time()
+
+    def finish(self):
+        '''Remove the checkpoint file once the job is complete.'''
+        if os.path.exists(self.file):
+            os.remove(self.file)
+
+
+def default_checkpoint_file(script):
+    '''The checkpoint file for the utility 'script' (a path, such as
+    __file__), in the current directory.'''
+    return os.path.splitext(os.path.basename(script))[0] + '.checkpoint'
+
+
+# Scanning collections.
+# .............................................................................
+
+def scan(collection, query=None, fields=None, checkpoint=None, **kwargs):
+    '''Yield the entries of 'collection' matching 'query' in _id order,
+    starting after checkpoint.position if there is one.  Each entry counts
+    as done, and the checkpoint advances to it, when the next one is asked
+    for.  If the cursor is lost, the scan continues with a new one.  Other
+    keyword arguments are passed to find().'''
+    query = query or {}
+    last = checkpoint.position if checkpoint else None
+    while True:
+        if last is None:
+            bounded = query
+        elif query:
+            bounded = {'$and': [query, {'_id': {'$gt': last}}]}
+        else:
+            bounded = {'_id': {'$gt': last}}
+        try:
+            for entry in collection.find(bounded, fields, sort=[('_id', ASCENDING)],
+                                         **kwargs):
+                yield entry
+                last = entry['_id']
+                if checkpoint:
+                    checkpoint.advance(last)
+            return
+        except CursorNotFound:
+            continue
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3.4
 
 import os
+import plac
 import sys
 import zlib
 
@@ -10,21 +11,40 @@ sys.path.append('../common')
 
 from database import *
 from lang import *
+from rangescan import parallel_scan
 
-casicsdb  = CasicsDB()
-github_db = casicsdb.open('github')
-repos     = github_db.repos
-
-for entry in repos.find():
-    if entry['language']:
-        current = entry['language']
-        from_codes = Lang.convert(current['codes'])
-        langlist = (from_codes or []) + (current['others'] or [])
-        if langlist:
-            langlist = [{'name' : x} for x in sorted(langlist)]
-        else:
-            langlist = []
-        status = repos.update_one( {'_id' : entry['_id'] },
-                                   {'$set' : { 'languages' : langlist } } )
-
-        msg('{}: {}'.format(entry['_id'], status.modified_count))
+# Converts the old language field into the languages list.  The entries are
+# scanned in ranges of _id by several processes at once (-p, default one
+# per core).
+
+def open_repos():
+    casicsdb  = CasicsDB()
+    github_db = casicsdb.open('github')
+    return github_db.repos
+
+
+def convert_language(entry):
+    if not entry['language']:
+        return None
+    current = entry['language']
+    from_codes = Lang.convert(current['codes'])
+    langlist = (from_codes or []) + (current['others'] or [])
+    if langlist:
+        langlist = [{'name' : x} for x in sorted(langlist)]
+    else:
+        langlist = []
+    return {'languages': langlist}
+
+
+def run(processes=0):
+    scanned, modified, errors = parallel_scan(open_repos, convert_language,
+                                              fields={'language': 1},
+                                              processes=processes or None, log=msg)
+    msg('{} scanned, {} modified, {} errors'.format(scanned, modified, errors))
+
+run.__annotations__ = dict(
+    processes = ('number of processes to use (default: one per core)', 'option', 'p', int),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3.4
 
 import os
+import plac
 import sys
 import zlib
 
@@ -10,18 +11,37 @@ sys.path.append('../common')
 
 from database import *
 from lang import *
+from rangescan import parallel_scan
 
-casicsdb  = CasicsDB()
-github_db = casicsdb.open('github')
-repos     = github_db.repos
+# Decompresses the readme field of every entry.  The entries are scanned in
+# ranges of _id by several processes at once (-p, default one per core).
 
-for entry in repos.find():
+def open_repos():
+    casicsdb  = CasicsDB()
+    github_db = casicsdb.open('github')
+    return github_db.repos
+
+
+def decompress_readme(entry):
     if entry['readme']:
         try:
             raw = zlib.decompress(entry['readme'])
             if raw:
-                status = repos.update_one( {'_id' : entry['_id'] },
-                                           {'$set' : { 'readme' : raw } } )
-                msg('{}: {}'.format(entry['_id'], status.modified_count))
+                return {'readme': raw}
         except:
             msg('failed on {}'.format(entry['_id']))
+    return None
+
+
+def run(processes=0):
+    scanned, modified, errors = parallel_scan(open_repos, decompress_readme,
+                                              fields={'readme': 1},
+                                              processes=processes or None, log=msg)
+    msg('{} scanned, {} modified, {} errors'.format(scanned, modified, errors))
+
+run.__annotations__ = dict(
+    processes = ('number of processes to use (default: one per core)', 'option', 'p', int),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
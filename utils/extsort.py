@@ -0,0 +1,103 @@
+#!/usr/bin/env python3.4
+#
+# @file    extsort.py
+# @brief   External sorting and merge joins with bounded memory.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# The GHTorrent dumps are too big to hold in memory as dicts, but most of
+# what we do with them is match up records by id.  The functions here sort
+# a stream of records using a fixed amount of memory, spilling sorted runs
+# to temporary files when needed, and then join sorted streams by key in a
+# single pass.  Records are tuples whose first element is the sort key.
+
+import heapq
+import pickle
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+
+# Globals.
+# .............................................................................
+
+# Records are pickled to the run files in blocks of this many.
+
+_BLOCK_SIZE = 10000
+
+
+# Sorting.
+# .............................................................................
+
+def _spill(run, tmp_dir):
+    f = tempfile.TemporaryFile(dir=tmp_dir)
+    for start in range(0, len(run), _BLOCK_SIZE):
+        pickle.dump(run[start:start + _BLOCK_SIZE], f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+
+def _read_run(f):
+    while True:
+        try:
+            block = pickle.load(f)
+        except EOFError:
+            return
+        yield from block
+
+
+def external_sort(records, run_size=1000000, tmp_dir=None):
+    '''Yield 'records' in sorted order, holding at most 'run_size' of them
+    in memory at a time.  If there are more than that, sorted runs are
+    written to temporary files in 'tmp_dir' and merged at the end.'''
+    files = []
+    run = []
+    try:
+        for record in records:
+            run.append(record)
+            if len(run) >= run_size:
+                run.sort()
+                files.append(_spill(run, tmp_dir))
+                run = []
+        run.sort()
+        if not files:
+            yield from run
+            return
+        files.append(_spill(run, tmp_dir))
+        run = []
+        yield from heapq.merge(*[_read_run(f) for f in files])
+    finally:
+        for f in files:
+            f.close()
+
+
+# Joining.
+# .............................................................................
+
+def grouped(records):
+    '''Group sorted records by key, yielding (key, [values]) tuples, where
+    the values are the second elements of the records.'''
+    for key, group in groupby(records, key=itemgetter(0)):
+        yield (key, [record[1] for record in group])
+
+
+def merge_join(left, right, unmatched=None):
+    '''Inner join of two streams of (key, values) groups that are both
+    sorted by key and have unique keys.  Yields (key, left_values,
+    right_values) for every key that appears in both.  If 'unmatched' is
+    given, it is called as unmatched(key, values) for each group in 'left'
+    that has no counterpart in 'right'.'''
+    right = iter(right)
+    r = next(right, None)
+    for l_key, l_values in left:
+        while r is not None and r[0] < l_key:
+            r = next(right, None)
+        if r is not None and r[0] == l_key:
+            yield (l_key, l_values, r[1])
+        elif unmatched:
+            unmatched(l_key, l_values)
@@ -12,6 +12,7 @@ sys.path.append('../../common')
 
 from casicsdb import *
 from utils import *
+from idquery import *
 
 casicsdb  = CasicsDB()
 github_db = casicsdb.open('github')
@@ -21,9 +22,5 @@ list_file = sys.argv[1]
 
 msg('Visible repos from list in {}'.format(list_file))
 
-with open(list_file, 'r') as f:
-    for id in f.readlines():
-        id = int(id.strip())
-        entry = repos.find_one({'_id': id, 'is_visible': True}, {'visibility': 1})
-        if entry:
-            msg(id)
+for id, entry in query_ids(repos, read_ids(list_file), {'is_visible': True}, {'_id': 1}):
+    msg(id)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3.4
 
 import os
+import plac
 import re
 import sys
 import zlib
@@ -12,20 +13,42 @@ sys.path.append('../../common')
 
 from casicsdb import *
 from utils import *
+from search import search
 
-casicsdb  = CasicsDB()
-github_db = casicsdb.open('github')
-repos     = github_db.repos
+# Searches the description field (or the readme, with -f readme) using the
+# text index, a page at a time (-p, -n; -n 0 prints every match).  Terms
+# that aren't plain words, or any term with -r, are searched with a regular
+# expression instead, which reads the whole collection.
 
-term = sys.argv[1]
+def run(field='description', page=1, page_size=0, regex=False, term=None):
+    if not term:
+        raise SystemExit('Need a term to search for.')
 
-msg('Searching repos for "{}" in the description field'.format(term))
+    casicsdb  = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos     = github_db.repos
 
-regex = re.compile(term, re.IGNORECASE)
-for entry in repos.find({'description': {'$regex': regex}},
-                        {'description': 1, 'owner': 1, 'name': 1}):
-    msg('-'*70)
-    msg(e_summary(entry))
-    msg(entry['description'])
+    msg('Searching repos for "{}" in the {} field'.format(term, field))
+
+    result = search(repos, term, field, {field: 1, 'owner': 1, 'name': 1},
+                    page, page_size, regex)
+    for entry in result.entries:
+        msg('-'*70)
+        msg(e_summary(entry))
+        msg(entry[field])
 
-msg('-'*70)
\ No newline at end of file
+    msg('-'*70)
+    msg('{} found by {} search{} in {:.2f} s'.format(
+        len(result.entries), result.path,
+        ' ({})'.format(result.reason) if result.reason else '', result.seconds))
+
+run.__annotations__ = dict(
+    field     = ('field to search: description or readme', 'option', 'f'),
+    page      = ('page of results to print, starting at 1', 'option', 'p', int),
+    page_size = ('results per page (default: all)', 'option', 'n', int),
+    regex     = ('search with a regular expression, not the text index', 'flag', 'r'),
+    term      = ('word, words or regular expression to search for', 'positional'),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
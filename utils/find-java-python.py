@@ -12,6 +12,7 @@ sys.path.append('../common')
 sys.path.append('../../common')
 from casicsdb import *
 from utils import *
+from idquery import *
 
 casicsdb = CasicsDB()
 github_db = casicsdb.open('github')
@@ -32,16 +33,17 @@ repos = github_db.repos
 #             msg(entry['_id'])
 #             count += 1
 
+# Also too slow, one find_one() per id, so the ids are now looked up a
+# chunk at a time.
+
 count = 0
-with open('four-million-project-ids.txt', encoding="utf-8") as f:
-    for line in f:
-        id = int(line.strip())
-        entry = repos.find_one({'_id': id, 'files': {'$ne': -1}, 'is_visible': True},
-                               {'languages': 1})
-        if entry and entry['languages'] != -1:
-            langs = [x['name'] for x in entry['languages']]
-            if 'Java' in langs or 'Python' in langs:
-                msg(id)
-                count += 1
+ids = read_ids('four-million-project-ids.txt')
+query = {'files': {'$ne': -1}, 'is_visible': True}
+for id, entry in query_ids(repos, ids, query, {'languages': 1}):
+    if entry['languages'] != -1:
+        langs = [x['name'] for x in entry['languages']]
+        if 'Java' in langs or 'Python' in langs:
+            msg(id)
+            count += 1
 
 msg('{} total'.format(count))
@@ -10,6 +10,7 @@ sys.path.append('../common')
 sys.path.append('../../common')
 from casicsdb import *
 from utils import *
+from idquery import *
 
 casicsdb = CasicsDB()
 github_db = casicsdb.open('github')
@@ -18,17 +19,13 @@ repos = github_db.repos
 def run(file=None, lang=None):
     count = 0
     msg('-'*70)
-    with open(file, encoding="utf-8") as f:
-        for line in f:
-            id = int(line.strip())
-            entry = repos.find_one({'_id': id,
-                                    'files': {'$ne': -1},
-                                    'is_visible': True},
-                                   {'languages': 1, 'owner': 1, 'name': 1})
-            if entry and entry['languages'] != -1:
-                if lang in [x['name'] for x in entry['languages']]:
-                    msg('{:<8d}  {}/{}'.format(id, entry['owner'], entry['name']))
-                    count += 1
+    query = {'files': {'$ne': -1}, 'is_visible': True}
+    fields = {'languages': 1, 'owner': 1, 'name': 1}
+    for id, entry in query_ids(repos, read_ids(file), query, fields):
+        if entry['languages'] != -1:
+            if lang in [x['name'] for x in entry['languages']]:
+                msg('{:<8d}  {}/{}'.format(id, entry['owner'], entry['name']))
+                count += 1
     msg('-'*70)
     msg('{} total'.format(count))
 
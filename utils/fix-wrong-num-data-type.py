@@ -3,6 +3,7 @@
 import bson
 import json
 import os
+import plac
 import pprint
 import sys
 import time
@@ -11,41 +12,40 @@ sys.path.append('../')
 sys.path.append('../common')
 from casicsdb import *
 from utils import *
+from bulkwriter import BulkUpdater, WriteThrottle
 
-casicsdb = CasicsDB()
-github_db = casicsdb.open('github')
-repos = github_db.repos
-
-count = 0
-start = time()
-for entry in repos.find({ 'num_commits' : { '$type' : 2 } }, {'num_commits': 1, '_id': 1}):
-    repos.update_one({'_id': entry['_id']},
-                     {'$set': {'num_commits': int(entry['num_commits'].replace(',', ''))}})
-    count += 1
-    if count % 1000 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
-
-for entry in repos.find({ 'num_branches' : { '$type' : 2 } }, {'num_branches': 1, '_id': 1}):
-    repos.update_one({'_id': entry['_id']},
-                     {'$set': {'num_branches': int(entry['num_branches'].replace(',', ''))}})
-    count += 1
-    if count % 1000 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
-
-for entry in repos.find({ 'num_contributors' : { '$type' : 2 } }, {'num_contributors': 1, '_id': 1}):
-    repos.update_one({'_id': entry['_id']},
-                     {'$set': {'num_contributors': int(entry['num_contributors'].replace(',', ''))}})
-    count += 1
-    if count % 1000 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
-
-for entry in repos.find({ 'num_releases' : { '$type' : 2 } }, {'num_releases': 1, '_id': 1}):
-    repos.update_one({'_id': entry['_id']},
-                     {'$set': {'num_releases': int(entry['num_releases'].replace(',', ''))}})
-    count += 1
-    if count % 1000 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
+# Converts num_* fields stored as strings like "1,234" into numbers.  The
+# updates are sent in bulk; with -t, they are slowed down whenever the
+# server's reads take longer than the given number of milliseconds.
+
+num_fields = ['num_commits', 'num_branches', 'num_contributors', 'num_releases']
+
+
+def run(batch=1000, throttle=0):
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
+
+    pacer = WriteThrottle(repos, throttle, batch_size=batch, log=msg) if throttle else None
+    count = 0
+    start = time()
+    with BulkUpdater(repos, batch_size=batch, throttle=pacer) as writer:
+        for field in num_fields:
+            for entry in repos.find({ field : { '$type' : 2 } }, {field: 1, '_id': 1}):
+                writer.set(entry['_id'], {field: int(entry[field].replace(',', ''))})
+                count += 1
+                if count % 1000 == 0:
+                    msg('{} [{:2f}]'.format(count, time() - start))
+                    start = time()
+    msg('{} updates sent, {} modified, {} errors'.format(writer.sent, writer.modified,
+                                                         writer.errors))
+    if pacer:
+        msg('Write throttle: {}'.format(pacer.metrics()))
+
+run.__annotations__ = dict(
+    batch    = ('number of updates per bulk write', 'option', 'b', int),
+    throttle = ('pace writes to keep server read latency near this many ms', 'option', 't', float),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
@@ -0,0 +1,611 @@
+#!/usr/bin/env python3.4
+#
+# @file    ghtorrent.py
+# @brief   Shared code for reading GHTorrent CSV dumps.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Shared code for the utilities that read GHTorrent's CSV dumps and its
+# MongoDB dump.  Besides plain and parallel readers for the CSV files, this
+# provides the id index described below and helpers for matching lists of
+# repositories against a local copy of the MongoDB dump.
+#
+# Several of our utilities need to translate GHTorrent's project id numbers
+# (the first column of projects.csv) to GitHub owner/name paths.  Parsing
+# projects.csv to build a dict for this takes a long time and a lot of
+# memory, so we build a persistent index file once and memory-map it on
+# later runs.
+#
+# Index file layout (all integers in native byte order):
+#
+#   header   32 bytes: magic, byte order check, count, arena size
+#   ids      count signed 64-bit ints, sorted ascending
+#   offsets  count + 1 unsigned 64-bit ints, offsets of paths in the arena
+#   arena    UTF-8 encoded owner/name paths, concatenated
+#
+# Lookups do a binary search over the ids, so they are O(log n) and touch
+# only a few pages of the file.
+
+import csv
+import io
+import mmap
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left
+from collections import deque
+from itertools import accumulate, chain, islice
+from operator import itemgetter, lt
+from multiprocessing import Pool
+from queue import Queue
+
+from pymongo import ASCENDING
+
+from bulkwriter import windows
+from extsort import external_sort
+from resolver import ALL_FIELDS, BY_ID, BY_PATH, RepoResolver
+
+
+# Globals.
+# .............................................................................
+
+# Column positions in GHTorrent's projects.csv.  The "id" is GHTorrent's own
+# identifier for the project, not GitHub's repository id.
+
+project_fields = {'id'          : 0,
+                  'url'         : 1,
+                  'owner'       : 2,
+                  'name'        : 3,
+                  'description' : 4,
+                  'language'    : 5,
+                  'created'     : 6,
+                  'forked_from' : 7,
+                  'deleted'     : 8,
+                  'updated'     : 9}
+
+namestart = len('https://api.github.com/repos/')
+
+_INDEX_MAGIC  = b'GHTIDX01'
+_BYTE_ORDER   = 0x0102030405060708
+_HEADER       = struct.Struct('=8sQQQ')
+_ITEM_SIZE    = 8
+
+
+# Reading projects.csv.
+# .............................................................................
+
+def projects_rows(csv_file):
+    '''Yield the rows of a GHTorrent projects.csv file, skipping the bogus
+    entries that GHTorrent marks with an id of -1.  This works for the other
+    GHTorrent CSV files too, since they are written the same way.'''
+    with open(csv_file, encoding="utf-8", errors="replace") as f:
+        reader = csv.reader(f, escapechar='\\')
+        for row in reader:
+            if row[0] == '-1':
+                continue
+            yield row
+
+
+def row_path(row):
+    '''Return the owner/name path string for a projects.csv row.'''
+    return row[project_fields['url']][namestart:]
+
+
+_id_url_re = re.compile(r'(\d+),"https://api\.github\.com/repos/([^"]*)"')
+
+def project_id_paths(csv_file):
+    '''Yield (id, path) pairs from a GHTorrent projects.csv file.
+
+    Only the first two columns are needed for this, so rather than running
+    every line through the csv module, this matches them with a regular
+    expression.  GHTorrent escapes newlines inside fields with a backslash;
+    a line ending in an odd number of backslashes is continued on the next
+    line, and the continuation is not the start of a record.
+    '''
+    match = _id_url_re.match
+    continued = False
+    with open(csv_file, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if not continued:
+                m = match(line)
+                if m:
+                    yield m.groups()
+            stripped = line.rstrip('\n')
+            continued = ((len(stripped) - len(stripped.rstrip('\\'))) % 2 == 1
+                         and len(stripped) < len(line))
+
+
+# Parallel parsing.
+# .............................................................................
+# projects.csv runs to tens of GB, and the csv module parses it on one core.
+# parallel_csv_rows() cuts the file into byte ranges and parses them in
+# a pool of worker processes.  Each range is widened to record boundaries.
+# A record boundary is the position just after a newline that is not
+# escaped: GHTorrent's dumps escape newlines inside fields with a
+# backslash, and a backslash can itself be escaped, so a newline ends a
+# record only if the run of backslashes before it has even length.  Every
+# worker computes boundaries the same way, so adjacent ranges meet exactly
+# and no record is lost or parsed twice.
+
+def _is_record_end(f, newline_pos):
+    # Count the run of backslashes immediately before the newline.
+    count = 0
+    pos = newline_pos
+    while pos > 0:
+        step = min(pos, 256)
+        f.seek(pos - step)
+        block = f.read(step)
+        stripped = block.rstrip(b'\\')
+        count += len(block) - len(stripped)
+        if stripped:
+            break
+        pos -= step
+    return count % 2 == 0
+
+
+def _record_boundary(f, pos, size):
+    # Returns the first record boundary at or after byte position 'pos'.
+    if pos <= 0:
+        return 0
+    if pos >= size:
+        return size
+    here = pos - 1                      # A boundary at pos needs \n at pos-1.
+    while True:
+        f.seek(here)
+        line = f.readline()
+        if not line:
+            return size
+        end = here + len(line)
+        if line.endswith(b'\n') and _is_record_end(f, end - 1):
+            return end
+        here = end
+
+
+def _parse_range(args):
+    # Runs in a worker process.  Parses the records that start in the byte
+    # range [start, end) and returns them as a list of rows.
+    csv_file, start, end, columns, transform = args
+    with open(csv_file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        start = _record_boundary(f, start, size)
+        end = _record_boundary(f, end, size)
+        if start >= end:
+            return []
+        f.seek(start)
+        data = f.read(end - start)
+    text = io.StringIO(data.decode('utf-8', 'replace'), newline=None)
+    rows = []
+    for row in csv.reader(text, escapechar='\\'):
+        if not row or row[0] == '-1':
+            continue
+        if columns:
+            row = [row[i] for i in columns]
+        if transform:
+            row = transform(row)
+            if row is None:
+                continue
+        rows.append(row)
+    return rows
+
+
+def _bounded_map(pool, function, args, window, ordered=True):
+    # Like pool.imap(), or pool.imap_unordered() if not 'ordered', but with
+    # no more than 'window' tasks handed to the pool and not yet collected.
+    # imap() queues every task at once and the workers keep parsing however
+    # far ahead of the caller they get, so a slow consumer would end up with
+    # most of the file's rows in memory.
+    if ordered:
+        pending = deque()
+        for arg in args:
+            pending.append(pool.apply_async(function, (arg,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        return
+    done = Queue()
+
+    def collect():
+        ok, value = done.get()
+        if not ok:
+            raise value
+        return value
+
+    outstanding = 0
+    for arg in args:
+        pool.apply_async(function, (arg,),
+                         callback=lambda value: done.put((True, value)),
+                         error_callback=lambda err: done.put((False, err)))
+        outstanding += 1
+        if outstanding >= window:
+            outstanding -= 1
+            yield collect()
+    while outstanding:
+        outstanding -= 1
+        yield collect()
+
+
+def _window(processes):
+    # How many chunks may be parsed ahead of the caller.
+    return 2*(processes or os.cpu_count() or 1)
+
+
+def parallel_csv_rows(csv_file, processes=None, ordered=True,
+                      chunk_bytes=32*2**20, columns=None, transform=None):
+    '''Parse a GHTorrent CSV file such as projects.csv in parallel, yielding
+    lists of rows.  Each list holds the records from one chunk of about
+    'chunk_bytes' bytes of the file.  If 'ordered' is true, the lists come
+    back in file order; otherwise they come back as soon as they are
+    parsed.  Only about two chunks per process are parsed ahead of the
+    caller, so memory use doesn't depend on the size of the file.  If
+    'columns' is given, each row is reduced to those column positions.  If
+    'transform' is given, it must be a module-level function; it is called
+    in the worker on each row, and whatever it returns is sent back in
+    place of the row (None drops the row).  Sending rows back from the
+    workers costs about as much as parsing them, so it pays to trim them
+    with 'columns' or 'transform'.  Rows with an id of -1 are skipped, as
+    in projects_rows().'''
+    size = os.path.getsize(csv_file)
+    columns = tuple(columns) if columns else None
+    ranges = [(csv_file, start, min(start + chunk_bytes, size), columns, transform)
+              for start in range(0, size, chunk_bytes)]
+    with Pool(processes) as pool:
+        for rows in _bounded_map(pool, _parse_range, ranges, _window(processes),
+                                 ordered):
+            if rows:
+                yield rows
+
+
+def csv_chunks(csv_file, processes=1, start=0, chunk_bytes=32*2**20):
+    '''Yield (offset, rows) for each chunk of about 'chunk_bytes' bytes of
+    a GHTorrent CSV file, in file order, beginning at byte 'start'.
+    'offset' is where the chunk after this one begins, so passing it as
+    'start' later continues with the rows after these.  That makes it the
+    position to save in a checkpoint (see checkpoint.py).'''
+    size = os.path.getsize(csv_file)
+    ends = [min(pos + chunk_bytes, size) for pos in range(start, size, chunk_bytes)]
+    ranges = [(csv_file, pos, end, None, None)
+              for pos, end in zip([start] + ends[:-1], ends)]
+    if processes and processes > 1:
+        with Pool(processes) as pool:
+            yield from zip(ends, _bounded_map(pool, _parse_range, ranges,
+                                              _window(processes)))
+    else:
+        for end, args in zip(ends, ranges):
+            yield (end, _parse_range(args))
+
+
+def iter_csv_rows(csv_file, processes=1):
+    '''Yield the rows of a GHTorrent CSV file in file order, one at a time,
+    parsing the file with 'processes' worker processes if that is more
+    than 1.'''
+    if processes and processes > 1:
+        for rows in parallel_csv_rows(csv_file, processes):
+            yield from rows
+    else:
+        yield from projects_rows(csv_file)
+
+
+# Id to path mapping.
+# .............................................................................
+
+class IdPathMap():
+    '''Read-only mapping from GHTorrent project ids to owner/name paths.
+
+    The data is held in three flat sequences: a sorted sequence of ids, a
+    sequence of offsets into an arena, and the arena of UTF-8 bytes itself.
+    Keys may be given as ints or as the digit strings found in the CSV
+    files; anything else is simply not found.
+    '''
+
+    def __init__(self, ids, offsets, arena):
+        self._ids     = ids
+        self._offsets = offsets
+        self._arena   = arena
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        '''Build an in-memory map from an iterable of (id, path) pairs.'''
+        return cls(*_sorted_id_map(pairs))
+
+    def nbytes(self):
+        '''Approximate memory used by the underlying arrays, in bytes.'''
+        return (len(self._ids)*_ITEM_SIZE + len(self._offsets)*_ITEM_SIZE
+                + len(self._arena))
+
+    def _position(self, key):
+        try:
+            key = int(key)
+        except (TypeError, ValueError):
+            return -1
+        i = bisect_left(self._ids, key)
+        if i < len(self._ids) and self._ids[i] == key:
+            return i
+        return -1
+
+    def _path(self, i):
+        return bytes(self._arena[self._offsets[i]:self._offsets[i + 1]]).decode('utf-8')
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, key):
+        return self._position(key) >= 0
+
+    def __getitem__(self, key):
+        i = self._position(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._path(i)
+
+    def get(self, key, default=None):
+        i = self._position(key)
+        if i < 0:
+            return default
+        return self._path(i)
+
+    def keys(self):
+        return iter(self._ids)
+
+    def items(self):
+        for i, id in enumerate(self._ids):
+            yield (id, self._path(i))
+
+    def __iter__(self):
+        return self.keys()
+
+
+def _sorted_id_map(pairs, chunk_size=16384):
+    # Returns (ids, offsets, arena) with the ids sorted and unique.  When an
+    # id appears more than once the last one wins, like it would in a dict.
+    # The pairs are consumed in chunks so that the per-item work is done by
+    # the C code behind map, array, bytes.join and accumulate.  (zip(*chunk)
+    # would be shorter, but it makes an iterator per pair and costs more
+    # than all the rest put together.)
+    ids      = array('q')
+    ends     = array('Q')
+    arena    = bytearray()
+    in_order = True
+    pairs    = iter(pairs)
+    chunk    = list(islice(pairs, chunk_size))
+    while chunk:
+        chunk_ids = list(map(int, map(itemgetter(0), chunk)))
+        paths = list(map(itemgetter(1), chunk))
+        lengths = list(map(len, paths))
+        encoded = ''.join(paths).encode('utf-8')
+        if len(encoded) != sum(lengths):
+            # Not all ASCII, so string lengths aren't byte lengths.
+            lengths = [len(path.encode('utf-8')) for path in paths]
+        ends.extend(islice(accumulate(chain((len(arena),), lengths)), 1, None))
+        arena += encoded
+
+        # projects.csv is normally written in id order already, in which
+        # case we can skip the sort and its memory cost entirely.
+        if in_order:
+            in_order = ((not ids or ids[-1] < chunk_ids[0])
+                        and all(map(lt, chunk_ids, islice(chunk_ids, 1, None))))
+        ids.extend(chunk_ids)
+        chunk = list(islice(pairs, chunk_size))
+
+    if in_order:
+        offsets = array('Q', [0])
+        offsets.extend(ends)
+        return ids, offsets, arena
+
+    # sorted() is stable, so of a run of equal ids the last came last and
+    # overrides the others.
+    order = sorted(range(len(ids)), key=ids.__getitem__)
+    keep = [i for i, j in zip(order, islice(order, 1, None)) if ids[i] != ids[j]]
+    keep.append(order[-1])
+    starts = array('Q', [0])
+    starts.extend(islice(ends, len(ends) - 1))
+    pieces = list(map(arena.__getitem__, map(slice, map(starts.__getitem__, keep),
+                                                 map(ends.__getitem__, keep))))
+    offsets = array('Q', [0])
+    offsets.extend(accumulate(map(len, pieces)))
+    return array('q', map(ids.__getitem__, keep)), offsets, bytearray().join(pieces)
+
+
+def write_id_index(pairs, index_file):
+    '''Write an index file from an iterable of (id, path) pairs.  Returns
+    the number of ids written.'''
+    ids, offsets, arena = _sorted_id_map(pairs)
+    tmp_file = index_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(_HEADER.pack(_INDEX_MAGIC, _BYTE_ORDER, len(ids), len(arena)))
+        f.write(ids.tobytes())
+        f.write(offsets.tobytes())
+        f.write(arena)
+    os.replace(tmp_file, index_file)
+    return len(ids)
+
+
+def load_id_map(csv_file):
+    '''Parse a GHTorrent projects.csv file and return an in-memory IdPathMap.
+    This takes a fraction of the memory that a dict of the same data would.'''
+    return IdPathMap.from_pairs(project_id_paths(csv_file))
+
+
+def build_id_index(csv_file, index_file):
+    '''Parse a GHTorrent projects.csv file and write an index file mapping
+    GHTorrent project ids to owner/name paths.'''
+    return write_id_index(project_id_paths(csv_file), index_file)
+
+
+class IdPathIndex(IdPathMap):
+    '''An IdPathMap backed by a memory-mapped index file.'''
+
+    def __init__(self, index_file):
+        self._file = open(index_file, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, order, count, arena_size = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _INDEX_MAGIC or order != _BYTE_ORDER:
+            self.close()
+            raise ValueError('{} is not a GHTorrent id index for this machine'
+                             .format(index_file))
+        view = memoryview(self._mmap)
+        ids_start = _HEADER.size
+        off_start = ids_start + count*_ITEM_SIZE
+        arena_start = off_start + (count + 1)*_ITEM_SIZE
+        super().__init__(view[ids_start:off_start].cast('q'),
+                         view[off_start:arena_start].cast('Q'),
+                         view[arena_start:arena_start + arena_size])
+
+    def close(self):
+        self._ids = self._offsets = self._arena = None
+        if getattr(self, '_mmap', None) is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass                    # Someone still holds a view.
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def default_index_file(csv_file):
+    return csv_file + '.idx'
+
+
+def open_id_map(csv_file, index_file=None):
+    '''Return an IdPathIndex for the given projects.csv file, building the
+    index file first if it does not exist or is older than the CSV file.'''
+    if not index_file:
+        index_file = default_index_file(csv_file)
+    if (not os.path.exists(index_file)
+        or os.path.getmtime(index_file) < os.path.getmtime(csv_file)):
+        build_id_index(csv_file, index_file)
+    return IdPathIndex(index_file)
+
+
+# Joining against a GHTorrent MongoDB dump.
+# .............................................................................
+# Some of our utilities take a file of owner/name paths and look each one up
+# in a local copy of GHTorrent's MongoDB dump, then in our database.  Doing
+# that with find_one() costs up to three round trips per repository.
+# dump_entries() finds the dump entries for a stream of paths either by
+# sorting the paths and merging them with a scan of the dump sorted the same
+# way (which needs an index on owner.login and name in the dump), or, for
+# short lists, with one $or query per batch of paths.  casics_windows() then
+# finds our entries for a batch at a time using a RepoResolver.
+
+def read_repo_paths(file):
+    '''Yield (owner, name) tuples from a file of owner/name lines.'''
+    with open(file, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            yield (line[:line.find('/')], line[line.find('/') + 1:])
+
+
+def count_lines(file):
+    with open(file, 'rb') as f:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(2**20), b''))
+
+
+def _dump_key(ghentry):
+    # Returns None for the odd dump entry without an owner login or a name.
+    owner = ghentry.get('owner')
+    login = owner.get('login') if isinstance(owner, dict) else None
+    name = ghentry.get('name')
+    if login is None or name is None:
+        return None
+    return (login, name)
+
+
+def _keyed(ghentries):
+    # Yields (key, ghentry) for the dump entries that have a key, skipping
+    # the rest.
+    for ghentry in ghentries:
+        key = _dump_key(ghentry)
+        if key is not None:
+            yield (key, ghentry)
+
+
+def _dump_join(dump, paths, fields, run_size, not_found):
+    paths = external_sort(paths, run_size)
+    cursor = dump.find({}, fields, no_cursor_timeout=True,
+                       sort=[('owner.login', ASCENDING), ('name', ASCENDING)])
+    try:
+        entries = _keyed(cursor)
+        key, ghentry = next(entries, (None, None))
+        previous = None
+        for path in paths:
+            if path == previous:
+                continue
+            previous = path
+            while key is not None and key < path:
+                key, ghentry = next(entries, (None, None))
+            if key == path:
+                yield (path[0], path[1], ghentry)
+            elif not_found:
+                not_found(*path)
+    finally:
+        cursor.close()
+
+
+def _dump_batches(dump, paths, fields, batch_size, not_found):
+    for window in windows(paths, batch_size):
+        query = {'$or': [{'owner.login': owner, 'name': name}
+                         for owner, name in set(window)]}
+        found = dict(_keyed(dump.find(query, fields)))
+        seen = set()
+        for owner, name in window:
+            if (owner, name) in seen:
+                continue
+            seen.add((owner, name))
+            ghentry = found.get((owner, name))
+            if ghentry:
+                yield (owner, name, ghentry)
+            elif not_found:
+                not_found(owner, name)
+
+
+def dump_entries(dump, paths, join=False, fields=None, batch_size=1000,
+                 run_size=1000000, not_found=None):
+    '''Yield (owner, name, ghentry) for each (owner, name) in 'paths' that
+    is in the GHTorrent dump collection 'dump'.  If 'join' is true, the
+    paths are sorted (with at most 'run_size' of them in memory) and merged
+    with a sorted scan of the whole dump; duplicates are dropped and the
+    results come out in sorted order.  Otherwise the paths are looked up
+    'batch_size' at a time, in input order.  'not_found' is called as
+    not_found(owner, name) for paths that aren't in the dump.'''
+    if fields is not None:
+        fields = dict(fields, name=1)
+        fields['owner.login'] = 1
+    if join:
+        return _dump_join(dump, paths, fields, run_size, not_found)
+    else:
+        return _dump_batches(dump, paths, fields, batch_size, not_found)
+
+
+def casics_windows(repos, matches, batch_size=1000, fields=None, resolver=None):
+    '''Take the (owner, name, ghentry) tuples from dump_entries() a batch
+    at a time and yield lists of (owner, name, ghentry, by_id, by_path),
+    where by_id is our entry with the same id as the GHTorrent entry and
+    by_path is our entry with the same owner/name, or None.  by_path is
+    only looked up when by_id is not found.  The lookups are done by a
+    RepoResolver, which takes at most three queries per batch; pass one in
+    as 'resolver' to share its cache and counters.'''
+    if resolver is None:
+        resolver = RepoResolver(repos)
+    for window in windows(matches, batch_size):
+        found, entries = resolver.resolve_many(
+            [(ghentry['id'], owner, name) for owner, name, ghentry in window],
+            fields if fields is not None else ALL_FIELDS)
+        yield [(owner, name, ghentry,
+                entries.get(match.our_id) if match.how == BY_ID else None,
+                entries.get(match.our_id) if match.how == BY_PATH else None)
+               for (owner, name, ghentry), match in zip(window, found)]
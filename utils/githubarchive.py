@@ -0,0 +1,481 @@
+#!/usr/bin/env python3.4
+#
+# @file    githubarchive.py
+# @brief   Shared code for reading githubarchive.org hourly event files.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# githubarchive.org publishes one gzipped file of JSON events per hour.
+# This provides a decoder that turns the records in these files, in all the
+# formats githubarchive has used over the years, into uniform Event tuples.
+#
+# Backfilling a year means reading 8,760 files.  The functions at the end
+# take a list of files, directories or glob patterns, decode the files in a
+# pool of worker processes, and reduce the events to one record per
+# repository, so that the database only has to be touched once per
+# repository.
+
+import glob
+import gzip
+import json
+import os
+import re
+from collections import namedtuple
+from multiprocessing import Pool
+
+from bulkwriter import BulkUpdater, windows
+from resolver import RepoResolver
+
+# Use the fastest JSON decoder we have.  All of these accept the raw bytes
+# of a line, which saves decoding it to a string first.
+
+try:
+    from orjson import loads
+    json_backend = 'orjson'
+except ImportError:
+    try:
+        from ujson import loads
+        json_backend = 'ujson'
+    except ImportError:
+        from json import loads
+        json_backend = 'json'
+
+
+# Finding files.
+# .............................................................................
+
+def archive_files(inputs):
+    '''Expand a list of file names, directory names and glob patterns into
+    a sorted list of githubarchive .json.gz files.'''
+    files = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            files.update(glob.glob(os.path.join(item, '*.json.gz')))
+        elif os.path.exists(item):
+            files.add(item)
+        else:
+            files.update(glob.glob(item))
+    return sorted(files)
+
+
+# Decoding events.
+# .............................................................................
+# The format of the githubarchive records has changed several times.  The
+# pre-2015 "timeline" files have variously described the repository with a
+# 'repository' object, a 'repo' object, a 'repo' path string inside the
+# 'payload', or only a URL; the 2015+ files always have a 'repo' object.
+# decode_event() knows about all of these and reduces a record to an Event.
+# Records it doesn't understand are counted rather than stopping the run.
+
+Event = namedtuple('Event', 'id owner name type created_at public')
+Event.__doc__ = '''A githubarchive event reduced to the repository it concerns.
+The id is None for formats that don't include it, and created_at is the
+raw string from the record, which refers to the event, not the repo.'''
+
+_api_root   = 'https://api.github.com/repos/'
+_web_root   = 'https://github.com/'
+
+
+def _split_path(path):
+    slash = path.find('/')
+    if slash <= 0:
+        return (None, None)
+    owner = path[:slash]
+    name  = path[slash + 1:]
+    end   = name.find('/')
+    if end >= 0:
+        name = name[:end]
+    return (owner, name)
+
+
+def decode_event(contents):
+    '''Reduce a decoded JSON record to an Event, or return None if the
+    record's format is not one we recognize.'''
+    id = None
+    owner = name = None
+    repo = contents.get('repository')
+    if isinstance(repo, dict) and 'owner' in repo and 'name' in repo:
+        owner = repo['owner']
+        name  = repo['name']
+        id    = repo.get('id')
+    else:
+        repo = contents.get('repo')
+        payload = contents.get('payload')
+        if isinstance(repo, dict) and 'name' in repo:
+            owner, name = _split_path(repo['name'])
+            id = repo.get('id')
+        elif isinstance(payload, dict) and isinstance(payload.get('repo'), str):
+            owner, name = _split_path(payload['repo'])
+            if not owner:
+                # Some records give only the name here.
+                name  = payload['repo']
+                actor = contents.get('actor')
+                owner = actor.get('login') if isinstance(actor, dict) else payload.get('actor')
+        elif (isinstance(payload, dict) and isinstance(payload.get('release'), dict)
+              and payload['release'].get('url', '').startswith(_api_root)):
+            owner, name = _split_path(payload['release']['url'][len(_api_root):])
+        elif isinstance(contents.get('url'), str) and contents['url'].startswith(_web_root):
+            owner, name = _split_path(contents['url'][len(_web_root):])
+    if not owner or not name:
+        return None
+    return Event(id, owner, name, contents.get('type'), contents.get('created_at'),
+                 contents.get('public', True))
+
+
+class EventDecoder():
+    '''Streams Events out of githubarchive files, keeping counts of what it
+    has seen.  If 'types' is given, only events of those types are
+    returned.
+
+    Most scripts want only one or two event types, and most of the lines in
+    a file are other types.  So when 'types' is given, each raw line is
+    first checked for one of the wanted type names as a quoted JSON string,
+    and lines without one are skipped without being decoded or parsed.  A
+    line can pass the check and still not be one of the wanted types (the
+    name might appear in a commit message, say), so the type is checked
+    again after parsing; the prefilter only has to never reject a wanted
+    line, which it can't, since the type is always a plain string.'''
+
+    def __init__(self, types=None, prefilter=True):
+        self.types        = frozenset(types) if types else None
+        self.lines        = 0
+        self.events       = 0
+        self.unrecognized = 0
+        self.bad_json     = 0
+        self.prefiltered  = 0
+        self._prefilter   = None
+        if self.types and prefilter:
+            names = b'|'.join(re.escape(t.encode('ascii')) for t in sorted(self.types))
+            self._prefilter = re.compile(b'"(?:' + names + b')"').search
+
+    def decode_line(self, line):
+        self.lines += 1
+        if self._prefilter and not self._prefilter(line):
+            self.prefiltered += 1
+            return None
+        try:
+            contents = loads(line)
+        except ValueError:
+            try:
+                contents = json.loads(line.decode('ascii', 'ignore'))
+            except ValueError:
+                self.bad_json += 1
+                return None
+        if not isinstance(contents, dict):
+            self.unrecognized += 1
+            return None
+        if self.types and contents.get('type') not in self.types:
+            return None
+        event = decode_event(contents)
+        if event is None:
+            self.unrecognized += 1
+        else:
+            self.events += 1
+        return event
+
+    def decode_file(self, file):
+        with gzip.open(file, 'rb') as f:
+            for line in f:
+                event = self.decode_line(line)
+                if event:
+                    yield event
+
+    def decode_files(self, files):
+        for file in files:
+            yield from self.decode_file(file)
+
+    def counts(self):
+        return {'lines': self.lines, 'events': self.events,
+                'unrecognized': self.unrecognized, 'bad_json': self.bad_json,
+                'prefiltered': self.prefiltered}
+
+
+# Reducing to the latest push per repository.
+# .............................................................................
+# The results of the reduction are dicts keyed by owner/name path, with
+# values of the form [pushed_time, id, owner, name].  The time is whatever
+# the 'timestamp' function returns for the event's 'created_at' value; it
+# only needs to be comparable.
+
+def _merge_latest(into, other):
+    for path, value in other.items():
+        current = into.get(path)
+        if current is None:
+            into[path] = value
+            continue
+        if value[0] > current[0]:
+            current[0] = value[0]
+        if current[1] is None:
+            current[1] = value[1]
+
+
+def _file_latest_pushes(args):
+    # Runs in a worker process.  Returns (latest, events, unrecognized).
+    file, timestamp = args
+    latest = {}
+    decoder = EventDecoder(['PushEvent'])
+    for id, owner, name, _, created_at, _ in decoder.decode_file(file):
+        # It's confusing, but the 'created_at' here refers to the *event*,
+        # not the repo -- the event is a push.
+        when = timestamp(created_at)
+        path = owner + '/' + name
+        current = latest.get(path)
+        if current is None:
+            latest[path] = [when, id, owner, name]
+        else:
+            if when > current[0]:
+                current[0] = when
+            if current[1] is None:
+                current[1] = id
+    return (latest, decoder.events, decoder.unrecognized)
+
+
+def latest_pushes(files, timestamp, processes=None, progress=None):
+    '''Read PushEvents from the given githubarchive files in parallel and
+    return a dict mapping owner/name paths to [pushed_time, id, owner,
+    name], keeping the most recent push time for each repository across
+    all the files.  'timestamp' converts the events' created_at strings to
+    comparable values and must be a module-level function.  If 'progress'
+    is given, it is called as progress(files_done, events, unrecognized)
+    after each file.'''
+    latest = {}
+    events = 0
+    unrecognized = 0
+    with Pool(processes) as pool:
+        work = [(file, timestamp) for file in files]
+        for done, result in enumerate(pool.imap_unordered(_file_latest_pushes, work), 1):
+            file_latest, file_events, file_unrecognized = result
+            _merge_latest(latest, file_latest)
+            events += file_events
+            unrecognized += file_unrecognized
+            if progress:
+                progress(done, events, unrecognized)
+    return latest
+
+
+# Single-pass processing with multiple consumers.
+# .............................................................................
+# Different scripts used to decompress and parse the same hour files, each
+# for its own fields.  Here, any number of consumers share one pass over the
+# files.  Each consumer folds the events it cares about into a small
+# per-repository state; once all the files are read, the repositories are
+# looked up in batches, every consumer turns its state into field updates,
+# and the updates for a repository are merged into a single write.
+#
+# A consumer has a 'name', the event 'types' it wants (None for all), the
+# entry 'fields' it needs to see, and three methods:
+#
+#   reduce(state, event)    fold an event into the state (None at first)
+#   merge(state, other)     combine states from two workers
+#   updates(entry, state, direct)
+#                           return a dict of $set updates for the entry, or
+#                           an empty dict; direct is False if the event's
+#                           repository is one we know under another id, and
+#                           True if we found it by id, or by owner/name for
+#                           events (before 2015) that carry no id
+#
+# Consumers are sent to worker processes, so they must be picklable.
+
+class EventConsumer():
+    name   = None
+    types  = None
+    fields = {}
+
+    def reduce(self, state, event):
+        raise NotImplementedError
+
+    def merge(self, state, other):
+        raise NotImplementedError
+
+    def updates(self, entry, state, direct):
+        raise NotImplementedError
+
+
+class PushedConsumer(EventConsumer):
+    '''Keeps time.repo_pushed up to date with the latest PushEvent.'''
+
+    name   = 'pushed'
+    types  = ['PushEvent']
+    fields = {'time': 1}
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+    def reduce(self, state, event):
+        # The 'created_at' refers to the *event*, which is a push.
+        when = self.timestamp(event.created_at)
+        return when if state is None or when > state else state
+
+    def merge(self, state, other):
+        return max(state, other)
+
+    def updates(self, entry, state, direct):
+        # Purposefully not updating the data_refreshed time; see
+        # update-pushed-from-githubarchive.py.
+        if not entry['time']['repo_pushed'] or state > entry['time']['repo_pushed']:
+            return {'time.repo_pushed': state}
+        return {}
+
+
+class VisibleConsumer(EventConsumer):
+    '''Sets is_visible from the latest event for each repository.  If we
+    know the repository only under another id, its visibility is checked
+    on GitHub with 'url_exists(entry)' instead, and the refresh time is set
+    to 'now()'; if that check fails (returns None), the entry is left
+    alone.'''
+
+    name   = 'visible'
+    types  = None
+    fields = {'is_visible': 1, 'time': 1}
+
+    def __init__(self, timestamp, url_exists=None, now=None):
+        self.timestamp  = timestamp
+        self.url_exists = url_exists
+        self.now        = now
+
+    def reduce(self, state, event):
+        when = self.timestamp(event.created_at)
+        if state is None or when > state[0]:
+            return (when, event.public)
+        return state
+
+    def merge(self, state, other):
+        return other if other[0] > state[0] else state
+
+    def updates(self, entry, state, direct):
+        their_time, public = state
+        if entry['is_visible'] != '' and their_time < entry['time']['data_refreshed']:
+            # We have a value and our refresh time is newer.
+            return {}
+        if direct or not self.url_exists:
+            return {'is_visible': public}
+        exists = self.url_exists(entry)
+        if exists is None:
+            return {}
+        return {'is_visible': bool(exists), 'time.data_refreshed': self.now()}
+
+
+class ContentTypeConsumer(EventConsumer):
+    '''Marks repositories with releases or forks as having content.'''
+
+    name   = 'content_type'
+    types  = ['ReleaseEvent', 'ForkEvent']
+    fields = {'content_type': 1, 'is_visible': 1, 'is_deleted': 1}
+
+    def reduce(self, state, event):
+        return True
+
+    def merge(self, state, other):
+        return True
+
+    def updates(self, entry, state, direct):
+        if not direct and (entry['is_deleted'] or not entry['is_visible']):
+            return {}
+        if entry['content_type'] == '':
+            return {'content_type': 'nonempty'}
+        return {}
+
+
+def _wanted_types(consumers):
+    types = set()
+    for consumer in consumers:
+        if consumer.types is None:
+            return None
+        types.update(consumer.types)
+    return types
+
+
+def _file_consumer_states(args):
+    # Runs in a worker process.  Returns ({path: [id, owner, name, states]},
+    # decoder counts), where states is a list with one entry per consumer.
+    file, consumers = args
+    decoder = EventDecoder(_wanted_types(consumers))
+    wanted = [frozenset(c.types) if c.types is not None else None for c in consumers]
+    repos = {}
+    for event in decoder.decode_file(file):
+        path = event.owner + '/' + event.name
+        record = repos.get(path)
+        if record is None:
+            record = repos[path] = [event.id, event.owner, event.name,
+                                    [None]*len(consumers)]
+        elif record[0] is None:
+            record[0] = event.id
+        states = record[3]
+        for i, consumer in enumerate(consumers):
+            if wanted[i] is None or event.type in wanted[i]:
+                states[i] = consumer.reduce(states[i], event)
+    return (repos, decoder.counts())
+
+
+def consume_events(files, consumers, processes=None, progress=None):
+    '''Read the githubarchive files once, in parallel, and fold the events
+    into per-repository states for each consumer.  Returns a dict mapping
+    owner/name paths to [id, owner, name, states].  If 'progress' is given,
+    it is called as progress(files_done, counts) after each file.'''
+    repos = {}
+    totals = {}
+    with Pool(processes) as pool:
+        work = [(file, consumers) for file in files]
+        for done, result in enumerate(pool.imap_unordered(_file_consumer_states, work), 1):
+            file_repos, counts = result
+            for path, record in file_repos.items():
+                current = repos.get(path)
+                if current is None:
+                    repos[path] = record
+                    continue
+                if current[0] is None:
+                    current[0] = record[0]
+                for i, consumer in enumerate(consumers):
+                    if record[3][i] is None:
+                        continue
+                    if current[3][i] is None:
+                        current[3][i] = record[3][i]
+                    else:
+                        current[3][i] = consumer.merge(current[3][i], record[3][i])
+            for key, value in counts.items():
+                totals[key] = totals.get(key, 0) + value
+            if progress:
+                progress(done, totals)
+    return repos
+
+
+def apply_consumers(collection, repos, consumers, batch_size=1000, log=None,
+                    throttle=None):
+    '''Look up the repositories produced by consume_events() in batches,
+    collect the updates from every consumer, and write one merged update
+    per repository with bulk writes, paced by 'throttle' (a WriteThrottle)
+    if given.  Returns the BulkUpdater, whose counters tell what was done.
+    If 'log' is given, it is called with messages about unknown and
+    mismatched repositories.'''
+    fields = {'owner': 1, 'name': 1}
+    for consumer in consumers:
+        fields.update(consumer.fields)
+    if log:
+        report = lambda match: log('*** {} -- skipping'.format(match.describe()))
+        resolver = RepoResolver(collection, on_unknown=report,
+                                on_mismatch=lambda match: log('*** ' + match.describe()))
+    else:
+        resolver = RepoResolver(collection)
+    with BulkUpdater(collection, batch_size=batch_size, throttle=throttle) as writer:
+        for window in windows(repos.values(), batch_size):
+            matches, entries = resolver.resolve_many([r[:3] for r in window], fields)
+            for match, (_, _, _, states) in zip(matches, window):
+                entry = entries.get(match.our_id)
+                if not entry:
+                    continue
+                # Events from before 2015 have no repository id, so they can
+                # only be found by path; an exact path match is as good as
+                # an id match for them.
+                direct = not match.mismatch
+                updates = {}
+                for consumer, state in zip(consumers, states):
+                    if state is not None:
+                        updates.update(consumer.updates(entry, state, direct))
+                if updates:
+                    writer.set(entry['_id'], updates)
+    return writer
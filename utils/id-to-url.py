@@ -26,6 +26,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
 from casicsdb import *
 from utils import *
+from idquery import *
 
 casicsdb = CasicsDB()
 github_db = casicsdb.open('github')
@@ -33,17 +34,13 @@ repos = github_db.repos
 
 msg("Reading file of id's")
 
-lines = None
-with open(sys.argv[1], encoding="utf-8") as f:
-    lines = f.readlines()
-    for line in lines:
-        id = line.strip()
-        if not id.isdigit():
-            msg('*** {} is not an integer'.format(id))
-            continue
-        entry = repos.find_one({'_id': int(id)})
-        if not entry:
-            # We need to deal with these using our cataloguer.
-            msg('*** Unknown entry {}'.format(id))
-            continue
-        msg('https://github.com/{}/{}'.format(entry['owner'], entry['name']))
+def not_integer(line):
+    msg('*** {} is not an integer'.format(line))
+
+ids = read_ids(sys.argv[1], not_integer)
+for id, entry in query_ids(repos, ids, fields={'owner': 1, 'name': 1}, missing=True):
+    if not entry:
+        # We need to deal with these using our cataloguer.
+        msg('*** Unknown entry {}'.format(id))
+        continue
+    msg('https://github.com/{}/{}'.format(entry['owner'], entry['name']))
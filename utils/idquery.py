@@ -0,0 +1,88 @@
+#!/usr/bin/env python3.4
+#
+# @file    idquery.py
+# @brief   Look up long lists of repository ids with batched $in queries.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Many of our utilities read a file of repository ids (one per line, such
+# as four-million-project-ids.txt) and call find_one() for each.  With
+# millions of ids, nearly all of the time goes to network round trips.
+# query_ids() reads the ids in chunks, looks up each chunk with one $in
+# query, keeps a few of those queries in flight at once on separate
+# threads, and yields the results either in input order or as soon as
+# they arrive.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from bulkwriter import windows
+
+
+# Reading id files.
+# .............................................................................
+
+def read_ids(file, bad_id=None):
+    '''Yield the integer ids in 'file', one per line, skipping blank lines.
+    Lines that aren't integers are skipped too, after calling bad_id(line)
+    if 'bad_id' is given.'''
+    with open(file, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if not line.isdigit():
+                if bad_id:
+                    bad_id(line)
+                continue
+            yield int(line)
+
+
+# Querying.
+# .............................................................................
+
+def _query_chunk(collection, chunk, query, fields):
+    # Returns [(id, entry or None)] in the order of 'chunk'.
+    found = {e['_id']: e for e in
+             collection.find(dict(query, _id={'$in': chunk}), fields)}
+    return [(id, found.get(id)) for id in chunk]
+
+
+def query_ids(collection, ids, query=None, fields=None, chunk_size=1000,
+              in_flight=4, ordered=True, missing=False):
+    '''Yield (id, entry) for the ids in 'ids' that match 'query', looking
+    them up 'chunk_size' at a time with at most 'in_flight' queries
+    running at once.  'fields' is the projection, as for find().  If
+    'ordered' is true, results come out in the order of 'ids'; otherwise
+    each chunk comes out as soon as its query is done.  If 'missing' is
+    true, ids that are not found or don't match are yielded too, with an
+    entry of None.'''
+    query = query or {}
+    in_flight = max(1, in_flight)
+    with ThreadPoolExecutor(max_workers=in_flight) as pool:
+        pending = deque()
+        chunks = windows(ids, chunk_size)
+        while True:
+            while len(pending) < in_flight:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append(pool.submit(_query_chunk, collection, chunk,
+                                           query, fields))
+            if not pending:
+                return
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+            for future in done:
+                for id, entry in future.result():
+                    if entry is not None or missing:
+                        yield (id, entry)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import plac
 import re
 import sys
 import zlib
@@ -12,9 +13,45 @@ sys.path.append('../../common')
 
 from casicsdb import *
 from utils import *
+from idquery import read_ids
+from repopaths import *
 
-file = sys.argv[1]
+# Prints the path under /srv/repositories for each id in a file.  The paths
+# are generated in bulk.  With -i, only the ids that have a local clone are
+# printed, using an index of the clones built with -b; building it takes
+# one scan of the directory tree (-p sets the number of processes for it),
+# after which nothing needs to touch the file system to know what's there.
 
-with open(file, 'r') as f:
-    for id in f.readlines():
-        msg(generate_path('/srv/repositories', id.strip()))
+def run(index_file=None, build=False, processes=1, root=default_root, file=None):
+    if build:
+        if not index_file:
+            raise SystemExit('Need an index file to build (-i).')
+        ids = read_ids(file) if file else None
+        msg('Scanning {} for clones'.format(root))
+        checked, found = build_path_index(generate_path, index_file, ids, root,
+                                          processes)
+        msg('{} ids checked, {} with clones, written to {}'.format(
+            checked, found, index_file))
+        return
+    if not file:
+        raise SystemExit('Need a file of ids.')
+    if index_file:
+        with open_path_index(index_file) as index:
+            for id in read_ids(file):
+                path = index.get(id)
+                if path:
+                    msg(path)
+    else:
+        for id, path in generate_paths(generate_path, read_ids(file), root):
+            msg(path)
+
+run.__annotations__ = dict(
+    index_file = ('index of local clones to use (or build, with -b)', 'option', 'i'),
+    build      = ('build the index of local clones', 'flag', 'b'),
+    processes  = ('number of processes for scanning the tree', 'option', 'p', int),
+    root       = ('root of the repository tree', 'option', 'r'),
+    file       = ('file containing repo identifiers', 'positional'),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
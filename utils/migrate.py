@@ -0,0 +1,81 @@
+#!/usr/bin/env python3.4
+#
+# @file    migrate.py
+# @brief   Apply the pending migrations of the repos collection.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# With no arguments, applies every migration in repomigrations.py that the
+# database doesn't have recorded as applied, in order.  Naming versions
+# applies only those.  -l lists the migrations and their state, and -m
+# records the named versions (or all of them) as applied without running
+# them.  An interrupted migration continues where it stopped next time.
+#
+# Nothing is run on a database with no migrations recorded until -B has
+# recorded the ones that predate the runner (up to 'baseline_version' in
+# repomigrations.py) as applied.
+
+import sys
+import plac
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
+from casicsdb import *
+from migrations import *
+from repomigrations import *
+
+
+def run(show=False, mark_applied=False, baseline=False, batch=10000, *versions):
+    msg('Opening remote CASICS database ...')
+
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
+
+    runner = MigrationRunner(repos, batch_size=batch, log=msg)
+    if versions:
+        unknown = set(versions) - {m.version for m in repo_migrations}
+        if unknown:
+            raise SystemExit('Unknown versions: {}'.format(', '.join(sorted(unknown))))
+        migrations = [m for m in repo_migrations if m.version in versions]
+    else:
+        migrations = repo_migrations
+
+    if baseline:
+        for migration in runner.mark_baseline(repo_migrations, baseline_version):
+            msg('{} marked as applied'.format(migration.version))
+    elif show:
+        applied = runner.applied()
+        for migration in migrations:
+            msg('{} {:<8} {}'.format(migration.version,
+                                     'applied' if migration.version in applied else 'pending',
+                                     migration.description))
+    elif mark_applied:
+        for migration in migrations:
+            runner.mark_applied(migration)
+            msg('{} marked as applied'.format(migration.version))
+    else:
+        try:
+            runner.run_all(migrations)
+        except NoBaseline as err:
+            raise SystemExit('{} (see migrate.py -B)'.format(err))
+        for field, count in sorted(unparsable.items()):
+            msg('{} values of {} were not numbers and were set to None'.format(count, field))
+    msg('Done')
+
+run.__annotations__ = dict(
+    show          = ('list the migrations and whether they have been applied', 'flag', 'l'),
+    mark_applied  = ('record migrations as applied without running them', 'flag', 'm'),
+    baseline      = ('record the migrations up to the baseline as applied', 'flag', 'B'),
+    batch         = ('number of entries per _id range', 'option', 'b', int),
+    versions      = 'versions of the migrations to apply (default: all pending)',
+)
+
+if __name__ == '__main__':
+    plac.call(run)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3.4
+#
+# @file    migrations.py
+# @brief   Versioned, resumable changes to the structure of the database.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Every change to the format of our entries used to be a one-off script
+# (add-files-field.py, fix-content-type.py, ...) doing an update_many() over
+# 25 million entries, or a loop calling update_one() on each, with no record
+# of which had been run and no way to continue one that was interrupted.
+#
+# Here, each change is a Migration with a version string.  MigrationRunner
+# records the versions applied in a 'migrations' collection next to the
+# collection being changed, and applies each step of a migration to one
+# range of _id values at a time, saving the end of the range it has
+# finished in the migration's record.  If it's interrupted, running it
+# again continues from there.  The migrations themselves are listed in
+# repomigrations.py, and migrate.py runs them.
+#
+# A database with no record of any migration is taken to be one that
+# existed before MigrationRunner did, on which running the old migrations
+# again could do harm, so run_all() refuses to touch it until a baseline
+# has been recorded with mark_baseline().
+
+from collections import namedtuple
+from datetime import datetime
+
+from pymongo import ASCENDING
+
+from bulkwriter import BulkUpdater, RateMeter
+from pipelines import NotExpressible, Reshape, apply_reshape, to_pipeline
+
+
+# Migrations.
+# .............................................................................
+
+class NoBaseline(Exception):
+    '''Raised when asked to run migrations on a collection for which none
+    have been recorded.'''
+    pass
+
+
+class Update(namedtuple('Update', 'query update')):
+    '''A migration step done by the server: update_many(query, update),
+    applied one _id range at a time.'''
+    __slots__ = ()
+
+
+class Transform(namedtuple('Transform', 'query fields function')):
+    '''A migration step done in Python: function(entry) is called for each
+    entry matching 'query', fetched with the projection 'fields', and
+    returns a dict of fields to $set, or None to leave it alone.'''
+    __slots__ = ()
+
+
+class Migration():
+    '''A named, versioned list of steps, which can be Updates, Transforms
+    or Reshapes (see pipelines.py).  Versions are compared as strings,
+    so they should be written with leading zeros.'''
+
+    def __init__(self, version, description, steps):
+        self.version     = version
+        self.description = description
+        self.steps       = list(steps)
+
+    def __repr__(self):
+        return '<Migration {} {}>'.format(self.version, self.description)
+
+
+# Running.
+# .............................................................................
+
+class MigrationRunner():
+    '''Applies migrations to 'collection', 'batch_size' entries at a time,
+    recording what it has done in the collection named 'meta_name' in the
+    same database.  'log' is called with progress messages.'''
+
+    def __init__(self, collection, batch_size=10000, meta_name='migrations',
+                 log=None):
+        self.collection = collection
+        self.meta       = collection.database[meta_name]
+        self.batch_size = max(1, batch_size)
+        self.log        = log or (lambda text: None)
+        # Set to False once the server turns down a pipeline update.
+        self.server_updates = True
+
+    def _record(self, migration):
+        return self.meta.find_one({'_id': migration.version}) or {}
+
+    def _save(self, migration, **fields):
+        self.meta.update_one({'_id': migration.version},
+                             {'$set': dict(fields, description=migration.description,
+                                           collection=self.collection.name)},
+                             upsert=True)
+
+    def applied(self):
+        '''Return the set of versions that have been applied completely.'''
+        return {r['_id'] for r in self.meta.find({'state': 'done'}, {'_id': 1})}
+
+    def pending(self, migrations):
+        '''Return the migrations that haven't been applied, in version order.'''
+        done = self.applied()
+        return sorted((m for m in migrations if m.version not in done),
+                      key=lambda m: m.version)
+
+    def mark_applied(self, migration):
+        '''Record 'migration' as applied without running it, for databases
+        where the old one-off script was run by hand.'''
+        self._save(migration, state='done', finished=datetime.utcnow())
+
+    def recorded(self):
+        '''True if any migration has been recorded for the collection.'''
+        return self.meta.find_one({'collection': self.collection.name}) is not None
+
+    def mark_baseline(self, migrations, version):
+        '''Record every migration up to and including 'version' as
+        applied, without running them.  Returns the ones recorded.'''
+        marked = [m for m in migrations if m.version <= version]
+        for migration in marked:
+            self.mark_applied(migration)
+        return marked
+
+    def _boundary(self, after):
+        # The last _id of the next batch after 'after', or None if the rest
+        # of the collection fits in one batch.
+        query = {} if after is None else {'_id': {'$gt': after}}
+        found = list(self.collection.find(query, {'_id': 1}, sort=[('_id', ASCENDING)],
+                                          skip=self.batch_size - 1, limit=1))
+        return found[0]['_id'] if found else None
+
+    def _ranges(self, after):
+        # Yields (after, upto) pairs covering the collection from 'after'
+        # on, where either may be None for an open end.
+        while True:
+            upto = self._boundary(after)
+            yield (after, upto)
+            if upto is None:
+                return
+            after = upto
+
+    def _apply_update(self, step, query):
+        return self.collection.update_many(query, step.update).modified_count
+
+    def _apply_transform(self, step, query):
+        with BulkUpdater(self.collection, self.batch_size) as writer:
+            for entry in self.collection.find(query, step.fields):
+                updates = step.function(entry)
+                if updates:
+                    writer.set(entry['_id'], updates)
+        return writer.modified
+
+    def _apply_reshape(self, step, query):
+        modified, on_server = apply_reshape(self.collection, step, query,
+                                            self.batch_size, self.server_updates)
+        if not on_server and self.server_updates:
+            try:
+                to_pipeline(step)
+                self.log('Server refused a pipeline update; updating from here')
+                self.server_updates = False
+            except NotExpressible:
+                pass
+        return modified
+
+    def _apply(self, step, query):
+        if isinstance(step, Transform):
+            return self._apply_transform(step, query)
+        if isinstance(step, Reshape):
+            return self._apply_reshape(step, query)
+        return self._apply_update(step, query)
+
+    def run(self, migration):
+        '''Apply 'migration', continuing from where it stopped before if it
+        was interrupted.  Returns the number of entries modified.'''
+        record = self._record(migration)
+        if record.get('state') == 'done':
+            self.log('{} already applied'.format(migration.version))
+            return 0
+        first_step = record.get('step', 0)
+        after = record.get('last_id')
+        modified = record.get('modified', 0)
+        if record:
+            self.log('Resuming {} at step {} after _id {}'.format(
+                migration.version, first_step + 1, after))
+        else:
+            self._save(migration, state='running', step=0, last_id=None,
+                       modified=0, started=datetime.utcnow())
+        self.log('Applying {}: {}'.format(migration.version, migration.description))
+        for number in range(first_step, len(migration.steps)):
+            step = migration.steps[number]
+            meter = RateMeter()
+            for low, high in self._ranges(after):
+                bounds = {}
+                if low is not None:
+                    bounds['$gt'] = low
+                if high is not None:
+                    bounds['$lte'] = high
+                query = {'$and': [step.query, {'_id': bounds}]} if bounds else step.query
+                modified += self._apply(step, query)
+                if high is not None:
+                    # Steps must be safe to repeat, because a range may be
+                    # done again if we're interrupted before this is saved.
+                    meter.add(self.batch_size)
+                    self._save(migration, step=number, last_id=high, modified=modified)
+                    self.log('{} step {}: up to _id {}, {} modified [{:.0f}/s]'.format(
+                        migration.version, number + 1, high, modified, meter.rate()))
+            after = None
+            self._save(migration, step=number + 1, last_id=None, modified=modified)
+        self._save(migration, state='done', finished=datetime.utcnow())
+        self.log('{} done, {} modified'.format(migration.version, modified))
+        return modified
+
+    def run_all(self, migrations):
+        '''Apply every migration that hasn't been applied, in version order.
+        Raises NoBaseline if no migration has been recorded.'''
+        if not self.recorded():
+            raise NoBaseline('No migrations recorded for {}; record a baseline first'
+                             .format(self.collection.name))
+        for migration in self.pending(migrations):
+            self.run(migration)
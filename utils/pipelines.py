@@ -0,0 +1,215 @@
+#!/usr/bin/env python3.4
+#
+# @file    pipelines.py
+# @brief   Reshape entries on the server with pipeline updates, or in Python.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Several of our changes to the format of entries only move values around,
+# such as putting 'created' into 'time.repo_created'.  Doing that with a
+# loop over repos.find() and one update per entry sends every entry over
+# the network twice.  MongoDB 4.2 and later can do it on the server with an
+# update whose "update" is an aggregation pipeline.
+#
+# A Reshape describes the new values of fields in terms of old ones, using
+# the small set of expressions below.  to_pipeline() turns it into a
+# pipeline for update_many(), and evaluate() computes the same update in
+# Python for one entry.  apply_reshape() uses the server when it can, and
+# falls back to fetching the entries and sending bulk updates when the
+# server is too old or the Reshape uses a Python function.
+
+from collections import namedtuple
+
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from bulkwriter import BulkUpdater
+
+
+# Expressions.
+# .............................................................................
+
+class NotExpressible(Exception):
+    '''Raised when a Reshape can't be turned into a pipeline.'''
+    pass
+
+
+_MISSING = object()
+
+
+def _get(entry, path):
+    for part in path.split('.'):
+        if not isinstance(entry, dict) or part not in entry:
+            return _MISSING
+        entry = entry[part]
+    return entry
+
+
+class Field(namedtuple('Field', 'path')):
+    '''The value of field 'path' (in dot notation) of the old entry.  If
+    it doesn't exist, the field being set is left out.'''
+    __slots__ = ()
+
+    def pipeline(self):
+        return '$' + self.path
+
+    def evaluate(self, entry):
+        return _get(entry, self.path)
+
+    def fields(self):
+        return [self.path]
+
+
+# What Either counts as empty.  These are the values Python treats as
+# false, which is what the loops Either replaces tested with 'if value'.
+
+_EMPTY = [None, '', False, 0, [], {}]
+
+
+class Either(namedtuple('Either', 'value default')):
+    ''''value' if it is set and not empty (not None, '', False, 0, [] or
+    {}), otherwise 'default'.'''
+    __slots__ = ()
+
+    def pipeline(self):
+        value = _pipeline(self.value)
+        return {'$cond': [{'$in': [{'$ifNull': [value, None]}, {'$literal': _EMPTY}]},
+                          _pipeline(self.default), value]}
+
+    def evaluate(self, entry):
+        value = _evaluate(self.value, entry)
+        if value is _MISSING or not value:
+            return _evaluate(self.default, entry)
+        return value
+
+    def fields(self):
+        return _fields(self.value) + _fields(self.default)
+
+
+class Python(namedtuple('Python', 'function paths')):
+    '''function(*values) of the fields named in 'paths' (missing ones are
+    None).  This can't be done on the server, so using it makes the whole
+    Reshape run in Python.'''
+    __slots__ = ()
+
+    def __new__(cls, function, *paths):
+        return super().__new__(cls, function, paths)
+
+    def pipeline(self):
+        raise NotExpressible('{} is a Python function'.format(self.function.__name__))
+
+    def evaluate(self, entry):
+        values = [_get(entry, path) for path in self.paths]
+        return self.function(*[None if v is _MISSING else v for v in values])
+
+    def fields(self):
+        return list(self.paths)
+
+
+def _pipeline(value):
+    if hasattr(value, 'pipeline'):
+        return value.pipeline()
+    if isinstance(value, dict):
+        # Replace the whole embedded document, like $set does, rather than
+        # merging into it, which is what a plain object would do.
+        return {'$mergeObjects': [{k: _pipeline(v) for k, v in value.items()}]}
+    return {'$literal': value}
+
+
+def _evaluate(value, entry):
+    if hasattr(value, 'evaluate'):
+        return value.evaluate(entry)
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            item = _evaluate(item, entry)
+            if item is not _MISSING:
+                result[key] = item
+        return result
+    return value
+
+
+def _fields(value):
+    if hasattr(value, 'fields'):
+        return value.fields()
+    if isinstance(value, dict):
+        return [f for item in value.values() for f in _fields(item)]
+    return []
+
+
+# Reshaping.
+# .............................................................................
+
+class Reshape(namedtuple('Reshape', 'query set unset')):
+    '''Set the fields in the dict 'set' to the values of expressions (or
+    constants, or dicts of them) and remove the fields in 'unset', in the
+    entries matching 'query'.'''
+    __slots__ = ()
+
+    def __new__(cls, query, set=None, unset=()):
+        return super().__new__(cls, query, set or {}, tuple(unset))
+
+
+def to_pipeline(reshape):
+    '''Return the update pipeline for 'reshape', or raise NotExpressible.'''
+    stages = []
+    if reshape.set:
+        stages.append({'$set': {k: _pipeline(v) for k, v in reshape.set.items()}})
+    if reshape.unset:
+        stages.append({'$unset': list(reshape.unset)})
+    return stages
+
+
+def evaluate(reshape, entry):
+    '''Return the update document that 'reshape' makes for 'entry'.'''
+    update = {}
+    updates = {}
+    for key, value in reshape.set.items():
+        value = _evaluate(value, entry)
+        if value is not _MISSING:
+            updates[key] = value
+    if updates:
+        update['$set'] = updates
+    if reshape.unset:
+        update['$unset'] = {field: 1 for field in reshape.unset}
+    return update
+
+
+def projection(reshape):
+    '''The fields evaluate() needs from each entry.'''
+    fields = {f: 1 for value in reshape.set.values() for f in _fields(value)}
+    return fields or {'_id': 1}
+
+
+def _apply_in_python(collection, reshape, query, batch_size):
+    with BulkUpdater(collection, batch_size) as writer:
+        for entry in collection.find(query, projection(reshape)):
+            update = evaluate(reshape, entry)
+            if update:
+                writer.add(UpdateOne({'_id': entry['_id']}, update))
+    return writer.modified
+
+
+def apply_reshape(collection, reshape, query=None, batch_size=1000, server=True):
+    '''Apply 'reshape' to the entries matching its query (or 'query', if
+    given, such as one narrowed to a range of _id values).  Uses a pipeline
+    update if 'server' is true and the Reshape can be expressed as one; if
+    the server rejects it, or it can't be expressed, the entries are
+    fetched and updated in bulk from here.  Returns (number of entries
+    modified, True if done on the server).'''
+    if query is None:
+        query = reshape.query
+    if server:
+        try:
+            pipeline = to_pipeline(reshape)
+            return (collection.update_many(query, pipeline).modified_count, True)
+        except (NotExpressible, OperationFailure, TypeError):
+            # TypeError is what older versions of pymongo raise for a list
+            # where they expect an update document.
+            pass
+    return (_apply_in_python(collection, reshape, query, batch_size), False)
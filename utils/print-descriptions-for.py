@@ -12,6 +12,7 @@ sys.path.append('../../common')
 
 from casicsdb import *
 from utils import *
+from idquery import *
 
 casicsdb  = CasicsDB()
 github_db = casicsdb.open('github')
@@ -21,10 +22,9 @@ file = sys.argv[1]
 
 msg('Listing descriptions for repos found in file {}'.format(file))
 
-id_list = []
-with open(file) as f:
-    id_list = f.read().splitlines()
-
-for id in id_list:
-    entry = repos.find_one({'_id': int(id)}, {'description': 1, 'owner': 1, 'name': 1})
+fields = {'description': 1, 'owner': 1, 'name': 1}
+for id, entry in query_ids(repos, read_ids(file), fields=fields, missing=True):
+    if not entry:
+        msg('*** Unknown entry {}'.format(id))
+        continue
     msg('{}: {}'.format(e_summary(entry), entry['description']))
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3.4
+#
+# @file    rangescan.py
+# @brief   Scan a collection in parallel, one range of _id values per worker.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Some changes to entries can only be made in Python, such as decompressing
+# the readme field with zlib or converting language codes with Lang.  Done
+# with one repos.find() cursor, they use one core of the client and keep
+# the server waiting on it.
+#
+# parallel_scan() divides the _id values into ranges of roughly equal size,
+# using the split points the server computes for sharding (splitVector) or,
+# if it won't give us those, a random sample of _id values.  Each range is
+# then scanned by a worker process with its own connection and cursor,
+# calling a transform function on each entry and sending the updates it
+# returns back with BulkUpdater.  There are several ranges per process, so
+# that a process that gets a slow range doesn't hold up the end of the run.
+
+import os
+from multiprocessing import Pool
+
+from pymongo.errors import OperationFailure
+
+from bulkwriter import BulkUpdater, RateMeter
+
+
+# Globals.
+# .............................................................................
+
+# Number of ranges per worker process, and number of sampled _id values
+# per range when the server won't compute split points.
+
+ranges_per_process = 4
+samples_per_range  = 20
+
+# The collection used by the worker processes.  Each opens its own, since
+# pymongo clients can't be shared across fork().
+
+_collection = None
+
+
+# Splitting the _id space.
+# .............................................................................
+
+def _thin(points, count):
+    # Picks 'count' evenly spaced values from the sorted list 'points'.
+    if len(points) <= count:
+        return points
+    step = len(points)/(count + 1)
+    return [points[int(step*(i + 1))] for i in range(count)]
+
+
+def _split_vector(collection, partitions):
+    stats = collection.database.command('collstats', collection.name)
+    count = stats.get('count', 0)
+    if count < partitions:
+        return []
+    size_mb = max(1, int(stats.get('size', 0)/partitions/(1024*1024)))
+    result = collection.database.command(
+        'splitVector', '{}.{}'.format(collection.database.name, collection.name),
+        keyPattern={'_id': 1}, maxChunkSize=size_mb,
+        maxChunkObjects=max(1, count//partitions))
+    return [key['_id'] for key in result.get('splitKeys', [])]
+
+
+def _sampled(collection, partitions):
+    size = partitions*samples_per_range
+    sample = collection.aggregate([{'$sample': {'size': size}},
+                                   {'$project': {'_id': 1}}])
+    return sorted({entry['_id'] for entry in sample})
+
+
+def split_points(collection, partitions):
+    '''Return up to 'partitions' - 1 _id values, in order, that divide
+    'collection' into ranges of roughly the same number of entries.'''
+    if partitions <= 1:
+        return []
+    try:
+        points = _split_vector(collection, partitions)
+    except OperationFailure:
+        # splitVector needs the clusterManager role, and isn't there at all
+        # on some servers.
+        points = []
+    if not points:
+        points = _sampled(collection, partitions)
+    return _thin(points, partitions - 1)
+
+
+def id_ranges(points):
+    '''Turn sorted split points into (low, high) pairs covering every _id:
+    low <= _id < high, where None is an open end.'''
+    bounds = [None] + list(points) + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def range_query(query, low, high):
+    '''Restrict 'query' to the _id range [low, high).'''
+    bounds = {}
+    if low is not None:
+        bounds['$gte'] = low
+    if high is not None:
+        bounds['$lt'] = high
+    if not bounds:
+        return query
+    return {'$and': [query, {'_id': bounds}]} if query else {'_id': bounds}
+
+
+# Scanning.
+# .............................................................................
+
+def _open(open_collection):
+    global _collection
+    _collection = open_collection()
+
+
+def scan_range(collection, transform, query, fields, low, high, batch_size):
+    '''Call transform(entry) on each entry of 'collection' matching 'query'
+    in the _id range [low, high), and $set the fields in the dict it
+    returns, if it returns one.  Returns (scanned, modified, errors).'''
+    scanned = 0
+    with BulkUpdater(collection, batch_size) as writer:
+        for entry in collection.find(range_query(query, low, high), fields):
+            scanned += 1
+            updates = transform(entry)
+            if updates:
+                writer.set(entry['_id'], updates)
+    return (scanned, writer.modified, writer.errors)
+
+
+def _scan_range(args):
+    # Runs in a worker process.
+    transform, query, fields, low, high, batch_size = args
+    return scan_range(_collection, transform, query, fields, low, high, batch_size)
+
+
+def parallel_scan(open_collection, transform, query=None, fields=None,
+                  processes=None, batch_size=1000, log=None):
+    '''Apply 'transform' (see scan_range()) to every entry matching 'query'
+    using 'processes' worker processes (default: one per core).
+    'open_collection()' must return a new pymongo Collection; it and
+    'transform' must be module-level functions so that they can be sent to
+    the workers.  'log' is called with progress messages.  Returns
+    (scanned, modified, errors).'''
+    query = query or {}
+    processes = processes or os.cpu_count() or 1
+    log = log or (lambda text: None)
+    collection = open_collection()
+    ranges = id_ranges(split_points(collection, processes*ranges_per_process))
+    log('Scanning {} ranges of _id with {} processes'.format(len(ranges), processes))
+    work = [(transform, query, fields, low, high, batch_size) for low, high in ranges]
+    totals = [0, 0, 0]
+    meter = RateMeter()
+
+    def add(result, done):
+        for i, value in enumerate(result):
+            totals[i] += value
+        meter.add(result[0])
+        log('{}/{} ranges: {} scanned, {} modified, {} errors [{:.0f}/s]'.format(
+            done, len(ranges), totals[0], totals[1], totals[2], meter.overall_rate()))
+
+    if processes == 1:
+        for done, args in enumerate(work, 1):
+            add(scan_range(collection, *args), done)
+    else:
+        with Pool(processes, initializer=_open, initargs=(open_collection,)) as pool:
+            for done, result in enumerate(pool.imap_unordered(_scan_range, work), 1):
+                add(result, done)
+    return tuple(totals)
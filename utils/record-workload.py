@@ -0,0 +1,44 @@
+#!/usr/bin/env python3.4
+#
+# @file    record-workload.py
+# @brief   Run a utility and record the shapes of the queries it makes.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Usage: record-workload.py [-o FILE] SCRIPT [ARGS ...]
+#
+# Runs SCRIPT with ARGS as if it had been started directly, with a pymongo
+# command listener attached that records the shape of every query it
+# makes, and adds them to FILE (default: workload.jsonl) when it exits.
+# Running several utilities this way builds up a picture of the whole
+# workload, which advise-indexes.py then checks against the server.
+
+import os
+import runpy
+import sys
+
+from workload import *
+
+output = 'workload.jsonl'
+args = sys.argv[1:]
+if len(args) >= 2 and args[0] == '-o':
+    output = args[1]
+    args = args[2:]
+if not args:
+    raise SystemExit('Usage: record-workload.py [-o FILE] SCRIPT [ARGS ...]')
+
+script = args[0]
+recorder = record_workload()
+sys.argv = args
+sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+try:
+    runpy.run_path(script, run_name='__main__')
+finally:
+    count = len(recorder.shapes)
+    recorder.save(output)
+    print('{} query shapes recorded in {}'.format(count, output), file=sys.stderr)
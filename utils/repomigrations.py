@@ -0,0 +1,133 @@
+#!/usr/bin/env python3.4
+#
+# @file    repomigrations.py
+# @brief   The migrations of the repos collection, in order.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Each entry below replaces one of the old one-off scripts named in its
+# description, in the order the scripts were run; the scripts are left in
+# place for reference.  Those scripts have all been run on our database,
+# and several of them destroy data if run again (0009 empties content_type
+# values our updaters still write, for example), so the migrations up to
+# and including 'baseline_version' are recorded as applied without being run
+# (migrate.py --baseline) on any database that existed before this list
+# did.  New changes to the format of entries go at the end, with the next
+# version.
+
+from migrations import Migration, Transform, Update
+from pipelines import Either, Field, Reshape
+
+
+# Helpers.
+# .............................................................................
+
+# Values of num_* fields that weren't numbers at all, such as '', by field.
+# They're set to None, which is what we use for "don't know".
+
+unparsable = {}
+
+
+def _number_from_string(field):
+    # Some num_* fields were stored as strings like "1,234".
+    def convert(entry):
+        try:
+            return {field: int(entry[field].replace(',', ''))}
+        except ValueError:
+            unparsable[field] = unparsable.get(field, 0) + 1
+            return {field: None}
+    return Transform({field: {'$type': 2}}, {field: 1}, convert)
+
+
+# Migrations.
+# .............................................................................
+
+# The last version that predates the migration runner.
+
+baseline_version = '0014'
+
+repo_migrations = [
+    Migration('0001', 'single fork field (add-topics-functions-licenses-fields.py)', [
+        Reshape({'is_fork': True},
+                {'fork': {'parent': Either(Field('fork_of'), None),
+                          'root': Either(Field('fork_root'), None)}}),
+        Update({'is_fork': False}, {'$set': {'fork': {'parent': None, 'root': None}}}),
+        Update({}, {'$unset': {'is_fork': 1, 'fork_of': 1, 'fork_root': 1}}),
+    ]),
+    Migration('0002', 'time fields in one place (add-topics-functions-licenses-fields.py)', [
+        Reshape({'created': {'$exists': True}},
+                {'time': {'repo_created': Field('created'),
+                          'repo_modified': None,
+                          'data_refreshed': Field('refreshed')}},
+                unset=['created', 'refreshed']),
+    ]),
+    Migration('0003', 'time.repo_updated and time.repo_pushed (change-time-field-again.py)', [
+        Reshape({'time.repo_modified': {'$exists': True}},
+                {'time': {'repo_created': Field('time.repo_created'),
+                          'repo_updated': None,
+                          'repo_pushed': None,
+                          'data_refreshed': Field('time.data_refreshed')}}),
+    ]),
+    Migration('0004', 'add content_type field (add-content-type-field.py)', [
+        Update({'content_type': {'$exists': False}}, {'$set': {'content_type': ''}}),
+    ]),
+    Migration('0005', 'add files field (add-files-field.py)', [
+        Update({'files': {'$exists': False}}, {'$set': {'files': []}}),
+    ]),
+    Migration('0006', 'add num_* fields (add-num-fields.py)', [
+        Update({'num_commits': {'$exists': False}},
+               {'$set': {'num_commits': None, 'num_releases': None,
+                         'num_branches': None, 'num_contributors': None}}),
+    ]),
+    Migration('0007', 'add notes field (add-notes.py)', [
+        Update({'notes': {'$exists': False}}, {'$set': {'notes': ''}}),
+    ]),
+    Migration('0008', 'blank out placeholder text (fix-blank-fields.py)', [
+        Update({'readme': '-'*2048}, {'$set': {'readme': ''}}),
+        Update({'description': '-'*512}, {'$set': {'description': ''}}),
+    ]),
+    Migration('0009', 'new content_type format (fix-content-type.py)', [
+        Update({'content_type': 'empty'}, {'$set': {'files': -1}}),
+        Update({'files': 'empty'}, {'$set': {'files': -1}}),
+        Update({'content_type': 'empty'}, {'$set': {'content_type': []}}),
+        Update({'content_type': 'nonempty'}, {'$set': {'content_type': []}}),
+        Update({'content_type': 'noncode'},
+               {'$set': {'content_type': [{'content': 'noncode',
+                                           'determined_by': 'languages'}]}}),
+        Update({'content_type': 'code'}, {'$set': {'content_type': []}}),
+    ]),
+    Migration('0010', 'use None for missing fork info (fix-fork.py)', [
+        Update({'fork': {'$ne': False}, 'fork.parent': '', 'fork.root': ''},
+               {'$set': {'fork.parent': None, 'fork.root': None}}),
+    ]),
+    Migration('0011', 'make is_visible consistent (fix-inconsistent-visible-field.py)', [
+        Update({'is_visible': True, 'is_deleted': True},
+               {'$set': {'is_visible': False}}),
+        Update({'is_visible': '', 'is_deleted': False, 'files': {'$ne': []}},
+               {'$set': {'is_visible': True}}),
+        Update({'is_visible': '', 'is_deleted': False, 'readme': {'$nin': [-1, -2, '']}},
+               {'$set': {'is_visible': True}}),
+        Update({'is_visible': '', 'is_deleted': False, 'description': {'$ne': ''}},
+               {'$set': {'is_visible': True}}),
+    ]),
+    Migration('0012', 'fill in missing time fields (fix-missing-repo-updated.py)', [
+        Update({'time.repo_created': {'$exists': False}}, {'$set': {'time.repo_created': ''}}),
+        Update({'time.repo_updated': {'$exists': False}}, {'$set': {'time.repo_updated': ''}}),
+        Update({'time.repo_pushed': {'$exists': False}}, {'$set': {'time.repo_pushed': ''}}),
+        Update({'time.data_refreshed': {'$exists': False}}, {'$set': {'time.data_refreshed': ''}}),
+    ]),
+    Migration('0013', 'empty topics is {lcsh: []} (fix-wrong-empty-topics.py)', [
+        Update({'topics': []}, {'$set': {'topics': {'lcsh': []}}}),
+    ]),
+    Migration('0014', 'num_* fields are numbers (fix-wrong-num-data-type.py)', [
+        _number_from_string('num_commits'),
+        _number_from_string('num_branches'),
+        _number_from_string('num_contributors'),
+        _number_from_string('num_releases'),
+    ]),
+]
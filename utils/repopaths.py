@@ -0,0 +1,161 @@
+#!/usr/bin/env python3.4
+#
+# @file    repopaths.py
+# @brief   Bulk repository path generation and an index of local clones.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Our local clones of repositories live under /srv/repositories, at the
+# path that generate_path() in the common utils computes from the id.
+# Analysis jobs need the paths of millions of ids, and need to know which
+# of them have actually been cloned, and calling generate_path() and then
+# stat() on each one is slow.  This provides
+#
+#   generate_paths()     computes the paths for a whole sequence of ids,
+#                        a chunk at a time.  The work per id is so small
+#                        that handing chunks to other processes costs more
+#                        than it saves, so this is done in-process.
+#
+#   scan_repositories()  finds every clone directory under the root with
+#                        one parallel walk of the directory tree, going only
+#                        to the depths at which generate_path() puts the
+#                        clones.
+#
+#   build_path_index()   combines the two and writes an id -> path index of
+#                        the ids that have clones, in the same memory-mapped
+#                        format as the GHTorrent id index.  Being in the
+#                        index is the existence flag: IdPathIndex tells
+#                        whether an id has a clone and where, without stat().
+#
+# The layout itself is left to generate_path(), which callers pass in, so
+# that it stays defined in one place.
+
+import os
+from array import array
+from functools import partial
+from itertools import chain
+from multiprocessing import Pool
+
+from bulkwriter import windows
+from ghtorrent import IdPathIndex, write_id_index
+
+
+# Globals.
+# .............................................................................
+
+default_root = '/srv/repositories'
+
+
+# Generating paths.
+# .............................................................................
+
+def generate_paths(generate_path, ids, root=default_root, chunk_size=100000):
+    '''Yield (id, path) for each id in 'ids' (any iterable of ints, such as
+    an array), in order, computing the paths 'chunk_size' ids at a time.'''
+    path_of = partial(generate_path, root)
+    for chunk in windows(ids, chunk_size):
+        yield from zip(chunk, map(os.path.normpath, map(path_of, chunk)))
+
+
+# Scanning the directory tree.
+# .............................................................................
+
+def clone_depths(generate_path, ids=None, root=default_root):
+    '''Return the set of directory levels below 'root' at which
+    generate_path() puts the clones of 'ids'.  Without 'ids', ids of every
+    length from 1 to 12 digits are tried, since a layout may well depend
+    on the size of the id.'''
+    if ids is None:
+        ids = chain.from_iterable((10**n, 10**(n + 1) - 1) for n in range(12))
+    root = os.path.normpath(root)
+    return {len(os.path.relpath(path, root).split(os.sep))
+            for _, path in generate_paths(generate_path, ids, root)}
+
+
+def _subdirs(path):
+    # os.scandir() would save the stat() calls, but it needs Python 3.5.
+    try:
+        names = os.listdir(path)
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+    paths = [os.path.join(path, name) for name in names]
+    return [p for p in paths if os.path.isdir(p) and not os.path.islink(p)]
+
+
+def _scan_dir(args):
+    # Runs in a worker process.  Returns the directories below 'path' that
+    # are any of 'levels' levels down.
+    path, levels = args
+    found = []
+    dirs = [path]
+    for level in range(1, max(levels) + 1):
+        dirs = list(chain.from_iterable(_subdirs(d) for d in dirs))
+        if level in levels:
+            found += dirs
+    return found
+
+
+def scan_repositories(root=default_root, depths=1, processes=None):
+    '''Return the set of directories below 'root' that are any of 'depths'
+    (a number, or a set of them) levels down.  The subtrees of the
+    top-level directories are walked in parallel.'''
+    root = os.path.normpath(root)
+    depths = {depths} if isinstance(depths, int) else set(depths)
+    found = set(_subdirs(root)) if 1 in depths else set()
+    deeper = {depth - 1 for depth in depths if depth > 1}
+    if not deeper:
+        return found
+    work = [(top, deeper) for top in _subdirs(root)]
+    with Pool(processes) as pool:
+        for dirs in pool.imap_unordered(_scan_dir, work):
+            found.update(dirs)
+    return found
+
+
+# The index.
+# .............................................................................
+
+def _clone_ids(clones):
+    # Candidate ids for a scan with no list of ids: the clone directories
+    # are named after the id, if the layout is anything like sensible.
+    for path in clones:
+        name = os.path.basename(path)
+        if name.isdigit():
+            yield int(name)
+
+
+def build_path_index(generate_path, index_file, ids=None, root=default_root,
+                     processes=None):
+    '''Scan 'root' for clones and write 'index_file' mapping the ids that
+    have one to their paths.  If 'ids' is None, the ids are taken from the
+    names of the clone directories; otherwise only those ids are checked.
+    Either way, a clone only counts if it is where generate_path() says it
+    should be.  Returns (ids checked, ids with clones).'''
+    if ids is not None and not hasattr(ids, '__len__'):
+        # They are gone through twice, once for the depths to scan.
+        ids = array('q', ids)
+    depths = clone_depths(generate_path, ids, root)
+    clones = scan_repositories(root, depths, processes)
+    if ids is None:
+        ids = sorted(_clone_ids(clones))
+    checked = [0]
+
+    def existing():
+        for id, path in generate_paths(generate_path, ids, root):
+            checked[0] += 1
+            if path in clones:
+                yield (id, path)
+
+    count = write_id_index(existing(), index_file)
+    return (checked[0], count)
+
+
+def open_path_index(index_file):
+    '''Open an index written by build_path_index().  'id in index' tells
+    whether there is a clone, and index.get(id) gives its path.'''
+    return IdPathIndex(index_file)
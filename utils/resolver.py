@@ -0,0 +1,292 @@
+#!/usr/bin/env python3.4
+#
+# @file    resolver.py
+# @brief   Map outside repository ids and paths to our own entries.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Every source we ingest (GHTorrent, githubarchive.org) names repositories
+# by an id and an owner/name path, and every ingest script has to work out
+# which of our entries that is: first by id, because that's more invariant
+# than the name of the repo, then by owner/name, and if it was found only by
+# name, report the mismatch.  RepoResolver does that for a batch of
+# repositories at a time, with at most one id query and one path query per
+# batch, and remembers the answers in bounded LRU caches in both directions
+# so that repositories that come up again and again cost nothing after the
+# first time.
+
+from collections import OrderedDict, namedtuple
+
+from bulkwriter import find_by_ids, find_by_paths
+
+
+# Globals.
+# .............................................................................
+
+# How a repository was found.
+
+BY_ID   = 'id'
+BY_PATH = 'path'
+UNKNOWN = 'unknown'
+
+# Pass this as the 'fields' to RepoResolver.resolve_many() to get whole
+# entries.
+
+ALL_FIELDS = 'all'
+
+# The default for RepoResolver's 'snapshot': use the snapshot file named by
+# the CASICS_SNAPSHOT environment variable, if any.  See snapshot.py.
+
+DEFAULT_SNAPSHOT = 'default'
+
+# Marks cache entries for things we looked up and know we don't have.
+
+_ABSENT = object()
+
+
+# Results.
+# .............................................................................
+
+class Match(namedtuple('Match', 'id owner name how our_id our_owner our_name')):
+    '''The result of resolving one repository.  'id', 'owner' and 'name' are
+    what we were asked about; 'how' is BY_ID, BY_PATH or UNKNOWN; and the
+    'our_' fields identify our entry, or are None if it is unknown.'''
+
+    __slots__ = ()
+
+    @property
+    def found(self):
+        return self.how != UNKNOWN
+
+    @property
+    def mismatch(self):
+        '''True if the outside id was given but we know the repository
+        under a different one.'''
+        return self.how == BY_PATH and bool(self.id) and self.id != self.our_id
+
+    @property
+    def renamed(self):
+        '''True if we found the id but know it under a different path.'''
+        return self.how == BY_ID and (self.owner, self.name) != (self.our_owner, self.our_name)
+
+    def describe(self):
+        path = '{}/{}'.format(self.owner, self.name)
+        if not self.found:
+            return 'unknown {} (#{})'.format(path, self.id)
+        if self.mismatch:
+            return 'mismatch: their {} (#{}) is our {}/{} (#{})'.format(
+                path, self.id, self.our_owner, self.our_name, self.our_id)
+        return '{} (#{})'.format(path, self.our_id)
+
+
+def _projection(fields):
+    if fields is ALL_FIELDS:
+        return None
+    return dict(fields or {}, owner=1, name=1)
+
+
+# Caching.
+# .............................................................................
+
+class LRUCache():
+    '''A dict with at most 'size' entries, evicting the least recently used
+    one when full.  get() and put() count as uses.'''
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+
+# Resolving.
+# .............................................................................
+
+class RepoResolver():
+    '''Resolves (id, owner, name) triples to our entries in 'collection'.
+
+    resolve_many() takes a list of triples (the id may be None) and returns
+    a list of Match tuples in the same order.  Answers are cached, up to
+    'cache_size' in each direction, including negative ones; everything not
+    in the caches is looked up with one $in query on the ids and one $or
+    query on the paths of those not found by id.
+
+    If 'fields' is given to resolve_many(), it also returns a dict mapping
+    our ids to entries with those fields, or whole entries if 'fields' is
+    ALL_FIELDS.  Fields are not cached, since they
+    are what we're about to change, so that costs one more query for the
+    repositories that were resolved from the cache.
+
+    If an IdentitySnapshot is given as 'snapshot' (by default, the one
+    named by the CASICS_SNAPSHOT environment variable, if set), identities
+    are looked up in it before going to the database.  Pass None to turn
+    that off.
+
+    If 'on_mismatch' or 'on_unknown' is given, it is called with the Match
+    for each repository that was found only by path under a different id,
+    or not found at all.  The counters 'hits', 'misses', 'queries',
+    'mismatches' and 'unknown' tell how things went.'''
+
+    def __init__(self, collection, cache_size=1000000,
+                 on_mismatch=None, on_unknown=None, snapshot=DEFAULT_SNAPSHOT):
+        if snapshot is DEFAULT_SNAPSHOT:
+            # Imported here because snapshot.py needs ghtorrent.py, which
+            # needs this module.
+            from snapshot import default_snapshot
+            snapshot = default_snapshot()
+        self.collection  = collection
+        self.snapshot    = snapshot
+        self.by_id       = LRUCache(cache_size)
+        self.by_path     = LRUCache(cache_size)
+        self.on_mismatch = on_mismatch
+        self.on_unknown  = on_unknown
+        self.hits        = 0
+        self.misses      = 0
+        self.queries     = 0
+        self.mismatches  = 0
+        self.unknown     = 0
+
+    def _remember(self, id, owner, name):
+        self.by_id.put(id, (owner, name))
+        self.by_path.put((owner, name), id)
+
+    def _cached(self, id, owner, name):
+        # Returns a Match, or None if we have to ask the database.  Things
+        # found in the snapshot are moved into the caches, but things not
+        # found there may simply be newer than the snapshot.
+        if id:
+            ours = self.by_id.get(id)
+            if ours is None and self.snapshot is not None:
+                ours = self.snapshot.owner_name(id)
+                if ours is not None:
+                    self._remember(id, ours[0], ours[1])
+            if ours is None:
+                return None
+            if ours is not _ABSENT:
+                return Match(id, owner, name, BY_ID, id, ours[0], ours[1])
+        our_id = self.by_path.get((owner, name))
+        if our_id is None and self.snapshot is not None:
+            our_id = self.snapshot.find_path(owner, name)
+            if our_id is not None:
+                ours = self.snapshot.owner_name(our_id)
+                self._remember(our_id, ours[0], ours[1])
+                return Match(id, owner, name, BY_PATH, our_id, ours[0], ours[1])
+        if our_id is None:
+            return None
+        if our_id is _ABSENT:
+            return Match(id, owner, name, UNKNOWN, None, None, None)
+        return Match(id, owner, name, BY_PATH, our_id, owner, name)
+
+    def _lookup(self, misses, fields):
+        # Returns (matches, entries) for the misses, where entries is a dict
+        # of the entries found, keyed by our id.
+        fields = _projection(fields)
+        ids = {id for id, _, _ in misses if id and self.by_id.get(id) is not _ABSENT}
+        by_id = find_by_ids(self.collection, ids, fields)
+        if ids:
+            self.queries += 1
+        paths = {(owner, name) for id, owner, name in misses if id not in by_id}
+        by_path = find_by_paths(self.collection, list(paths), fields)
+        if paths:
+            self.queries += 1
+        for id in ids:
+            if id not in by_id:
+                self.by_id.put(id, _ABSENT)
+        for path in paths:
+            if path not in by_path:
+                self.by_path.put(path, _ABSENT)
+        entries = {}
+        matches = []
+        for id, owner, name in misses:
+            entry = by_id.get(id) if id else None
+            how = BY_ID
+            if not entry:
+                entry = by_path.get((owner, name))
+                how = BY_PATH
+            if not entry:
+                matches.append(Match(id, owner, name, UNKNOWN, None, None, None))
+                continue
+            self._remember(entry['_id'], entry['owner'], entry['name'])
+            entries[entry['_id']] = entry
+            matches.append(Match(id, owner, name, how, entry['_id'],
+                                 entry['owner'], entry['name']))
+        return (matches, entries)
+
+    def resolve_many(self, repos, fields=None):
+        matches = [self._cached(id, owner, name) for id, owner, name in repos]
+        misses = [repo for repo, match in zip(repos, matches) if match is None]
+        self.misses += len(misses)
+        self.hits += len(repos) - len(misses)
+        entries = {}
+        if misses:
+            looked_up, entries = self._lookup(misses, fields)
+            looked_up = iter(looked_up)
+            matches = [m if m is not None else next(looked_up) for m in matches]
+        for match in matches:
+            if not match.found:
+                self.unknown += 1
+                if self.on_unknown:
+                    self.on_unknown(match)
+            elif match.mismatch:
+                self.mismatches += 1
+                if self.on_mismatch:
+                    self.on_mismatch(match)
+        if fields is None:
+            return matches
+        wanted = {m.our_id for m in matches if m.found and m.our_id not in entries}
+        if wanted:
+            entries.update(find_by_ids(self.collection, wanted, _projection(fields)))
+            self.queries += 1
+        return (matches, entries)
+
+    def resolve(self, id, owner, name, fields=None):
+        '''Resolve a single repository.  Returns a Match, or (Match, entry)
+        if 'fields' is given.'''
+        result = self.resolve_many([(id, owner, name)], fields)
+        if fields is None:
+            return result[0]
+        match = result[0][0]
+        return (match, result[1].get(match.our_id))
+
+    def forget(self, id=None, owner=None, name=None):
+        '''Drop what we know about a repository, e.g. after adding it.'''
+        if id:
+            ours = self.by_id.pop(id)
+            if ours is not None and ours is not _ABSENT:
+                self.by_path.pop(ours)
+        if owner and name:
+            self.by_path.pop((owner, name))
+
+    def counts(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'queries': self.queries, 'mismatches': self.mismatches,
+                'unknown': self.unknown}
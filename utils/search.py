@@ -0,0 +1,108 @@
+#!/usr/bin/env python3.4
+#
+# @file    search.py
+# @brief   Search descriptions and readmes with the text index.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# find-in-description.py used to search with a case-insensitive $regex on
+# the description field.  No index can serve that, so every search read
+# all 25 million entries.  The repos collection has a text index on
+# description and readme (see casicsdb/indexes.py), and a $text query
+# finds the entries containing a word by looking it up in that index.
+#
+# search() sends plain terms (words, possibly several, with no regular
+# expression syntax) through $text as a phrase.  Because the index covers
+# both fields, it adds a $regex for the phrase on the requested field, which
+# the server applies only to the entries the index found.  Results are
+# sorted by text score and returned a page at a time.  A term that uses
+# regular expression syntax, or a search with regex=True, falls back to
+# the $regex scan, as does a search when the server has no text index.
+# The result says which way was used, why and how long it took.
+#
+# The text index matches whole words (after stemming), so 'learn' finds
+# 'learning' but 'lear' doesn't.  Use regex=True to find parts of words.
+
+import re
+from collections import namedtuple
+from time import time
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+
+# Globals.
+# .............................................................................
+
+BY_TEXT  = 'text'
+BY_REGEX = 'regex'
+
+# Terms made of these characters can go through the text index.
+
+_plain_term = re.compile(r"^[\w\s'-]+$")
+
+
+# Searching.
+# .............................................................................
+
+class SearchResult(namedtuple('SearchResult', 'entries path reason seconds')):
+    '''The 'entries' found, the 'path' used (BY_TEXT or BY_REGEX), the
+    'reason' for falling back to BY_REGEX if it was used, and how many
+    seconds the search took.'''
+    __slots__ = ()
+
+
+def is_plain(term):
+    '''True if 'term' is just words, which the text index can find.'''
+    return bool(_plain_term.match(term)) and bool(term.strip())
+
+
+def _text_search(collection, term, field, fields, skip, limit):
+    words = term.split()
+    query = {'$text': {'$search': '"{}"'.format(' '.join(words))}}
+    if field:
+        phrase = r'\s+'.join(re.escape(word) for word in words)
+        query[field] = {'$regex': re.compile(phrase, re.IGNORECASE)}
+    projection = dict(fields or {}, score={'$meta': 'textScore'})
+    cursor = collection.find(query, projection, sort=[('score', {'$meta': 'textScore'})],
+                             skip=skip, limit=limit)
+    return list(cursor)
+
+
+def _regex_search(collection, term, field, fields, skip, limit):
+    query = {field or 'description': {'$regex': re.compile(term, re.IGNORECASE)}}
+    cursor = collection.find(query, fields, sort=[('_id', ASCENDING)],
+                             skip=skip, limit=limit)
+    return list(cursor)
+
+
+def search(collection, term, field='description', fields=None, page=1,
+           page_size=100, regex=False):
+    '''Find the entries of 'collection' whose 'field' (description or
+    readme) contains 'term', case-insensitively, and return a
+    SearchResult with page number 'page' (starting at 1) of them, with
+    'page_size' entries per page; a 'page_size' of 0 returns them all.
+    'fields' is the projection for the entries.  Uses the text index
+    unless 'regex' is true or the term isn't plain words.'''
+    skip = (page - 1)*page_size if page_size else 0
+    start = time()
+    if regex:
+        reason = 'regex search requested'
+    elif not is_plain(term):
+        reason = 'term is not plain words'
+    else:
+        try:
+            entries = _text_search(collection, term, field, fields, skip, page_size)
+            return SearchResult(entries, BY_TEXT, None, time() - start)
+        except OperationFailure as err:
+            # Error 27 (IndexNotFound) means there is no text index.
+            if getattr(err, 'code', None) != 27:
+                raise
+            reason = 'no text index'
+    entries = _regex_search(collection, term, field, fields, skip, page_size)
+    return SearchResult(entries, BY_REGEX, reason, time() - start)
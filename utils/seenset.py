@@ -0,0 +1,254 @@
+#!/usr/bin/env python3.4
+#
+# @file    seenset.py
+# @brief   Sets of strings for deduplication that use a bounded amount of memory.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Scripts that read event streams remember the owner/name paths they have
+# already handled in a set() so that each repository is only handled once.
+# A Python set of strings costs around 100 bytes per path, and over a year
+# of githubarchive files that's tens of millions of paths.  The classes
+# here do the same job in a fixed memory budget, at the cost of a small and
+# measurable chance of error:
+#
+#   FingerprintSet  keeps a 64-bit hash of each string in a flat table, 8-11
+#                   bytes per string.  False positives are practically
+#                   impossible (about n/2^64), but once the table has used up
+#                   its budget, new strings are no longer remembered, so
+#                   they may be handled again.
+#
+#   BloomFilter     uses a fixed bit array.  It never forgets, but the rate
+#                   of false positives (strings wrongly reported as seen, and
+#                   so skipped) rises as it fills up.
+#
+# All of them have the same interface: add(key) remembers 'key' and returns
+# True if it was already there, and 'key in seen' tests without adding.
+
+import math
+import sys
+from array import array
+from hashlib import md5
+from random import getrandbits
+
+
+# Globals.
+# .............................................................................
+
+# The kinds of sets that make_seen_set() can create.
+
+seen_set_kinds = ['set', 'fingerprint', 'bloom']
+
+_MAX_LOAD = 0.75
+
+
+# Helpers.
+# .............................................................................
+
+def _hash(key, size):
+    # Returns the first 'size' bytes (at most 16) of a hash of 'key' as an
+    # int.  md5 is not used for security here, only for mixing.
+    return int.from_bytes(md5(key.encode('utf-8')).digest()[:size], 'little')
+
+
+# Exact set.
+# .............................................................................
+
+class PlainSeenSet():
+    '''A set() with the seen-set interface, for comparison.'''
+
+    def __init__(self):
+        self._set = set()
+        self.key_bytes = 0
+
+    def add(self, key):
+        if key in self._set:
+            return True
+        self._set.add(key)
+        self.key_bytes += sys.getsizeof(key)
+        return False
+
+    def __contains__(self, key):
+        return key in self._set
+
+    def __len__(self):
+        return len(self._set)
+
+    def nbytes(self):
+        return sys.getsizeof(self._set) + self.key_bytes
+
+    def estimated_false_positive_rate(self):
+        return 0.0
+
+
+# Fingerprints.
+# .............................................................................
+
+class FingerprintSet():
+    '''An open-addressing hash table of 64-bit fingerprints.  The table
+    doubles as it fills, but never beyond 'max_bytes'; once it can't grow,
+    new keys are counted in 'overflow' but not stored.'''
+
+    def __init__(self, max_bytes=256*2**20, initial_slots=2**16):
+        self.max_slots = max(8, 2**int(math.log2(max(8, max_bytes // 8))))
+        slots = min(self.max_slots, 2**int(math.log2(max(8, initial_slots))))
+        self._table = array('Q', bytes(8*slots))
+        self._mask = slots - 1
+        self._count = 0
+        self.overflow = 0
+        self.key_bytes = 0
+
+    def _slot(self, fp):
+        table = self._table
+        mask = self._mask
+        i = fp & mask
+        while True:
+            value = table[i]
+            if value == 0 or value == fp:
+                return i
+            i = (i + 1) & mask
+
+    def _grow(self):
+        old = self._table
+        self._table = array('Q', bytes(8*2*len(old)))
+        self._mask = len(self._table) - 1
+        for fp in old:
+            if fp:
+                self._table[self._slot(fp)] = fp
+
+    def _fingerprint(self, key):
+        # 0 marks an empty slot, so it can't be a fingerprint.
+        return _hash(key, 8) or 1
+
+    def add(self, key):
+        fp = self._fingerprint(key)
+        i = self._slot(fp)
+        if self._table[i] == fp:
+            return True
+        if self._count + 1 > _MAX_LOAD*len(self._table):
+            if len(self._table) >= self.max_slots:
+                self.overflow += 1
+                return False
+            self._grow()
+            i = self._slot(fp)
+        self._table[i] = fp
+        self._count += 1
+        self.key_bytes += sys.getsizeof(key)
+        return False
+
+    def __contains__(self, key):
+        fp = self._fingerprint(key)
+        return self._table[self._slot(fp)] == fp
+
+    def __len__(self):
+        return self._count
+
+    def nbytes(self):
+        return len(self._table)*self._table.itemsize
+
+    def estimated_false_positive_rate(self):
+        # Chance that a new key's fingerprint equals one of the stored ones.
+        return self._count/2.0**64
+
+
+# Bloom filter.
+# .............................................................................
+
+class BloomFilter():
+    '''A Bloom filter of 'max_bytes' bytes, with the number of hash
+    functions chosen to be best when it holds 'capacity' keys, up to
+    'max_hashes'.  More than that costs time and gains little.'''
+
+    def __init__(self, max_bytes=64*2**20, capacity=50000000, max_hashes=12):
+        self._bits = bytearray(max(1, max_bytes))
+        self._nbits = 8*len(self._bits)
+        best = round(self._nbits/max(1, capacity)*math.log(2))
+        self.hashes = max(1, min(max_hashes, best))
+        self._count = 0
+        self.key_bytes = 0
+
+    def _positions(self, key):
+        # Double hashing: the i'th position is h1 + i*h2.
+        h = _hash(key, 16)
+        h1 = h & 0xffffffffffffffff
+        h2 = (h >> 64) | 1
+        return [(h1 + i*h2) % self._nbits for i in range(self.hashes)]
+
+    def add(self, key):
+        bits = self._bits
+        seen = True
+        for pos in self._positions(key):
+            byte, bit = pos >> 3, 1 << (pos & 7)
+            if not bits[byte] & bit:
+                seen = False
+                bits[byte] |= bit
+        if not seen:
+            self._count += 1
+            self.key_bytes += sys.getsizeof(key)
+        return seen
+
+    def __contains__(self, key):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def __len__(self):
+        return self._count
+
+    def nbytes(self):
+        return len(self._bits)
+
+    def estimated_false_positive_rate(self):
+        return (1 - math.exp(-self.hashes*self._count/self._nbits))**self.hashes
+
+
+# Utilities.
+# .............................................................................
+
+def make_seen_set(kind='fingerprint', max_bytes=256*2**20, capacity=50000000):
+    '''Create a seen-set of the given kind (one of 'seen_set_kinds').'''
+    if kind == 'set':
+        return PlainSeenSet()
+    elif kind == 'fingerprint':
+        return FingerprintSet(max_bytes)
+    elif kind == 'bloom':
+        return BloomFilter(max_bytes, capacity)
+    raise ValueError('Unknown kind of seen-set: {}'.format(kind))
+
+
+def measure_false_positive_rate(seen, trials=100000):
+    '''Probe 'seen' with random keys that were never added and return the
+    fraction it claims to have seen.'''
+    # Real keys are owner/name paths, which can't contain a space.
+    hits = sum(1 for _ in range(trials)
+               if 'probe {:x}'.format(getrandbits(64)) in seen)
+    return hits/trials
+
+
+def set_nbytes_estimate(seen):
+    '''Estimate how many bytes a set() holding the same keys would take.'''
+    # CPython sets keep their table at most 60% full, with 16 bytes per
+    # slot, on top of the string objects themselves.
+    count = len(seen)
+    slots = 8
+    while slots*3 < count*5:
+        slots *= 4 if count < 50000 else 2
+    return sys.getsizeof(set()) + 16*slots + seen.key_bytes
+
+
+def seen_set_report(seen, trials=100000):
+    '''Return a one-line summary of the memory used by 'seen', compared to
+    a set(), and its measured false-positive rate.'''
+    used = seen.nbytes()
+    plain = seen.nbytes() if isinstance(seen, PlainSeenSet) else set_nbytes_estimate(seen)
+    overflow = getattr(seen, 'overflow', 0)
+    return ('{} paths in {:.1f} MB ({:.1f} MB as a set()), measured false '
+            'positive rate {:.2g} (estimated {:.2g}){}'.format(
+                len(seen), used/2**20, plain/2**20,
+                measure_false_positive_rate(seen, trials),
+                seen.estimated_false_positive_rate(),
+                ', {} not remembered'.format(overflow) if overflow else ''))
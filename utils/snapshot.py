@@ -0,0 +1,247 @@
+#!/usr/bin/env python3.4
+#
+# @file    snapshot.py
+# @brief   Memory-mapped snapshot of repository ids and owner/name paths.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Bulk jobs spend much of their time asking the database which of our
+# entries an id or an owner/name path refers to.  The answers change
+# rarely, so this writes the _id, owner and name of every entry to a file
+# once, and lets jobs memory-map it and answer those questions locally.
+#
+# The file holds the same id-sorted arrays as the GHTorrent id index (see
+# IdPathMap in ghtorrent.py), plus a second array of positions sorted by
+# lowercased path, which keeps paths that differ only in case together.
+# find_path() still only matches a path exactly, as find_by_paths() does in
+# the database, so that a lookup gives the same answer whether or not a
+# snapshot is in use.  The file also records the newest time.data_refreshed
+# value it has seen, so that refresh_snapshot() can fetch only the entries
+# touched since then using the time.data_refreshed index, instead of
+# exporting everything again.
+#
+# Jobs opt in by setting the environment variable CASICS_SNAPSHOT to the
+# path of the file; RepoResolver then consults the snapshot before going to
+# the database.  Entries that are not in the snapshot are still looked up
+# in the database, so a stale snapshot only costs queries, but entries that
+# were deleted or renamed without touching their refresh time are not
+# noticed until the snapshot is rebuilt with export_snapshot().
+
+import mmap
+import os
+import pickle
+import struct
+from array import array
+
+from pymongo import ASCENDING
+
+from extsort import external_sort
+from ghtorrent import IdPathMap, _sorted_id_map
+
+
+# Globals.
+# .............................................................................
+
+_SNAPSHOT_MAGIC = b'CASSNP01'
+_BYTE_ORDER     = 0x0102030405060708
+_HEADER         = struct.Struct('=8sQQQQ')
+_ITEM_SIZE      = 8
+
+# The environment variable that names the snapshot file to use by default.
+
+snapshot_variable = 'CASICS_SNAPSHOT'
+
+
+# Writing.
+# .............................................................................
+
+def _later(a, b):
+    # time.data_refreshed is sometimes '' or missing; those never win.
+    if b in (None, ''):
+        return a
+    if a in (None, ''):
+        return b
+    try:
+        return b if b > a else a
+    except TypeError:
+        return a
+
+
+def _write(ids, offsets, arena, snapshot_file, refreshed, run_size):
+    keys = ((bytes(arena[offsets[i]:offsets[i + 1]]).lower(), i)
+            for i in range(len(ids)))
+    by_path = array('Q', (i for _, i in external_sort(keys, run_size)))
+    meta = pickle.dumps({'refreshed': refreshed}, pickle.HIGHEST_PROTOCOL)
+    tmp_file = snapshot_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(_HEADER.pack(_SNAPSHOT_MAGIC, _BYTE_ORDER, len(ids), len(arena),
+                             len(meta)))
+        f.write(ids.tobytes())
+        f.write(offsets.tobytes())
+        f.write(by_path.tobytes())
+        f.write(arena)
+        f.write(meta)
+    # Readers that already have the old file mapped keep seeing it.
+    os.replace(tmp_file, snapshot_file)
+    return len(ids)
+
+
+def write_snapshot(pairs, snapshot_file, refreshed=None, run_size=1000000):
+    '''Write a snapshot file from an iterable of (id, 'owner/name') pairs.
+    'refreshed' is the newest time.data_refreshed value they reflect.
+    Returns the number of entries written.'''
+    return _write(*_sorted_id_map(pairs), snapshot_file, refreshed, run_size)
+
+
+def _entry_pairs(cursor, watermark):
+    # Yields (id, path) pairs and records the newest refresh time seen in
+    # watermark[0].
+    for entry in cursor:
+        refreshed = entry.get('time', {}).get('data_refreshed')
+        watermark[0] = _later(watermark[0], refreshed)
+        yield (entry['_id'], entry['owner'] + '/' + entry['name'])
+
+
+def export_snapshot(collection, snapshot_file, run_size=1000000):
+    '''Write the id, owner and name of every entry in 'collection' to
+    'snapshot_file'.  Returns the number of entries written.'''
+    fields = {'owner': 1, 'name': 1, 'time.data_refreshed': 1}
+    cursor = collection.find({}, fields, no_cursor_timeout=True,
+                             sort=[('_id', ASCENDING)])
+    watermark = [None]
+    try:
+        ids, offsets, arena = _sorted_id_map(_entry_pairs(cursor, watermark))
+    finally:
+        cursor.close()
+    return _write(ids, offsets, arena, snapshot_file, watermark[0], run_size)
+
+
+def _merge_changes(old, changes):
+    # Both are sorted by id; a change replaces the old entry with its id.
+    changes = iter(changes)
+    change = next(changes, None)
+    for id, path in old.items():
+        while change is not None and change[0] < id:
+            yield change
+            change = next(changes, None)
+        if change is not None and change[0] == id:
+            yield change
+            change = next(changes, None)
+        else:
+            yield (id, path)
+    while change is not None:
+        yield change
+        change = next(changes, None)
+
+
+def refresh_snapshot(collection, snapshot_file, run_size=1000000):
+    '''Bring 'snapshot_file' up to date with the entries in 'collection'
+    whose time.data_refreshed is no older than the newest one in the
+    snapshot.  Returns the number of entries fetched.'''
+    with IdentitySnapshot(snapshot_file) as old:
+        watermark = [old.refreshed]
+        if watermark[0] in (None, ''):
+            return export_snapshot(collection, snapshot_file, run_size)
+        fields = {'owner': 1, 'name': 1, 'time.data_refreshed': 1}
+        query = {'time.data_refreshed': {'$gte': old.refreshed}}
+        changes = sorted(_entry_pairs(collection.find(query, fields), watermark))
+        ids, offsets, arena = _sorted_id_map(_merge_changes(old, changes))
+    _write(ids, offsets, arena, snapshot_file, watermark[0], run_size)
+    return len(changes)
+
+
+# Reading.
+# .............................................................................
+
+class IdentitySnapshot(IdPathMap):
+    '''A memory-mapped snapshot of our entries' ids and paths.  As a
+    mapping, it maps ids to 'owner/name' paths; owner_name() splits them,
+    and find_path() goes the other way.'''
+
+    def __init__(self, snapshot_file):
+        self.file  = snapshot_file
+        self._file = open(snapshot_file, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, order, count, arena_size, meta_size = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _SNAPSHOT_MAGIC or order != _BYTE_ORDER:
+            self.close()
+            raise ValueError('{} is not a CASICS snapshot for this machine'
+                             .format(snapshot_file))
+        view = memoryview(self._mmap)
+        ids_start   = _HEADER.size
+        off_start   = ids_start + count*_ITEM_SIZE
+        path_start  = off_start + (count + 1)*_ITEM_SIZE
+        arena_start = path_start + count*_ITEM_SIZE
+        meta_start  = arena_start + arena_size
+        self._by_path = view[path_start:arena_start].cast('Q')
+        meta = pickle.loads(self._mmap[meta_start:meta_start + meta_size])
+        self.refreshed = meta['refreshed']
+        super().__init__(view[ids_start:off_start].cast('q'),
+                         view[off_start:path_start].cast('Q'),
+                         view[arena_start:meta_start])
+
+    def nbytes(self):
+        return super().nbytes() + len(self._by_path)*_ITEM_SIZE
+
+    def _key(self, n):
+        i = self._by_path[n]
+        return bytes(self._arena[self._offsets[i]:self._offsets[i + 1]]).lower()
+
+    def owner_name(self, id):
+        '''Return our (owner, name) for 'id', or None.'''
+        path = self.get(id)
+        if path is None:
+            return None
+        slash = path.find('/')
+        return (path[:slash], path[slash + 1:])
+
+    def find_path(self, owner, name):
+        '''Return the id of our entry for owner/name, or None.  The case
+        must match exactly, as in find_by_paths().'''
+        path = owner + '/' + name
+        # GitHub owner and repository names are ASCII, so bytes.lower() is
+        # all the case folding we need.
+        key = path.encode('utf-8').lower()
+        lo, hi = 0, len(self._by_path)
+        while lo < hi:
+            mid = (lo + hi)//2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < len(self._by_path) and self._key(lo) == key:
+            i = self._by_path[lo]
+            if self._path(i) == path:
+                return self._ids[i]
+            lo += 1
+        return None
+
+    def close(self):
+        self._ids = self._offsets = self._arena = self._by_path = None
+        if getattr(self, '_mmap', None) is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass                    # Someone still holds a view.
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def default_snapshot():
+    '''Open the snapshot named by the CASICS_SNAPSHOT environment variable.
+    Returns None if it isn't set.'''
+    snapshot_file = os.environ.get(snapshot_variable)
+    if not snapshot_file:
+        return None
+    return IdentitySnapshot(snapshot_file)
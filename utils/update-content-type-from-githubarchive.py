@@ -1,7 +1,7 @@
 #!/usr/bin/env python3.4
 #
-# @file    add-from-ghtorrent-dump.py
-# @brief   Add entries from a GHTorrent MongoDB database dump.
+# @file    update-content-type-from-githubarchive.py
+# @brief   Mark repos nonempty using a githubarchive.org event file.
 # @author  Michael Hucka
 #
 # <!---------------------------------------------------------------------------
@@ -22,8 +22,6 @@ import csv
 import http
 import requests
 import urllib
-import gzip
-import json
 from datetime import datetime
 from time import time, sleep
 from pymongo import MongoClient
@@ -31,6 +29,9 @@ from pymongo import MongoClient
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
 from casicsdb import *
+from bulkwriter import *
+from githubarchive import *
+from resolver import *
 
 
 # Helpers
@@ -59,89 +60,57 @@ casicsdb = CasicsDB()
 github_db = casicsdb.open('github')
 repos = github_db.repos
 
+batch_size = 1000
+cache_size = 1000000
+
 input = sys.argv[1]
 msg('Opening file {}'.format(input))
 
-root = 'https://api.github.com/repos/'
-root_len = len(root)
+msg('Using {} for JSON decoding'.format(json_backend))
 
-done = set()
-with gzip.open(input, 'r') as f:
-    count = 0
-    start = time()
-    for line in f:
-        contents = json.loads(line.decode('ascii', 'ignore'))
+# Releases and forks can only happen in repos that have content.
 
-        if contents['type'] != 'ReleaseEvent' and contents['type'] != 'ForkEvent':
-            continue
+# Events are resolved to our entries a window at a time, and the resolver
+# remembers the repositories it has seen, so that popular repositories
+# with many releases or forks are only looked up once.
 
-        id = None
-        entry = None
-        owner = None
-        name = None
-        path = None
-        if 'repository' in contents:
-            repo  = contents['repository']
-            owner = repo['owner']
-            name  = repo['name']
-            path  = owner + '/' + name
-            id    = repo['id']
-        elif 'repo' in contents:
-            repo  = contents['repo']
-            if 'id' not in repo:
-                msg('*** ignoring bad content: {}'.format(contents))
-                continue
-            path  = repo['name']
-            owner = path[:path.find('/')]
-            name  = path[path.find('/') + 1 :]
-            id    = repo['id']
-        elif 'payload' in contents:
-            payload = contents['payload']
-            if not payload:
-                msg('*** empty payload in contents: {}'.format(contents))
-                continue
-            elif 'release' in payload:
-                url = payload['release']['url']
-                url = url[root_len: ]
-                owner = url[: url.find('/')]
-                name = url[url.find('/') + 1 : url.find('/releases')]
-            else:
-                msg('problem 1')
-                import ipdb; ipdb.set_trace()
-        else:
-            msg('problem 2')
-            import ipdb; ipdb.set_trace()
-
-
-        if owner == '' or name == '':
-            msg('*** ignoring bad path {}/{}'.format(owner, name))
-            continue
-
-        fields = {'owner': 1, 'name': 1, 'content_type': 1, 'is_visible':1, 'is_deleted':1}
-        if id:
-            entry = repos.find_one({'_id': id}, fields)
+fields = {'owner': 1, 'name': 1, 'content_type': 1, 'is_visible':1, 'is_deleted':1}
+resolver = RepoResolver(repos, cache_size=cache_size,
+                        on_mismatch=lambda match: msg('*** ' + match.describe()))
+decoder = EventDecoder(['ReleaseEvent', 'ForkEvent'])
+count = 0
+start = time()
+for window in windows(decoder.decode_file(input), batch_size):
+    matches, entries = resolver.resolve_many(
+        [(event.id, event.owner, event.name) for event in window], fields)
+    for event, match in zip(window, matches):
+        id    = event.id
+        owner = event.owner
+        name  = event.name
+        path  = owner + '/' + name
+
+        entry = entries.get(match.our_id)
         if not entry:
-            entry = repos.find_one({'owner': owner, 'name': name}, fields)
-            if not entry:
-                msg('*** unknown {} (#{}) -- skipping'.format(path, id))
-                continue
-            elif entry['is_deleted']:
+            msg('*** unknown {} (#{}) -- skipping'.format(path, id))
+            continue
+        elif match.how == BY_PATH:
+            if entry['is_deleted']:
                 msg('*** {} (#{}) marked as deleted -- skipping'.format(path, entry['_id']))
                 continue
             elif not entry['is_visible']:
                 msg('*** {} (#{}) marked as not visible -- skipping'.format(path, entry['_id']))
                 continue
-            elif id:
-                # We know it under a different id or name.
-                msg('*** mismatch: their {} (#{}) is our {}/{} (#{})'.format(
-                    path, id, entry['owner'], entry['name'], entry['_id']))
 
         if entry['content_type'] == '':
             update_content(entry, 'nonempty')
+            # The same repository may come up again in this window.
+            entry['content_type'] = 'nonempty'
 
-    count += 1
-    if count % 100 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
+        count += 1
+        if count % 1000 == 0:
+            msg('{} [{:2f}]'.format(count, time() - start))
+            start = time()
 
+msg('{} events, {} unrecognized records, {} bad JSON lines'.format(
+    decoder.events, decoder.unrecognized, decoder.bad_json))
 msg('Done')
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3.4
+#
+# @file    update-from-githubarchive.py
+# @brief   Update pushed times, visibility and content type in one pass.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# This does the work of update-pushed-from-githubarchive.py,
+# update-visible-from-githubarchive.py and
+# update-content-type-from-githubarchive.py in a single pass over the
+# githubarchive files: each file is decompressed and parsed once, each
+# repository is looked up once, and the updates from all three are merged
+# into one write per repository.  Use -c to run only some of them, and -t
+# to slow the writes down whenever the server's reads take longer than the
+# given number of milliseconds.
+
+import sys
+import plac
+import os
+import http.client
+from time import time, sleep
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
+from casicsdb import *
+from bulkwriter import WriteThrottle
+from githubarchive import *
+
+
+# Helpers
+# .............................................................................
+
+def github_url_path(entry, owner=None, name=None):
+    if not owner:
+        owner = entry['owner']
+    if not name:
+        name  = entry['name']
+    return '/' + owner + '/' + name
+
+
+def github_url_exists(entry, owner=None, name=None):
+    url_path = github_url_path(entry, owner, name)
+    try:
+        conn = http.client.HTTPSConnection('github.com', timeout=15)
+    except:
+        # If we fail (maybe due to a timeout), try it one more time.
+        try:
+            sleep(1)
+            conn = http.client.HTTPSConnection('github.com', timeout=15)
+        except Exception as err:
+            msg('Failed url check for {}: {}'.format(url_path, err))
+            return None
+    conn.request('HEAD', url_path)
+    resp = conn.getresponse()
+    return resp.status < 400
+
+
+def report(files_done, counts):
+    msg('{} files read: {}'.format(files_done, counts))
+
+
+consumer_makers = {
+    'pushed'       : lambda: PushedConsumer(canonicalize_timestamp),
+    'visible'      : lambda: VisibleConsumer(canonicalize_timestamp,
+                                             github_url_exists, now_timestamp),
+    'content_type' : lambda: ContentTypeConsumer(),
+}
+
+
+# Main body.
+# .............................................................................
+# Currently this only does GitHub, but extending this to handle other hosts
+# should hopefully be possible.
+
+def run(consumers='pushed,visible,content_type', processes=None, batch=1000,
+        throttle=0, *inputs):
+    names = [name.strip() for name in consumers.split(',') if name.strip()]
+    unknown = [name for name in names if name not in consumer_makers]
+    if unknown:
+        raise SystemExit('Unknown consumer(s): {}'.format(', '.join(unknown)))
+    consumers = [consumer_makers[name]() for name in names]
+
+    files = archive_files(inputs)
+    if not files:
+        raise SystemExit('No githubarchive files found in {}'.format(inputs))
+
+    msg('Opening remote CASICS database ...')
+
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
+
+    msg('Reading {} files for {} using {}'.format(len(files), ', '.join(names),
+                                                   json_backend))
+    start = time()
+    found = consume_events(files, consumers, processes, report)
+    msg('{} repositories found in {:.0f} s'.format(len(found), time() - start))
+
+    start = time()
+    pacer = WriteThrottle(repos, throttle, batch_size=batch, log=msg) if throttle else None
+    writer = apply_consumers(repos, found, consumers, batch, msg, pacer)
+    msg('{} updates sent in {} batches, {} modified, {} errors [{:.0f} s]'.format(
+        writer.sent, writer.batches, writer.modified, writer.errors, time() - start))
+    if pacer:
+        msg('Write throttle: {}'.format(pacer.metrics()))
+    msg('Done')
+
+run.__annotations__ = dict(
+    consumers = ('comma-separated list of: pushed, visible, content_type', 'option', 'c'),
+    processes = ('number of processes for decoding files (default: all cores)', 'option', 'p', int),
+    batch     = ('number of repositories per lookup query and bulk write', 'option', 'b', int),
+    throttle  = ('pace writes to keep server read latency near this many ms', 'option', 't', float),
+    inputs    = 'githubarchive .json.gz files, directories or glob patterns',
+)
+
+if __name__ == '__main__':
+    plac.call(run)
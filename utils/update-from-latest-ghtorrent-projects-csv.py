@@ -58,168 +58,212 @@ from time import time, sleep
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
 from casicsdb import *
+from bulkwriter import *
+from ghtorrent import *
+from checkpoint import Checkpoint, default_checkpoint_file
 
 
-# Main body.
+# Globals.
 # .............................................................................
-# Currently this only does GitHub, but extending this to handle other hosts
-# should hopefully be possible.
-
-msg('Opening database ...')
-
-casicsdb = CasicsDB()
-github_db = casicsdb.open('github')
-repos = github_db.repos
 
 # The GHTorrent CSV projects.csv file has an "id" as the first column, but
 # I believe that's the id for the entry in the table and not github's id
 # for the repository.  We don't reference this in our database.
 
-fields = {'id'          : 0,            # Don't use this -- no the repo id.
-          'url'         : 1,
-          'owner'       : 2,
-          'name'        : 3,
-          'description' : 4,
-          'language'    : 5,
-          'created'     : 6,
-          'forked_from' : 7,
-          'deleted'     : 8,
-          'updated'     : 9}
-
-namestart = len('https://api.github.com/repos/')
-id_map = {}
-
-# Read the file once and build a mapping from their identifiers to project
-# owner/name path strings.  We need this because we have to match up their
-# id's when they say a project is a fork of another project.
-
-msg('Building project id mapping')
-with open(sys.argv[1], encoding="utf-8", errors="replace") as f:
-    reader = csv.reader(f, escapechar='\\')
-    count = 0
-    for row in reader:
-        id   = row[fields['id']]
-        if id == '-1':
-            continue
-        path = row[fields['url']][namestart:]
-        id_map[id] = path
-        count += 1
-        if count % 10000 == 0:
-            msg(count)
-
-msg('Processing {} for real.'.format(sys.argv[1]))
-with open(sys.argv[1], encoding="utf-8", errors="replace") as f:
-    reader = csv.reader(f, escapechar='\\')
-    count = 0
-    start = time()
-    for row in reader:
-        id   = row[fields['id']]
-        if id == '-1':
-            continue
-        count += 1
-
-        path        = row[fields['url']][namestart:]
-        desc        = row[fields['description']]
-        lang        = row[fields['language']]
-        forked_from = row[fields['forked_from']]
-        created     = row[fields['created']]
-        deleted     = row[fields['deleted']]
-        updated     = row[fields['updated']]
-
-        owner       = path[:path.find('/')]
-        name        = path[path.find('/') + 1:]
-        is_fork     = True if forked_from != 'N' else False
-        is_deleted  = True if deleted != '0' else False
-
-        entry = repos.find_one({'owner': owner, 'name': name})
-
-        if not entry:
-            # We need to deal with these using our cataloguer.
-            msg('*** Unknown entry {}'.format(path))
-            continue
-
-        # We gather up changes and issue a single update command for an entry.
-
-        updates = {}
-
-        # If GHTorrent says something is a fork and we don't have it that way
-        # in our database, then it is very unlikely that it is *not* a fork.
-        # Trust GHTorrent on this.  Unfortunately, the GHTorrent data about
-        # the fork source is in terms of their id numbers, not github's, so
-        # we can only update it if we can find the id in the map we create.
-
-        if is_fork and not entry['fork'] and forked_from in id_map:
-            msg('Updating is_fork for {}'.format(path))
-            fork = {}
-            fork['parent'] = id_map[forked_from]
-            fork['root'] = ''           # It's not in projects.csv.
-            updates['fork'] = fork
-
-        # If GHTorrent knows something has been deleted, it's probably
-        # a good bet that it has not been reverted somehow.
-
-        if is_deleted and not entry['is_deleted']:
-            msg('Marking {} as deleted'.format(path))
-            updates['is_deleted'] = True
-            updates['is_visible'] = False
-
-        # If we find it in projects.csv, call it visible if we didn't already.
-
-        if not is_deleted and not entry['is_visible']:
-            msg('Marking {} as visible'.format(path))
-            updates['is_visible'] = True
-        elif entry['is_visible'] == '':
-            updates['is_visible'] = not(is_deleted)
-
-        # If GHTorrent has language info for an entry and we don't,
-        # take GHTorrent's value.  However, since GHTorrent's
-        # projects.csv only lists 1 language for a project, don't
-        # replace what we have in our database if we have something
-        # for an entry already.
-
-        if lang and lang != 'N' and (not entry['languages'] or entry['languages'] == -1):
-            msg('Updating languages for {} with {}'.format(path, lang))
-            updates['languages'] = [{'name':lang}]
-
-        # If GHTorrent has a description and we don't, use theirs.  However,
-        # if we have a description, don't overwrite it because ours might be
-        # more recently-updated one than theirs.
-
-        if desc and (not entry['description'] or entry['description'] == -1):
-            msg('Updating description for {}'.format(path))
-            updates['description'] = desc
-
-        # If GHTorrent has a creation date and we don't, use theirs.
-        # Ditto for update date.  The projects.csv files don't have pushed
-        # times, unfortunately, so we use whatever we have already.
-
-        time_dict = {}                  # Don't call this variable "time".
-        if created and created != '0000-00-00 00:00:00' and not entry['time']['repo_created']:
-            msg('Updating creation date for {}'.format(path))
-            time_dict['repo_created'] = canonicalize_timestamp(created)
-        if updated and updated != '0000-00-00 00:00:00' and not entry['time']['repo_updated']:
-            msg('Updating update date for {}'.format(path))
-            time_dict['repo_updated'] = canonicalize_timestamp(updated)
-        if time_dict:
-            # If we're updating any part of the time field, we have to update
-            # all of it.  We use existing values if we don't have new ones.
-            time_dict['repo_pushed'] = entry['time']['repo_pushed']
-            time_dict['data_refreshed'] = now_timestamp()
-            if 'repo_created' not in time_dict:
-                time_dict['repo_created'] = entry['time']['repo_created']
-            if 'repo_updated' not in time_dict:
-                time_dict['repo_updated'] = entry['time']['repo_updated']
-            updates['time'] = time_dict
-
-        # Send the updates if there are any.
-
-        if updates:
-            repos.update_one({'_id': entry['_id']},
-                             {'$set': updates},
-                             upsert=False)
-
-        if count % 1000 == 0:
-            msg('{} [{:2f}]'.format(count, time() - start))
-            start = time()
-
-msg('Done')
+fields = project_fields
+
+# The only fields of our entries that compute_updates() looks at.
+
+entry_fields = {'owner': 1, 'name': 1, 'fork': 1, 'is_deleted': 1,
+                'is_visible': 1, 'languages': 1, 'description': 1, 'time': 1}
+
+
+# Helpers
+# .............................................................................
+
+def row_owner_name(row):
+    path = row_path(row)
+    return (path[:path.find('/')], path[path.find('/') + 1:])
+
+
+def compute_updates(entry, row, id_map):
+    # We gather up changes and issue a single update command for an entry.
+
+    path        = row_path(row)
+    desc        = row[fields['description']]
+    lang        = row[fields['language']]
+    forked_from = row[fields['forked_from']]
+    created     = row[fields['created']]
+    deleted     = row[fields['deleted']]
+    updated     = row[fields['updated']]
+
+    is_fork     = True if forked_from != 'N' else False
+    is_deleted  = True if deleted != '0' else False
+
+    updates = {}
+
+    # If GHTorrent says something is a fork and we don't have it that way
+    # in our database, then it is very unlikely that it is *not* a fork.
+    # Trust GHTorrent on this.  Unfortunately, the GHTorrent data about
+    # the fork source is in terms of their id numbers, not github's, so
+    # we can only update it if we can find the id in the map we create.
+
+    if is_fork and not entry['fork'] and forked_from in id_map:
+        msg('Updating is_fork for {}'.format(path))
+        fork = {}
+        fork['parent'] = id_map[forked_from]
+        fork['root'] = ''           # It's not in projects.csv.
+        updates['fork'] = fork
+
+    # If GHTorrent knows something has been deleted, it's probably
+    # a good bet that it has not been reverted somehow.
+
+    if is_deleted and not entry['is_deleted']:
+        msg('Marking {} as deleted'.format(path))
+        updates['is_deleted'] = True
+        updates['is_visible'] = False
+
+    # If we find it in projects.csv, call it visible if we didn't already.
+
+    if not is_deleted and not entry['is_visible']:
+        msg('Marking {} as visible'.format(path))
+        updates['is_visible'] = True
+    elif entry['is_visible'] == '':
+        updates['is_visible'] = not(is_deleted)
+
+    # If GHTorrent has language info for an entry and we don't,
+    # take GHTorrent's value.  However, since GHTorrent's
+    # projects.csv only lists 1 language for a project, don't
+    # replace what we have in our database if we have something
+    # for an entry already.
+
+    if lang and lang != 'N' and (not entry['languages'] or entry['languages'] == -1):
+        msg('Updating languages for {} with {}'.format(path, lang))
+        updates['languages'] = [{'name':lang}]
+
+    # If GHTorrent has a description and we don't, use theirs.  However,
+    # if we have a description, don't overwrite it because ours might be
+    # more recently-updated one than theirs.
+
+    if desc and (not entry['description'] or entry['description'] == -1):
+        msg('Updating description for {}'.format(path))
+        updates['description'] = desc
+
+    # If GHTorrent has a creation date and we don't, use theirs.
+    # Ditto for update date.  The projects.csv files don't have pushed
+    # times, unfortunately, so we use whatever we have already.
+
+    time_dict = {}                  # Don't call this variable "time".
+    if created and created != '0000-00-00 00:00:00' and not entry['time']['repo_created']:
+        msg('Updating creation date for {}'.format(path))
+        time_dict['repo_created'] = canonicalize_timestamp(created)
+    if updated and updated != '0000-00-00 00:00:00' and not entry['time']['repo_updated']:
+        msg('Updating update date for {}'.format(path))
+        time_dict['repo_updated'] = canonicalize_timestamp(updated)
+    if time_dict:
+        # If we're updating any part of the time field, we have to update
+        # all of it.  We use existing values if we don't have new ones.
+        time_dict['repo_pushed'] = entry['time']['repo_pushed']
+        time_dict['data_refreshed'] = now_timestamp()
+        if 'repo_created' not in time_dict:
+            time_dict['repo_created'] = entry['time']['repo_created']
+        if 'repo_updated' not in time_dict:
+            time_dict['repo_updated'] = entry['time']['repo_updated']
+        updates['time'] = time_dict
+
+    return updates
+
+
+# Main body.
+# .............................................................................
+# Currently this only does GitHub, but extending this to handle other hosts
+# should hopefully be possible.
+
+def run(batch=1000, report=100000, processes=1, index_file=None, resume=False,
+        checkpoint_file=None, csv_file=None):
+    if not csv_file:
+        raise SystemExit('Need the path to a GHTorrent projects.csv file.')
+
+    msg('Opening database ...')
+
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
+
+    # We need a mapping from GHTorrent's identifiers to project owner/name
+    # path strings, because we have to match up their id's when they say a
+    # project is a fork of another project.  The mapping lives in an index
+    # file next to the CSV file; it is built the first time it's needed.
+
+    msg('Opening project id mapping')
+    id_map = open_id_map(csv_file, index_file)
+    msg('{} project ids in mapping'.format(len(id_map)))
+
+    # Progress is saved at the end of each chunk of the file, after the
+    # updates for it have been sent, so --resume redoes at most one chunk.
+    # Redoing rows is harmless: compute_updates() only fills in what's
+    # missing.
+
+    checkpoint = Checkpoint(checkpoint_file or default_checkpoint_file(__file__), resume)
+    start = checkpoint.position or 0
+    if checkpoint.resumed:
+        msg('Resuming at byte {} after {} rows'.format(start, checkpoint.counts.get('rows', 0)))
+    before = dict(checkpoint.counts)
+
+    # Rows are handled in windows of 'batch' rows: one query looks up every
+    # row in the window, and the updates go out in unordered bulk writes.
+
+    msg('Processing {} for real, in batches of {}.'.format(csv_file, batch))
+    meter = RateMeter()
+    unknown = 0
+    next_report = report
+    with BulkUpdater(repos, batch_size=batch) as writer:
+        for offset, rows in csv_chunks(csv_file, processes, start):
+            for window in windows(rows, batch):
+                entries = find_by_paths(repos, [row_owner_name(row) for row in window],
+                                        entry_fields)
+                for row in window:
+                    entry = entries.get(row_owner_name(row))
+                    if not entry:
+                        # We need to deal with these using our cataloguer.
+                        msg('*** Unknown entry {}'.format(row_path(row)))
+                        unknown += 1
+                        continue
+                    updates = compute_updates(entry, row, id_map)
+                    if updates:
+                        writer.set(entry['_id'], updates)
+                meter.add(len(window))
+                if meter.count >= next_report:
+                    msg('{} rows [{:.0f} rows/s], {} updates sent'.format(
+                        meter.count, meter.rate(), writer.sent))
+                    next_report += report
+            writer.flush()
+            now = {'rows': meter.count, 'unknown': unknown, 'sent': writer.sent,
+                   'batches': writer.batches, 'modified': writer.modified,
+                   'errors': writer.errors}
+            checkpoint.counts = {k: before.get(k, 0) + v for k, v in now.items()}
+            checkpoint.advance(offset)
+
+    totals = checkpoint.counts
+    msg('{} rows in {:.0f} s [{:.0f} rows/s]; {} updates in {} batches, {} modified, {} errors'.format(
+        meter.count, time() - meter.start, meter.overall_rate(),
+        writer.sent, writer.batches, writer.modified, writer.errors))
+    if checkpoint.resumed:
+        msg('Including earlier runs: {} rows, {} unknown, {} updates, {} modified, {} errors'.format(
+            totals.get('rows', 0), totals.get('unknown', 0), totals.get('sent', 0),
+            totals.get('modified', 0), totals.get('errors', 0)))
+    checkpoint.finish()
+    msg('Done')
+
+run.__annotations__ = dict(
+    batch           = ('number of rows per lookup query and per bulk write', 'option', 'b', int),
+    report          = ('report progress every N rows', 'option', 'r', int),
+    processes       = ('number of processes for parsing the CSV file', 'option', 'p', int),
+    index_file      = ('GHTorrent id index file (default: CSV file + .idx)', 'option', 'i'),
+    resume          = ('continue from the last checkpoint', 'flag', 'R'),
+    checkpoint_file = ('checkpoint file (default: update-from-latest-ghtorrent-projects-csv.checkpoint)', 'option', 'c'),
+    csv_file        = ('path to GHTorrent projects.csv file', 'positional'),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
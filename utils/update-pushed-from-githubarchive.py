@@ -1,7 +1,7 @@
 #!/usr/bin/env python3.4
 #
-# @file    add-from-ghtorrent-dump.py
-# @brief   Add entries from a GHTorrent MongoDB database dump.
+# @file    update-pushed-from-githubarchive.py
+# @brief   Update repo pushed times from githubarchive.org event files.
 # @author  Michael Hucka
 #
 # <!---------------------------------------------------------------------------
@@ -10,151 +10,102 @@
 # Inventory Creation System.  For more information, visit http://casics.org.
 # ------------------------------------------------------------------------- -->
 
-# This assumes that the current machine is running mongodb and has been
-# loaded with a ghtorrent dump.  In that case, the local database will
-# have a github database and a collection called "repos" inside of it.
-
-
 import sys
 import plac
 import os
-import csv
-import http
-import requests
-import urllib
-import gzip
-import json
-from datetime import datetime
 from time import time, sleep
-from pymongo import MongoClient
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
 from casicsdb import *
+from bulkwriter import *
+from githubarchive import *
+from resolver import *
 
 
 # Helpers
 # .............................................................................
 
-def update_pushed(entry, pushed_at):
-    # Purposefully not updating the data_refreshed time, because i'm running
-    # this concurrently with other updates and the others do check the refresh
-    # time.  It's not crucial to touch the refresh time for this update.
-    repos.update_one({'_id': entry['_id']},
-                     {'$set': {'time.repo_pushed': canonicalize_timestamp(pushed_at)}},
-                     upsert=False)
+def report_match(match, action=None):
+    if action:
+        msg('*** {} -- {}'.format(match.describe(), action))
+    else:
+        msg('*** ' + match.describe())
+
+
+def report(files_done, events, unrecognized):
+    msg('{} files read, {} push events, {} unrecognized'.format(
+        files_done, events, unrecognized))
 
 
 # Main body.
 # .............................................................................
 # Currently this only does GitHub, but extending this to handle other hosts
 # should hopefully be possible.
-
-start = time()
-
-msg('Opening remote CASICS database ...')
-
-casicsdb = CasicsDB()
-github_db = casicsdb.open('github')
-repos = github_db.repos
-
-input = sys.argv[1]
-msg('Opening file {}'.format(input))
-
-done = set()
-with gzip.open(input, 'r') as f:
-    count = 0
+#
+# The inputs can be any number of githubarchive .json.gz files, directories
+# containing them, or glob patterns.  The files are decoded in parallel and
+# reduced to the latest push time for each repository across all of them,
+# and then the database is updated in batches: one lookup query and one
+# bulk write per batch of repositories, no matter how many events there
+# were for each one.  With -t, the writes are slowed down whenever the
+# server's reads take longer than the given number of milliseconds.
+
+def run(processes=None, batch=1000, throttle=0, *inputs):
+    files = archive_files(inputs)
+    if not files:
+        raise SystemExit('No githubarchive files found in {}'.format(inputs))
+
+    msg('Opening remote CASICS database ...')
+
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
+
+    msg('Reading {} files'.format(len(files)))
     start = time()
-    for line in f:
-        contents = json.loads(line.decode('ascii', 'ignore'))
-
-        if contents['type'] != 'PushEvent':
-            continue
-
-        id = None
-        entry = None
-        if 'actor' in contents:
-            # Older "timeline" format for pre-2015 githubarchive downloads.
-            # Messy because it seems to have changed multiple times.
-            if 'payload' in contents and 'repo' in contents['payload']:
-                path  = contents['payload']['repo']
-                name  = path[path.find('/') + 1:]
-                if 'actor' in contents and 'login' in contents['actor']:
-                    owner = contents['actor']['login']
-                elif 'actor' in contents['payload']:
-                    owner = contents['payload']['actor']
-                else:
-                    msg('problem 1')
-                    import ipdb; ipdb.set_trace()
-            elif 'repo' in contents:
-                repo  = contents['repo']
-                path  = repo['name']
-                owner = path[:path.find('/')]
-                name  = path[path.find('/') + 1 :]
-                id    = repo['id']
-            elif 'repository' in contents:
-                repo  = contents['repository']
-                owner = repo['owner']
-                name  = repo['name']
-                path  = owner + '/' + name
-                id    = repo['id']
-            else:
-                # Some other kind of push event.
-                msg('*** unrecognized push event ***')
-                continue
-
-            # repo  = contents['repository']
-            # owner = repo['owner']
-            # name  = repo['name']
-            # path  = owner + '/' + name
-            # id    = repo['id']
-        elif 'url' in contents:
-            # Another variant of the timeline format?
-            url   = contents['url']
-            owner = contents['actor']
-            start = 19 + len(owner) + 1  # 19 for "https://github.com/"
-            end   = url[start:].find('/')
-            name  = url[start:start + end]
-            path  = owner + '/' + name
-        elif 'repo' in contents:
-            # New format in githubarchive downloads from 2015 and beyond.
-            repo  = contents['repo']
-            path  = repo['name']
-            owner = path[:path.find('/')]
-            name  = path[path.find('/') + 1 :]
-            id    = repo['id']
-        else:
-            msg('problem 3')
-            import ipdb; ipdb.set_trace()
-
-        if path in done:
-            continue
-        done.add(path)
-
-        fields = {'owner': 1, 'name': 1, 'time': 1}
-        if id:
-            entry = repos.find_one({'_id': id}, fields)
-        if not entry:
-            entry = repos.find_one({'owner': owner, 'name': name}, fields)
-            if not entry:
-                msg('*** unknown {} (#{}) -- skipping'.format(path, id))
-                continue
-            elif id:
-                # We know it under a different id or name.
-                msg('*** mismatch: their {} (#{}) is our {}/{} (#{})'.format(
-                    path, id, entry['owner'], entry['name'], entry['_id']))
-
-        # It's confusing, but the 'created_at' here refers to the *event*, not
-        # the repo -- the event is a push, so we update the pushed time.
-        their_time = canonicalize_timestamp(contents['created_at'])
-        if not entry['time']['repo_pushed']:
-            update_pushed(entry, their_time)
-        elif their_time > entry['time']['repo_pushed']:
-            update_pushed(entry, their_time)
-
-    count += 1
-    if count % 100 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
-
-msg('Done')
+    latest = latest_pushes(files, canonicalize_timestamp, processes, report)
+    msg('{} repositories pushed, found in {:.0f} s'.format(len(latest), time() - start))
+
+    fields = {'owner': 1, 'name': 1, 'time': 1}
+    meter = RateMeter()
+    resolver = RepoResolver(repos, on_mismatch=report_match,
+                            on_unknown=lambda match: report_match(match, 'skipping'))
+    pacer = WriteThrottle(repos, throttle, batch_size=batch, log=msg) if throttle else None
+    with BulkUpdater(repos, batch_size=batch, throttle=pacer) as writer:
+        for window in windows(latest.values(), batch):
+            # Resolving tries the id first, because that's more invariant
+            # than the name of the repo, then owner/name.
+            matches, entries = resolver.resolve_many([r[1:] for r in window], fields)
+            for match, (pushed, _, _, _) in zip(matches, window):
+                entry = entries.get(match.our_id)
+                if not entry:
+                    continue
+
+                # Purposefully not updating the data_refreshed time, because
+                # i'm running this concurrently with other updates and the
+                # others do check the refresh time.  It's not crucial to
+                # touch the refresh time for this update.
+                if not entry['time']['repo_pushed'] or pushed > entry['time']['repo_pushed']:
+                    writer.set(entry['_id'], {'time.repo_pushed': pushed})
+
+            meter.add(len(window))
+            msg('{} [{:.0f}/s]'.format(meter.count, meter.rate()))
+
+    msg('{} repositories, {} updates sent, {} modified'.format(
+        meter.count, writer.sent, writer.modified))
+    msg('{mismatches} mismatched, {unknown} unknown, {queries} lookup queries'.format(
+        **resolver.counts()))
+    if pacer:
+        msg('Write throttle: {}'.format(pacer.metrics()))
+    msg('Done')
+
+run.__annotations__ = dict(
+    processes = ('number of processes for decoding files (default: all cores)', 'option', 'p', int),
+    batch     = ('number of repositories per lookup query and bulk write', 'option', 'b', int),
+    throttle  = ('pace writes to keep server read latency near this many ms', 'option', 't', float),
+    inputs    = 'githubarchive .json.gz files, directories or glob patterns',
+)
+
+if __name__ == '__main__':
+    plac.call(run)
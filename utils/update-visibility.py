@@ -1,4 +1,4 @@
-#!/usr/bin/env python3.4
+#!/usr/bin/env python3.5
 #
 # @file    add-from-ghtorrent-dump.py
 # @brief   Add entries from a GHTorrent MongoDB database dump.
@@ -18,85 +18,77 @@
 import sys
 import plac
 import os
-import csv
-import http
-import requests
-import urllib
-from datetime import datetime
-from time import time, sleep
-from pymongo import MongoClient
+from time import time
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
 from casicsdb import *
+from checkpoint import Checkpoint, default_checkpoint_file, scan
+from visibility import VisibilityChecker, update_visibility
+from visibilitycache import VisibilityCache, recheck_schedule
 
 
-# Helpers
-# .............................................................................
-
-def github_url_path(entry, owner=None, name=None):
-    if not owner:
-        owner = entry['owner']
-    if not name:
-        name  = entry['name']
-    return '/' + owner + '/' + name
-
-
-def github_url(entry, owner=None, name=None):
-    return 'http://github.com' + github_url_path(entry, owner, name)
-
-
-def github_url_exists(entry, owner=None, name=None):
-    url_path = github_url_path(entry, owner, name)
-    try:
-        conn = http.client.HTTPSConnection('github.com', timeout=15)
-    except:
-        # If we fail (maybe due to a timeout), try it one more time.
-        try:
-            sleep(1)
-            conn = http.client.HTTPSConnection('github.com', timeout=15)
-        except Exception:
-            msg('Failed url check for {}: {}'.format(url_path, err))
-            return None
-    conn.request('HEAD', url_path)
-    resp = conn.getresponse()
-    return resp.status < 400
-
-
-def update(entry):
-    is_visible = bool(github_url_exists(entry))
-    msg('{}/{} (#{}) is_visible = {}'.format(
-        entry['owner'], entry['name'], entry['_id'], is_visible))
-    repos.update_one({'_id': entry['_id']},
-                     {'$set': {'is_visible': is_visible,
-                               'time.data_refreshed': now_timestamp()}},
-                     upsert=False)
-
-
 # Main body.
 # .............................................................................
 # Currently this only does GitHub, but extending this to handle other hosts
 # should hopefully be possible.
-
-start = time()
-
-msg('Opening remote CASICS database ...')
-
-casicsdb = CasicsDB()
-github_db = casicsdb.open('github')
-repos = github_db.repos
-
-msg('Doing updates')
-
-count = 0
-start = time()
-for entry in repos.find({'is_visible': ''},
-                        {'is_visible': 1, 'owner': 1, 'name': 1, 'time': 1}):
-    update(entry)
-
-    count += 1
-    if count % 1000 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
-
-msg('Done')
+#
+# The checks are done by a VisibilityChecker (see visibility.py), with up
+# to -n requests in flight over reused connections and at most -r requests
+# per second (10 unless told otherwise), and the results are written in
+# bulk.  Rate limits and server errors count as failed checks.  Every entry
+# checked drops out of the query, so a rerun carries on with the ones left;
+# an entry whose check failed stays as it was, to be tried again next time.
+# --resume keeps the counts from the interrupted run.
+#
+# Every outcome is also kept in a VisibilityCache (see visibilitycache.py),
+# and entries whose last outcome hasn't expired are skipped, so failing
+# URLs aren't tried again on every run.  With -s N, instead of the entries
+# never checked, this re-checks the N entries that most need it: those
+# confirmed longest ago, counting entries pushed to since then as staler.
+
+def run(concurrency=50, rate=10, batch=1000, schedule=0, resume=False,
+        checkpoint_file=None):
+    msg('Opening remote CASICS database ...')
+
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
+    cache = VisibilityCache(repos)
+    cache.ensure_indexes()
+
+    checkpoint = Checkpoint(checkpoint_file or default_checkpoint_file(__file__), resume)
+    if checkpoint.resumed:
+        msg('Resuming with {} already checked'.format(checkpoint.counts.get('checked', 0)))
+
+    if schedule:
+        msg('Choosing {} entries to re-check'.format(schedule))
+        entries = recheck_schedule(repos, cache, schedule)
+        msg('{} entries chosen'.format(len(entries)))
+    else:
+        entries = cache.due(scan(repos, {'is_visible': ''}, {'owner': 1, 'name': 1}))
+
+    msg('Doing updates')
+    start = time()
+    checker = VisibilityChecker(concurrency, rate=rate or None)
+    checked, visible, failed = update_visibility(repos, entries, checker, now_timestamp,
+                                                 batch, checkpoint=checkpoint,
+                                                 cache=cache, log=msg)
+    msg('{} checked, {} visible, {} failed in {:.0f} s; {requests} requests over {connections} connections'
+        .format(checked, visible, failed, time() - start, **checker.stats()))
+    if not schedule:
+        msg('{} skipped because they were checked recently'.format(cache.hits))
+    checkpoint.finish()
+    msg('Done')
+
+run.__annotations__ = dict(
+    concurrency     = ('number of requests in flight at once', 'option', 'n', int),
+    rate            = ('most requests per second to send; 0 for no limit (default: 10)', 'option', 'r', float),
+    batch           = ('number of updates per bulk write', 'option', 'b', int),
+    schedule        = ('re-check this many previously checked entries instead', 'option', 's', int),
+    resume          = ('keep the counts from the last checkpoint', 'flag', 'R'),
+    checkpoint_file = ('checkpoint file (default: update-visibility.checkpoint)', 'option', 'c'),
+)
+
+if __name__ == '__main__':
+    plac.call(run)
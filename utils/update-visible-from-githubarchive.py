@@ -1,7 +1,7 @@
 #!/usr/bin/env python3.4
 #
-# @file    add-from-ghtorrent-dump.py
-# @brief   Add entries from a GHTorrent MongoDB database dump.
+# @file    update-visible-from-githubarchive.py
+# @brief   Update repo visibility from a githubarchive.org event file.
 # @author  Michael Hucka
 #
 # <!---------------------------------------------------------------------------
@@ -22,8 +22,6 @@ import csv
 import http
 import requests
 import urllib
-import gzip
-import json
 from datetime import datetime
 from time import time, sleep
 from pymongo import MongoClient
@@ -31,8 +29,23 @@ from pymongo import MongoClient
 sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../common"))
 from casicsdb import *
+from bulkwriter import *
+from githubarchive import *
+from resolver import *
+from seenset import *
 
 
+# Globals.
+# .............................................................................
+
+batch_size  = 1000
+cache_size  = 1000000
+
+# Memory budget of the seen-set, in bytes (see seenset.py).
+
+seen_budget = 256*2**20
+
+
 # Helpers
 # .............................................................................
 
@@ -65,7 +78,7 @@ def github_url_exists(entry, owner=None, name=None):
     return resp.status < 400
 
 
-def make_visible(entry, is_visible=True, checked_github=False):
+def make_visible(repos, entry, is_visible=True, checked_github=False):
     msg('{}/{} (#{}) is_visible = {}'.format(
         entry['owner'], entry['name'], entry['_id'], is_visible))
     if checked_github:
@@ -83,71 +96,86 @@ def make_visible(entry, is_visible=True, checked_github=False):
 # Currently this only does GitHub, but extending this to handle other hosts
 # should hopefully be possible.
 
-start = time()
+def run(input, seen_kind='fingerprint'):
+    msg('Opening remote CASICS database ...')
+
+    casicsdb = CasicsDB()
+    github_db = casicsdb.open('github')
+    repos = github_db.repos
+
+    # The paths already handled are remembered in a seen-set of the -s kind
+    # (see seenset.py).  Use 'set' for an exact but unbounded one.
 
-msg('Opening remote CASICS database ...')
+    msg('Opening file {}'.format(input))
 
-casicsdb = CasicsDB()
-github_db = casicsdb.open('github')
-repos = github_db.repos
+    msg('Using {} for JSON decoding'.format(json_backend))
 
-input = sys.argv[1]
-msg('Opening file {}'.format(input))
+    # Events are resolved to our entries a window at a time.  The same
+    # repositories come up over and over in the event stream, and the
+    # resolver remembers them, so they cost no extra lookups after the
+    # first time.
 
-done = set()
-with gzip.open(input, 'r') as f:
+    fields = {'owner': 1, 'name': 1, 'is_visible': 1, 'time': 1}
+    resolver = RepoResolver(repos, cache_size=cache_size,
+                            on_mismatch=lambda match: msg('*** ' + match.describe()))
+    done = make_seen_set(seen_kind, seen_budget)
+    decoder = EventDecoder()
     count = 0
     start = time()
-    for line in f:
-        contents = json.loads(line.decode('ascii', 'ignore'))
-
-        repo       = contents['repo']
-        id         = repo['id']
-        path       = repo['name']
-        owner      = path[:path.find('/')]
-        name       = path[path.find('/') + 1 :]
-        their_time = canonicalize_timestamp(contents['created_at'])
-
-        if path in done:
-            continue
-        done.add(path)
-
-        fields = {'owner': 1, 'name': 1, 'is_visible': 1, 'time': 1}
-        entry = repos.find_one({'_id': id}, fields)
-        if not entry:
-            entry = repos.find_one({'owner': owner, 'name': name}, fields)
+    for window in windows(decoder.decode_file(input), batch_size):
+        window = [event for event in window
+                  if event.owner + '/' + event.name not in done]
+        matches, entries = resolver.resolve_many(
+            [(event.id, event.owner, event.name) for event in window], fields)
+        for event, match in zip(window, matches):
+            id         = event.id
+            path       = event.owner + '/' + event.name
+            their_time = canonicalize_timestamp(event.created_at)
+
+            if done.add(path):
+                continue
+
+            entry = entries.get(match.our_id)
             if not entry:
                 # They're all public.
                 # if not contents['public']:
                 #     msg('unknown {} (#{}) is not public anyway -- skipping'.format(path, id))
                 #     continue
                 msg('*** unknown {} (#{}) is public -- skipping but should add'.format(path, id))
-            else:
+            elif match.how == BY_PATH:
                 # We know it under a different name.
-                msg('*** missmatch: their {} (#{}) is our {}/{} (#{})'.format(
-                    path, id, entry['owner'], entry['name'], entry['_id']))
-
                 if entry['is_visible'] != '' and their_time < entry['time']['data_refreshed']:
                     # We have a value and our refresh time is newer.
                     continue
                 # They're all public.
                 # if not contents['public']:
                 #     msg('{} (#{}) is not public'.format(path, id))
-                #     make_visible(entry, False)
+                #     make_visible(repos, entry, False)
                 if not github_url_exists(entry):
                     msg('{} (#{}) no longer exists'.format(path, id))
-                    make_visible(entry, False, True)
+                    make_visible(repos, entry, False, True)
                 else:
-                    make_visible(entry, True, True)
-        else:
-            if entry['is_visible'] != '' and their_time < entry['time']['data_refreshed']:
-                # We have a value and our refresh time is newer.
-                continue
-            make_visible(entry, contents['public'])
+                    make_visible(repos, entry, True, True)
+            else:
+                if entry['is_visible'] != '' and their_time < entry['time']['data_refreshed']:
+                    # We have a value and our refresh time is newer.
+                    continue
+                make_visible(repos, entry, event.public)
+
+            count += 1
+            if count % 10000 == 0:
+                msg('{} [{:2f}]'.format(count, time() - start))
+                start = time()
+
+    msg(seen_set_report(done))
+    msg('{} events, {} unrecognized records, {} bad JSON lines'.format(
+        decoder.events, decoder.unrecognized, decoder.bad_json))
+    msg('Done')
 
-    count += 1
-    if count % 100 == 0:
-        msg('{} [{:2f}]'.format(count, time() - start))
-        start = time()
+run.__annotations__ = dict(
+    input     = ('githubarchive.org event file', 'positional'),
+    seen_kind = ('kind of seen-set for the paths already handled', 'option', 's', str, seen_set_kinds),
+)
 
-msg('Done')
+if __name__ == '__main__':
+    plac.call(run)
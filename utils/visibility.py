@@ -0,0 +1,364 @@
+#!/usr/bin/env python3.5
+#
+# @file    visibility.py
+# @brief   Check many repository URLs concurrently, reusing connections.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# We decide whether a repository is visible by sending a HEAD request for
+# its page on GitHub.  github_url_exists() in our utilities opens a new
+# HTTPS connection for every repository and waits for each answer before
+# sending the next request.  That means a TCP and TLS handshake per request
+# and only one request in flight, which is hopeless for millions of
+# repositories.
+#
+# VisibilityChecker uses asyncio to keep up to 'concurrency' requests in
+# flight.  It keeps a pool of HTTP/1.1 keep-alive connections to each host
+# and sends one request at a time on each connection, which makes it much
+# cheaper to send many requests.  A per-host rate limit keeps it polite.
+# update_visibility() uses it to check a sequence of entries and writes the
+# results in bulk.  benchmark-visibility.py compares it with the old way
+# against a local stub server.
+#
+# A 429, a 5xx, or a 403 saying GitHub's rate limit has run out tells us
+# nothing about the repository, so the checker treats it as a failed request
+# rather than an answer.  It holds back every request to that host for as
+# long as the Retry-After (or X-RateLimit-Reset) header says, up to
+# 'max_wait' seconds, and then tries again.
+#
+# This uses async def and await, and so needs Python 3.5 or later.
+
+import asyncio
+import ssl as ssllib
+from collections import deque
+from time import time
+from urllib.parse import urlsplit
+
+from bulkwriter import BulkUpdater, RateMeter
+
+
+# Globals.
+# .............................................................................
+
+user_agent = 'casics-visibility-checker'
+
+
+# Rate limiting.
+# .............................................................................
+
+class RateLimiter():
+    '''Spaces out calls to acquire() to at most 'rate' per second.  A
+    rate of None or 0 means no limit.'''
+
+    def __init__(self, rate=None, loop=None):
+        self.interval = 1.0/rate if rate else 0
+        self.loop     = loop
+        self._next    = 0
+
+    async def acquire(self):
+        now = self.loop.time()
+        wait = self._next - now
+        self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def hold(self, seconds):
+        '''Let no call to acquire() return for the next 'seconds'.'''
+        self._next = max(self._next, self.loop.time() + seconds)
+
+
+# Connections.
+# .............................................................................
+
+class _Connection():
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.used   = 0
+
+    def close(self):
+        self.writer.close()
+
+
+class HostPool():
+    '''Keep-alive connections to one host.  At most 'size' connections are
+    open at once; requests wait for a free one.  'rate' limits the requests
+    per second sent to the host.'''
+
+    def __init__(self, host, port, use_ssl, size, rate, timeout, loop):
+        self.host      = host
+        self.port      = port
+        self.ssl       = ssllib.create_default_context() if use_ssl else None
+        self.timeout   = timeout
+        self.loop      = loop
+        self.limiter   = RateLimiter(rate, loop)
+        self.idle      = deque()
+        self.slots     = asyncio.Semaphore(size)
+        self.opened    = 0
+        self.requests  = 0
+
+    async def _connect(self):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl),
+            self.timeout)
+        self.opened += 1
+        return _Connection(reader, writer)
+
+    async def _request(self, connection, path):
+        request = ('HEAD {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: {}\r\n'
+                   'Connection: keep-alive\r\n\r\n').format(path, self.host, user_agent)
+        connection.writer.write(request.encode('ascii'))
+        status_line = await connection.reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed by {}'.format(self.host))
+        status = int(status_line.split()[1])
+        keep_alive = not status_line.startswith(b'HTTP/1.0')
+        headers = {}
+        while True:
+            line = await connection.reader.readline()
+            if not line:
+                keep_alive = False
+                break
+            if line in (b'\r\n', b'\n'):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'connection' in headers:
+            keep_alive = headers['connection'].lower() != 'close'
+        connection.used += 1
+        return (status, headers, keep_alive)
+
+    async def head(self, path):
+        '''Send a HEAD request for 'path' and return (status, headers),
+        with the header names in lower case.  Raises an exception
+        (OSError, ValueError or asyncio.TimeoutError) if no answer can be
+        had.'''
+        async with self.slots:
+            await self.limiter.acquire()
+            self.requests += 1
+            # A reused connection may have been closed by the server while
+            # it sat idle, so a failure on one is retried on a new one.
+            while True:
+                connection = self.idle.popleft() if self.idle else None
+                reused = connection is not None
+                try:
+                    if not reused:
+                        connection = await self._connect()
+                    status, headers, keep_alive = await asyncio.wait_for(
+                        self._request(connection, path), self.timeout)
+                except (OSError, ValueError, IndexError, asyncio.TimeoutError):
+                    if connection:
+                        connection.close()
+                    if reused:
+                        continue
+                    raise
+                if keep_alive:
+                    self.idle.append(connection)
+                else:
+                    connection.close()
+                return (status, headers)
+
+    def close(self):
+        while self.idle:
+            self.idle.popleft().close()
+
+
+# Checking.
+# .............................................................................
+
+class VisibilityChecker():
+    '''Sends HEAD requests for many URLs with up to 'concurrency' in flight,
+    over at most 'connections' connections per host (default: as many as
+    'concurrency'), and no more than 'rate' requests per second per host.
+    A request that fails, or is turned away by a rate limit or a server
+    error, is tried 'retries' more times; a host asking us to wait is left
+    alone for up to 'max_wait' seconds.'''
+
+    def __init__(self, concurrency=50, connections=None, rate=None, timeout=15,
+                 retries=1, max_wait=300):
+        self.concurrency = concurrency
+        self.pool_size   = connections or concurrency
+        self.rate        = rate
+        self.timeout     = timeout
+        self.retries     = retries
+        self.max_wait    = max_wait
+        self.pools       = {}
+        self.requests    = 0
+        self.connections = 0
+        self.failures    = 0
+        self.throttled   = 0
+        self.loop        = None
+
+    def _pool(self, url):
+        parts = urlsplit(url)
+        use_ssl = parts.scheme == 'https'
+        port = parts.port or (443 if use_ssl else 80)
+        key = (parts.hostname, port, use_ssl)
+        if key not in self.pools:
+            self.pools[key] = HostPool(parts.hostname, port, use_ssl, self.pool_size,
+                                       self.rate, self.timeout, self.loop)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        return (self.pools[key], path)
+
+    async def status(self, url):
+        '''Return the HTTP status for 'url', or None if it can't be had.'''
+        pool, path = self._pool(url)
+        for attempt in range(self.retries + 1):
+            wait = 1
+            try:
+                status, headers = await pool.head(path)
+            except (OSError, ValueError, IndexError, asyncio.TimeoutError):
+                pass
+            else:
+                if not is_throttled(status, headers):
+                    return status
+                self.throttled += 1
+                delay = retry_delay(headers)
+                if delay is not None:
+                    # The whole host waits, not just this request.
+                    pool.limiter.hold(min(delay, self.max_wait))
+                    wait = 0
+            if attempt < self.retries and wait:
+                await asyncio.sleep(wait)
+        self.failures += 1
+        return None
+
+    async def _check(self, key, url, on_result):
+        on_result(key, await self.status(url))
+
+    async def _check_all(self, items, on_result):
+        pending = set()
+        try:
+            for key, url in items:
+                if len(pending) >= self.concurrency:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        # Raises the task's exception, if it had one.
+                        task.result()
+                pending.add(asyncio.ensure_future(self._check(key, url, on_result)))
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+        finally:
+            # After an error, stop the checks still going.
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    def check_all(self, items, on_result):
+        '''For each (key, url) in 'items', call on_result(key, status),
+        where status is the HTTP status code or None if the request failed.
+        Results come back in the order they arrive, not the order given.
+        'items' is read lazily, so it can be a database cursor.'''
+        # The pools' semaphores find the loop with get_event_loop().
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._check_all(items, on_result))
+        finally:
+            for pool in self.pools.values():
+                pool.close()
+                self.requests += pool.requests
+                self.connections += pool.opened
+            self.pools = {}
+            self.loop.close()
+            self.loop = None
+            asyncio.set_event_loop(None)
+
+    def stats(self):
+        '''Requests sent, connections opened, URLs that failed and answers
+        turned away by rate limits or server errors, so far.'''
+        return {'requests'   : self.requests,
+                'connections': self.connections,
+                'failures'   : self.failures,
+                'throttled'  : self.throttled}
+
+
+def github_url(entry):
+    return 'https://github.com/' + entry['owner'] + '/' + entry['name']
+
+
+def is_throttled(status, headers):
+    '''True if a response with 'status' and (lower-case) 'headers' says to
+    come back later rather than whether the repository is there: a 429, a
+    5xx, or a 403 for an exhausted rate limit.'''
+    if status == 429 or status >= 500:
+        return True
+    return status == 403 and (headers.get('x-ratelimit-remaining') == '0'
+                              or 'retry-after' in headers)
+
+
+def retry_delay(headers):
+    '''How many seconds the (lower-case) 'headers' of a throttled response
+    ask us to wait, or None if they don't say.'''
+    after = headers.get('retry-after', '')
+    if after.isdigit():
+        return int(after)
+    reset = headers.get('x-ratelimit-reset', '')
+    if reset.isdigit():
+        return max(0, int(reset) - time())
+    return None
+
+
+def is_visible(status):
+    '''What a HEAD status means for is_visible: True or False, or None if
+    the status says nothing about the repository (a 429 or a 5xx).'''
+    if status is None or status == 429 or status >= 500:
+        return None
+    return status < 400
+
+
+def update_visibility(collection, entries, checker, now, batch_size=1000,
+                      report=1000, url=github_url, checkpoint=None, cache=None,
+                      log=None):
+    '''Check the visibility of each entry in 'entries' (which need _id,
+    owner and name) with 'checker', and set is_visible and
+    time.data_refreshed (to now()) in bulk writes.  Entries whose check
+    failed are left alone to be tried again another time.  If a
+    Checkpoint is given, the counts are kept in it, and it is saved (if
+    it's time) after each bulk write.  If a VisibilityCache is given (see
+    visibilitycache.py), every outcome, failures included, is recorded in
+    it.  Returns (checked, visible, failed).'''
+    log = log or (lambda text: None)
+    counts = checkpoint.counts if checkpoint else {}
+    for name in ('checked', 'visible', 'failed'):
+        counts.setdefault(name, 0)
+    meter = RateMeter()
+
+    def record(id, status):
+        counts['checked'] += 1
+        meter.add()
+        visible = None if status is None else is_visible(status)
+        if visible is None:
+            status = None
+        if cache:
+            cache.record(id, status)
+        if status is None:
+            counts['failed'] += 1
+            log('Failed url check for #{}'.format(id))
+        else:
+            counts['visible'] += visible
+            batches = writer.batches
+            writer.set(id, {'is_visible': visible, 'time.data_refreshed': now()})
+            if checkpoint and writer.batches != batches:
+                checkpoint.tick()
+        if counts['checked'] % report == 0:
+            log('{checked} checked, {visible} visible, {failed} failed'.format(**counts)
+                + ' [{:.0f}/s]'.format(meter.rate()))
+
+    with BulkUpdater(collection, batch_size) as writer:
+        checker.check_all(((e['_id'], url(e)) for e in entries), record)
+    if cache:
+        cache.flush()
+    return (counts['checked'], counts['visible'], counts['failed'])
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3.4
+#
+# @file    visibilitycache.py
+# @brief   Remember visibility checks, and choose which entries to check next.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Until now, every run of a visibility check started from scratch.  It
+# checked every candidate again, however recently we'd confirmed it, and
+# it kept retrying the same failing URLs.
+#
+# VisibilityCache keeps the outcome of each HEAD request in a collection
+# next to repos ('visibility_cache'), keyed by the repository id.  Each
+# outcome records the status code (None if the request failed), when the
+# check was made, and when it expires.  How long it lasts depends on the
+# result:
+#
+#   positive_ttl   the repository was there (status < 400)
+#   negative_ttl   it wasn't (404 and the like)
+#   failure_ttl    we got no answer at all
+#
+# While an outcome hasn't expired, the entry isn't checked again.
+#
+# recheck_schedule() picks the entries to spend a limited number of checks
+# on.  Entries with an unexpired outcome are left out, as are entries that
+# have never been looked at (is_visible ''), which update-visibility.py
+# handles without a schedule.  The rest are ranked by how long it has been
+# since they were last confirmed, using the cache or, failing that,
+# time.data_refreshed.  An entry that has been pushed to since then counts
+# 'activity_weight' times as stale, because a repository that is changing
+# is more likely to have been renamed, made private or deleted than one
+# that has been quiet.
+
+import heapq
+from datetime import datetime
+from time import time
+
+from pymongo import ASCENDING, UpdateOne
+
+from bulkwriter import BulkUpdater, find_by_ids, windows
+
+
+# Globals.
+# .............................................................................
+
+hour = 3600
+day  = 24*hour
+
+# Entry fields recheck_schedule() needs.
+
+schedule_fields = {'owner': 1, 'name': 1, 'is_visible': 1,
+                   'time.data_refreshed': 1, 'time.repo_pushed': 1}
+
+
+# Helpers.
+# .............................................................................
+
+def seconds(value):
+    '''Our time fields as seconds since the epoch.  They are numbers,
+    datetimes or 'YYYY-MM-DD HH:MM:SS' strings, or '' or None when we
+    don't know; those give None.'''
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.timestamp()
+    text = str(value).replace('T', ' ').rstrip('Z')[:19]
+    try:
+        return datetime.strptime(text, '%Y-%m-%d %H:%M:%S').timestamp()
+    except ValueError:
+        return None
+
+
+# The cache.
+# .............................................................................
+
+class VisibilityCache():
+    '''Outcomes of visibility checks, stored in the collection 'name' in
+    the database of 'repos'.  Outcomes are written in bulk, 'batch_size'
+    at a time; call flush() (or use the cache in a with statement) to
+    write the rest.'''
+
+    def __init__(self, repos, name='visibility_cache', positive_ttl=30*day,
+                 negative_ttl=7*day, failure_ttl=6*hour, batch_size=1000):
+        self.collection   = repos.database[name]
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.failure_ttl  = failure_ttl
+        self.writer       = BulkUpdater(self.collection, batch_size)
+        self.hits         = 0
+        self.misses       = 0
+
+    def ensure_indexes(self):
+        self.collection.create_index([('expires', ASCENDING)])
+
+    def ttl(self, status):
+        '''How long an outcome with HTTP status 'status' (None for a
+        failed request) stays fresh, in seconds.  A 429 or a 5xx counts
+        as a failed request.'''
+        if status is None or status == 429 or status >= 500:
+            return self.failure_ttl
+        return self.positive_ttl if status < 400 else self.negative_ttl
+
+    def record(self, id, status, now=None):
+        '''Remember that checking 'id' gave 'status'.'''
+        now = now or time()
+        self.writer.add(UpdateOne({'_id': id},
+                                  {'$set': {'status' : status,
+                                            'checked': now,
+                                            'expires': now + self.ttl(status)}},
+                                  upsert=True))
+
+    def get_many(self, ids):
+        '''Return a dict mapping those of 'ids' that have outcomes to them.'''
+        return find_by_ids(self.collection, ids)
+
+    def due(self, entries, now=None, window=1000):
+        '''Yield the entries (which need an _id) whose outcomes are missing
+        or expired, looking them up 'window' at a time.'''
+        now = now or time()
+        for batch in windows(entries, window):
+            known = self.get_many([e['_id'] for e in batch])
+            for entry in batch:
+                outcome = known.get(entry['_id'])
+                if outcome and outcome['expires'] > now:
+                    self.hits += 1
+                    continue
+                self.misses += 1
+                yield entry
+
+    def flush(self):
+        self.writer.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+
+# Scheduling re-checks.
+# .............................................................................
+
+def priority(entry, outcome, now, activity_weight=4):
+    '''How much 'entry' needs re-checking, given its cached 'outcome' (or
+    None): seconds since it was last confirmed, multiplied by
+    'activity_weight' if it has been pushed to since.  Returns None if it
+    shouldn't be checked now.'''
+    if outcome and outcome['expires'] > now:
+        return None
+    times = entry.get('time') or {}
+    confirmed = outcome['checked'] if outcome else seconds(times.get('data_refreshed'))
+    if confirmed is None:
+        confirmed = 0
+    score = max(0.0, now - confirmed)
+    pushed = seconds(times.get('repo_pushed'))
+    if pushed is not None and pushed > confirmed:
+        score *= activity_weight
+    return score
+
+
+def recheck_schedule(repos, cache, budget, query=None, activity_weight=4,
+                     now=None, window=1000):
+    '''Return up to 'budget' entries of 'repos' matching 'query' (default:
+    all that have been checked before), most in need of a re-check
+    first.'''
+    now = now or time()
+    if query is None:
+        query = {'is_visible': {'$ne': ''}}
+    best = []
+    for batch in windows(repos.find(query, schedule_fields), window):
+        known = cache.get_many([e['_id'] for e in batch])
+        for entry in batch:
+            score = priority(entry, known.get(entry['_id']), now, activity_weight)
+            if score is None:
+                continue
+            item = (score, entry['_id'], entry)
+            if len(best) < budget:
+                heapq.heappush(best, item)
+            elif item[:2] > best[0][:2]:
+                heapq.heapreplace(best, item)
+    return [entry for _, _, entry in sorted(best, key=lambda item: item[:2], reverse=True)]
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3.4
+#
+# @file    workload.py
+# @brief   Record the shapes of the queries our utilities make, and advise on indexes.
+# @author  Michael Hucka
+#
+# <!---------------------------------------------------------------------------
+# Copyright (C) 2015 by the California Institute of Technology.
+# This software is part of CASICS, the Comprehensive and Automated Software
+# Inventory Creation System.  For more information, visit http://casics.org.
+# ------------------------------------------------------------------------- -->
+
+# Each utility makes a handful of kinds of queries, such as {'is_visible':
+# ''} or {'readme': -1, 'files': {'$in': [...]}}, and we had no way to tell
+# which of them scan the whole collection.  WorkloadRecorder is a pymongo
+# command listener that reduces every find, count, distinct, aggregate,
+# update and delete to its shape (the field names and operators, without
+# the values), and counts how often each shape is used and how long it
+# takes, keeping one real example of each.  The shapes can be saved to a
+# file (see record-workload.py, which runs any utility with a recorder
+# attached) and then given to advise(), which runs explain() on each
+# example and says which shapes do collection scans, how many documents
+# they examine per document returned, and which index would cover them.
+#
+# The file is written with bson.json_util, so that ObjectIds, datetimes,
+# regular expressions and the like in the examples come back as what they
+# were.  Each example keeps what its command needs besides the filter (the
+# update, the distinct key, the pipeline and so on), so that it is
+# explained as the command it was and not as a find.
+
+import json
+import threading
+from collections import OrderedDict
+
+from bson import json_util
+from pymongo import monitoring
+
+
+# Globals.
+# .............................................................................
+
+# The commands whose filters we record, and where the filter is in each.
+
+_FILTERS = {'find'     : 'filter',
+            'count'    : 'query',
+            'distinct' : 'query',
+            'delete'   : 'deletes',
+            'update'   : 'updates'}
+
+# Values of these types are left alone in shapes, because the operator
+# they go with is part of the shape.
+
+_OPERATOR_ARGS = {'$exists', '$type', '$size'}
+
+
+# Shapes.
+# .............................................................................
+
+def query_shape(filter):
+    '''Return 'filter' with every value replaced by 1, except operator
+    names and the arguments of $exists and the like, so that queries that
+    differ only in their values have the same shape.'''
+    if isinstance(filter, dict):
+        return OrderedDict((key, filter[key] if key in _OPERATOR_ARGS
+                            else query_shape(filter[key]))
+                           for key in sorted(filter))
+    if isinstance(filter, (list, tuple)):
+        shapes = [query_shape(item) for item in filter]
+        if all(not isinstance(s, dict) for s in shapes):
+            return 1
+        return shapes
+    return 1
+
+
+def _shape_key(collection, command, filter, sort):
+    return json_util.dumps([collection, command, query_shape(filter),
+                            list((sort or {}).keys())])
+
+
+def _filters(command_name, command):
+    # Yields (filter, sort, details) for each query in a command, where
+    # 'details' is the rest of what explain_shape() needs to repeat it.
+    if command_name == 'aggregate':
+        pipeline = command.get('pipeline', [])
+        for stage in pipeline:
+            if '$match' in stage:
+                yield (stage['$match'], None, {'pipeline': pipeline})
+                return
+            if '$sort' in stage:
+                continue
+            return
+        return
+    where = _FILTERS[command_name]
+    if command_name == 'update':
+        for statement in command.get(where, []):
+            yield (statement.get('q', {}), None,
+                   {'u'     : statement.get('u', {}),
+                    'multi' : statement.get('multi', False),
+                    'upsert': statement.get('upsert', False)})
+    elif command_name == 'delete':
+        for statement in command.get(where, []):
+            yield (statement.get('q', {}), None, {'limit': statement.get('limit', 0)})
+    elif command_name == 'distinct':
+        yield (command.get(where) or {}, None, {'key': command.get('key')})
+    else:
+        yield (command.get(where) or {}, command.get('sort'), {})
+
+
+# Recording.
+# .............................................................................
+
+class WorkloadRecorder(monitoring.CommandListener):
+    '''Collects query shapes from the commands pymongo sends.  Register it
+    with pymongo.monitoring.register() before the client is created.
+    'shapes' maps a shape key to a dict with the collection, command,
+    example filter, sort and details, number of uses and total
+    milliseconds.'''
+
+    def __init__(self):
+        self.shapes   = {}
+        self._pending = {}
+        self._lock    = threading.Lock()
+
+    def started(self, event):
+        name = event.command_name
+        if name not in _FILTERS and name != 'aggregate':
+            return
+        command = event.command
+        collection = command.get(name)
+        if not isinstance(collection, str):
+            return
+        keys = []
+        with self._lock:
+            for filter, sort, details in _filters(name, command):
+                key = _shape_key(collection, name, filter, sort)
+                shape = self.shapes.get(key)
+                if shape is None:
+                    shape = self.shapes[key] = {
+                        'database'  : event.database_name,
+                        'collection': collection,
+                        'command'   : name,
+                        'filter'    : filter,
+                        'sort'      : sort,
+                        'details'   : details,
+                        'count'     : 0,
+                        'ms'        : 0.0}
+                shape['count'] += 1
+                keys.append(key)
+            self._pending[event.request_id] = keys
+
+    def _finished(self, event):
+        with self._lock:
+            for key in self._pending.pop(event.request_id, []):
+                self.shapes[key]['ms'] += event.duration_micros/1000.0
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def save(self, file):
+        '''Add the shapes recorded so far to 'file', one JSON object per
+        line, merging them with any shapes already in it, and start over.'''
+        shapes = load_shapes(file, missing_ok=True)
+        with self._lock:
+            for key, shape in self.shapes.items():
+                if key in shapes:
+                    shapes[key]['count'] += shape['count']
+                    shapes[key]['ms'] += shape['ms']
+                else:
+                    shapes[key] = shape
+            self.shapes = {}
+        with open(file, 'w', encoding='utf-8') as f:
+            for key, shape in shapes.items():
+                f.write(json_util.dumps(dict(shape, key=key)) + '\n')
+
+
+def load_shapes(file, missing_ok=False):
+    '''Read shapes saved by WorkloadRecorder.save().'''
+    shapes = OrderedDict()
+    try:
+        with open(file, encoding='utf-8') as f:
+            for line in f:
+                shape = json_util.loads(line)
+                shapes[shape.pop('key')] = shape
+    except FileNotFoundError:
+        if not missing_ok:
+            raise
+    return shapes
+
+
+def record_workload():
+    '''Create a WorkloadRecorder and register it with pymongo.'''
+    recorder = WorkloadRecorder()
+    monitoring.register(recorder)
+    return recorder
+
+
+# Advising.
+# .............................................................................
+
+def _stages(plan):
+    # Yields the stage names in an explain() plan tree.
+    yield plan.get('stage')
+    for child in plan.get('inputStages', []) + [plan.get('inputStage') or {}]:
+        if child:
+            yield from _stages(child)
+
+
+def _fields(filter):
+    # Returns (equality fields, range fields) of a filter, at the top level
+    # and inside $and.  Returns None if there is an $or, $where or $text,
+    # which no single ordinary index serves.
+    equality, ranges = [], []
+    for field, value in filter.items():
+        if field == '$and':
+            for clause in value:
+                sub = _fields(clause)
+                if sub is None:
+                    return None
+                equality += sub[0]
+                ranges += sub[1]
+        elif field.startswith('$'):
+            return None
+        elif isinstance(value, dict) and any(k.startswith('$') for k in value):
+            if set(value) <= {'$eq'}:
+                equality.append(field)
+            else:
+                ranges.append(field)
+        else:
+            equality.append(field)
+    return (equality, ranges)
+
+
+def _partial_filter(filter):
+    # Partial indexes can only use equality, $exists: true, comparisons and
+    # $type, so only top-level equalities on flag-like values qualify.
+    partial = {}
+    for field, value in filter.items():
+        if not field.startswith('$') and not isinstance(value, (dict, list)):
+            if value == '' or isinstance(value, bool) or (type(value) is int and value == -1):
+                partial[field] = value
+    return partial
+
+
+def suggest_index(filter, sort=None):
+    '''Suggest an index for a query: equality fields first, then the sort
+    fields, then range fields.  Returns (keys, partial filter or None), or
+    None if no single index would do or the _id index already does.'''
+    fields = _fields(filter)
+    if fields is None:
+        return None
+    equality, ranges = fields
+    keys = []
+    for field in equality:
+        keys.append((field, 1))
+    for field, direction in (sort or {}).items():
+        if field not in equality:
+            keys.append((field, direction))
+    for field in ranges:
+        if field not in [k for k, _ in keys]:
+            keys.append((field, 1))
+    if not keys or keys[0][0] == '_id':
+        return None
+    return (keys, _partial_filter(filter) or None)
+
+
+def explain_command(shape):
+    '''The command to explain for the example query of a shape: the same
+    kind of command it was recorded from.  Shapes saved without details
+    are explained as a find with the same filter.'''
+    collection, kind = shape['collection'], shape['command']
+    filter, details = shape['filter'], shape.get('details')
+    if kind == 'count':
+        return {'count': collection, 'query': filter}
+    if kind == 'distinct' and details:
+        return {'distinct': collection, 'key': details['key'], 'query': filter}
+    if kind == 'aggregate' and details:
+        return {'aggregate': collection, 'pipeline': details['pipeline'], 'cursor': {}}
+    if kind == 'update' and details:
+        return {'update': collection,
+                'updates': [dict({'q': filter}, **details)]}
+    if kind == 'delete' and details:
+        return {'delete': collection,
+                'deletes': [{'q': filter, 'limit': details['limit']}]}
+    find = {'find': collection, 'filter': filter}
+    if shape.get('sort'):
+        find['sort'] = shape['sort']
+    return find
+
+
+def explain_shape(database, shape):
+    '''Run explain on the example query of a shape.  Returns a dict with
+    'collscan', 'examined', 'returned' and 'millis'.'''
+    command = explain_command(shape)
+    result = database.command('explain', command, verbosity='executionStats')
+    if 'stages' in result:
+        # An aggregate's query is explained in its first stage.
+        result = result['stages'][0].get('$cursor', {})
+    stats = result.get('executionStats', {})
+    plan = result.get('queryPlanner', {}).get('winningPlan', {})
+    return {'collscan': 'COLLSCAN' in set(_stages(plan)),
+            'examined': stats.get('totalDocsExamined', 0),
+            'returned': stats.get('nReturned', 0),
+            'millis'  : stats.get('executionTimeMillis', 0)}
+
+
+def advise(open_database, shapes, log=print):
+    '''Explain each recorded shape and log a report, worst first.
+    'open_database(name)' must return the pymongo Database of that name.
+    Returns a list of (shape, explain results, suggestion).'''
+    databases = {}
+    results = []
+    for shape in shapes.values():
+        if shape['command'] == 'aggregate' and not shape['filter']:
+            continue
+        if shape['database'] not in databases:
+            databases[shape['database']] = open_database(shape['database'])
+        explained = explain_shape(databases[shape['database']], shape)
+        suggestion = None
+        if explained['collscan'] or explained['examined'] > 2*max(1, explained['returned']):
+            suggestion = suggest_index(shape['filter'], shape.get('sort'))
+        results.append((shape, explained, suggestion))
+
+    def cost(result):
+        shape, explained, _ = result
+        return (explained['collscan'], shape['count']*explained['examined'])
+
+    for shape, explained, suggestion in sorted(results, key=cost, reverse=True):
+        log('{}.{} {} x{}  {}'.format(
+            shape['collection'], shape['command'],
+            json.dumps(query_shape(shape['filter'])), shape['count'],
+            'COLLSCAN' if explained['collscan'] else 'index'))
+        log('    {} examined for {} returned ({:.1f} per doc), {} ms, {:.0f} ms total recorded'
+            .format(explained['examined'], explained['returned'],
+                    explained['examined']/max(1, explained['returned']),
+                    explained['millis'], shape['ms']))
+        if suggestion:
+            keys, partial = suggestion
+            text = 'IndexSpec({}'.format(keys)
+            if partial:
+                text += ', partialFilterExpression={}'.format(partial)
+            log('    suggest ' + text + ')')
+    return results